@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Lookup latency of the near-duplicate prompt cache with many stored responses.
+
+    python benchmarks/similarity_cache.py --entries 1000000
+
+Stored prompts are random signatures, which spreads them over the LSH buckets
+like unrelated prompts would. Half of the lookups are near-duplicates of a
+stored prompt, the other half miss.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gptcli.completion import MessageDeltaEvent  # noqa: E402
+from gptcli.similarity import (  # noqa: E402
+    NUM_HASHES,
+    SimilarityCache,
+    SimilarityKey,
+    bucket_keys,
+    minhash,
+    prompt_scope,
+    shingle_hashes,
+)
+
+BATCH_SIZE = 10000
+ARGS = {"model": "gpt-4o", "temperature": 0.0, "top_p": 1.0}
+
+
+def fill(cache: SimilarityCache, scope: str, entries: int, rng: random.Random):
+    events = json.dumps([{"type": "message_delta", "text": "cached response"}])
+    now = time.time()
+    started = time.monotonic()
+    for start in range(0, entries, BATCH_SIZE):
+        signatures = [
+            [rng.getrandbits(58) for _ in range(NUM_HASHES)]
+            for _ in range(min(BATCH_SIZE, entries - start))
+        ]
+        with cache.connection:
+            (last_id,) = cache.connection.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM entries"
+            ).fetchone()
+            first_id = last_id + 1
+            cache.connection.executemany(
+                "INSERT INTO entries "
+                "(id, scope, signature, events, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, 0, ?, ?)",
+                [
+                    (
+                        first_id + i,
+                        scope,
+                        array("Q", signature).tobytes(),
+                        events,
+                        now,
+                        now,
+                    )
+                    for i, signature in enumerate(signatures)
+                ],
+            )
+            cache.connection.executemany(
+                "INSERT OR IGNORE INTO buckets (key, entry_id) VALUES (?, ?)",
+                sorted(
+                    (bucket, first_id + i)
+                    for i, signature in enumerate(signatures)
+                    for bucket in bucket_keys(scope, signature)
+                ),
+            )
+        print(
+            f"\rStored {start + len(signatures)} entries "
+            f"({time.monotonic() - started:.0f}s)",
+            end="",
+            flush=True,
+        )
+    print()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        "p50": statistics.median(samples),
+        "p99": samples[int(len(samples) * 0.99) - 1],
+        "max": samples[-1],
+    }
+
+
+def report(name, samples):
+    stats = percentiles(samples)
+    print(
+        f"{name:<24}"
+        + "".join(f"{k} {v * 1e6:8.1f} us  " for k, v in stats.items())
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--db", type=str, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    path = args.db or os.path.join(tempfile.mkdtemp(), "similar.db")
+    # The filler entries have size 0, so nothing is evicted for size
+    cache = SimilarityCache(path, ttl=float("inf"))
+    messages = [
+        {"role": "system", "content": "You summarize CI logs."},
+        {"role": "user", "content": "Summarize build 1234 from 2024-05-01 10:22:01."},
+    ]
+    scope = prompt_scope("general", messages, ARGS)
+
+    (stored,) = cache.connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+    if stored < args.entries:
+        fill(cache, scope, args.entries - stored, rng)
+
+    prompt = (
+        "You summarize CI logs.\nSummarize the build log below and list the failing "
+        "tests with their error messages. Build 1234 ran on 2024-05-01 10:22:01."
+    )
+    near_duplicate = prompt.replace("Summarize", "Please summarize").replace(
+        "10:22:01", "11:02:47"
+    )
+    signature = minhash(shingle_hashes(prompt))
+    cache.put(SimilarityKey(scope, signature), [MessageDeltaEvent("cached")])
+
+    signing, hits, misses = [], [], []
+    for i in range(args.lookups):
+        if i % 2 == 0:
+            text = near_duplicate
+        else:
+            text = "".join(rng.choices(string.ascii_lowercase + " ", k=150))
+        started = time.perf_counter()
+        key = SimilarityKey(scope, minhash(shingle_hashes(text)))
+        signed = time.perf_counter()
+        found = cache.lookup(key)
+        looked_up = time.perf_counter()
+        signing.append(signed - started)
+        (hits if found is not None else misses).append(looked_up - signed)
+
+    print(f"{args.entries} entries, {len(hits)} hits, {len(misses)} misses")
+    report("signature", signing)
+    if hits:
+        report("index lookup (hit)", hits)
+    if misses:
+        report("index lookup (miss)", misses)
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,20 +2,34 @@ import os
 import sys
 from attr import dataclass
 import platform
-from typing import Any, Dict, Iterator, Optional, TypedDict, List
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    Optional,
+    Sequence,
+    TypedDict,
+    List,
+    TYPE_CHECKING,
+)
 
 from gptcli.completion import (
     CompletionEvent,
     CompletionProvider,
     ModelOverrides,
     Message,
+    iterate_sync,
 )
-#from gptcli.providers.google import GoogleCompletionProvider
-#from gptcli.providers.llama import LLaMACompletionProvider
-from gptcli.providers.openai import OpenAICompletionProvider
-from gptcli.providers.dolphin import DolphinCompletionProvider
-from gptcli.providers.anthropic import AnthropicCompletionProvider
-#from gptcli.providers.cohere import CohereCompletionProvider
+from gptcli.context import ContextConfig, ContextTrim, fit_to_context
+from gptcli.hedge import DEFAULT_HEDGE_DELAY, HedgeConfig, HedgeStats, hedged_complete
+from gptcli.providers import get_provider_class
+
+if TYPE_CHECKING:
+    from gptcli.cache import ResponseCache
+    from gptcli.similarity import SimilarityCache
+    from gptcli.tokens import TokenCounter
 
 
 class AssistantConfig(TypedDict, total=False):
@@ -23,6 +37,8 @@ class AssistantConfig(TypedDict, total=False):
     model: str
     temperature: float
     top_p: float
+    hedge: HedgeConfig
+    context: ContextConfig
 
 
 CONFIG_DEFAULTS = {
@@ -68,31 +84,18 @@ User's `uname`: {platform.uname()}. User's `$SHELL`: {os.environ.get('SHELL')}."
 
 
 def get_completion_provider(model: str) -> CompletionProvider:
-    if (
-        model.startswith("gpt")
-        or model.startswith("ft:gpt")
-        or model.startswith("oai-compat:")
-        or model.startswith("chatgpt")
-        or model.startswith("o1")
-    ):
-        return OpenAICompletionProvider()
-    elif model.startswith("claude"):
-        return AnthropicCompletionProvider()
-    elif model.startswith("llama"):
-        return LLaMACompletionProvider()
-    elif model.startswith("command") or model.startswith("c4ai"):
-        return CohereCompletionProvider()
-    elif model.startswith("dol"):
-        return DolphinCompletionProvider()
-    elif model.startswith("gemini"):
-        return GoogleCompletionProvider()
-    else:
-        raise ValueError(f"Unknown model: {model}")
+    # Only the provider module (and SDK) matching the model is imported. Providers
+    # are cheap to construct, their API clients are shared via providers.get_client
+    return get_provider_class(model)()
 
 
 class Assistant:
-    def __init__(self, config: AssistantConfig):
+    def __init__(self, config: AssistantConfig, name: str = ""):
         self.config = config
+        self.name = name
+        self.hedge_stats = HedgeStats()
+        self.cache: Optional["ResponseCache"] = None
+        self.similarity_cache: Optional["SimilarityCache"] = None
 
     @classmethod
     def from_config(cls, name: str, config: AssistantConfig):
@@ -105,7 +108,7 @@ class Assistant:
                 if config.get(key) is None:
                     config[key] = default_config[key]
 
-        return cls(config)
+        return cls(config, name)
 
     def init_messages(self) -> List[Message]:
         return self.config.get("messages", [])[:]
@@ -121,11 +124,81 @@ class Assistant:
             param, self.config.get(param, CONFIG_DEFAULTS[param])
         )
 
+    def _completion_provider(self, model: str) -> CompletionProvider:
+        provider = get_completion_provider(model)
+        if self.similarity_cache is not None:
+            from gptcli.similarity import SimilarityCachedProvider
+
+            provider = SimilarityCachedProvider(
+                provider, self.similarity_cache, self.name
+            )
+        if self.cache is not None:
+            # Exact hits are checked first, they are the cheapest
+            from gptcli.cache import CachedProvider
+
+            provider = CachedProvider(provider, self.cache)
+        return provider
+
+    def _hedge_model(self, model: str) -> Optional[str]:
+        hedge_model = self.config.get("hedge", {}).get("model")
+        return hedge_model if hedge_model != model else None
+
+    def _fit_to_context(
+        self,
+        messages: Sequence[Message],
+        model: str,
+        on_trim: Optional[Callable[[ContextTrim], None]],
+        token_counter: "Optional[TokenCounter]" = None,
+    ) -> Sequence[Message]:
+        # The assistant's own messages are never trimmed
+        messages, trim = fit_to_context(
+            messages,
+            model,
+            len(self.init_messages()),
+            self.config.get("context", {}),
+            token_counter,
+        )
+        if trim is not None and on_trim is not None:
+            on_trim(trim)
+        return messages
+
+    def _ahedged_complete(
+        self,
+        messages,
+        override_params: ModelOverrides,
+        hedge_model: str,
+        stream: bool,
+    ) -> AsyncIterator[CompletionEvent]:
+        return hedged_complete(
+            lambda: self.acomplete_chat(
+                messages, override_params, stream=stream, hedge=False
+            ),
+            lambda: self.acomplete_chat(
+                messages,
+                {**override_params, "model": hedge_model},
+                stream=stream,
+                hedge=False,
+            ),
+            float(self.config["hedge"].get("delay", DEFAULT_HEDGE_DELAY)),
+            self.hedge_stats,
+        )
+
     def complete_chat(
-        self, messages, override_params: ModelOverrides = {}, stream: bool = True, tools=[], tool_choice=False
+        self, messages, override_params: ModelOverrides = {}, stream: bool = True, tools=[], tool_choice=False,
+        on_trim: Optional[Callable[[ContextTrim], None]] = None,
+        token_counter: "Optional[TokenCounter]" = None,
     ) -> Iterator[str]:
         model = self._param("model", override_params)
-        completion_provider = get_completion_provider(model)
+        messages = self._fit_to_context(messages, model, on_trim, token_counter)
+        hedge_model = self._hedge_model(model)
+        if hedge_model is not None and not tools:
+            return iterate_sync(
+                self._ahedged_complete(messages, override_params, hedge_model, stream)
+            )
+
+        completion_provider = self._completion_provider(model)
+        # Providers serialize the messages, which needs a list rather than a snapshot
+        messages = list(messages)
 
         try:
             params = {
@@ -135,11 +208,13 @@ class Assistant:
             }
             if tool_choice:
                 params["tool_choice"] = "required"
+            # Only some providers take tools
+            kwargs = {"tools": tools} if tools else {}
             return completion_provider.complete(
                 messages,
                 params,
                 stream=stream,
-                tools=tools,
+                **kwargs,
             )
         except:
             return completion_provider.complete(
@@ -153,6 +228,34 @@ class Assistant:
             )
 
 
+    def acomplete_chat(
+        self,
+        messages,
+        override_params: ModelOverrides = {},
+        stream: bool = True,
+        hedge: bool = True,
+        on_trim: Optional[Callable[[ContextTrim], None]] = None,
+        token_counter: "Optional[TokenCounter]" = None,
+    ) -> AsyncIterator[CompletionEvent]:
+        model = self._param("model", override_params)
+        messages = self._fit_to_context(messages, model, on_trim, token_counter)
+        hedge_model = self._hedge_model(model) if hedge else None
+        if hedge_model is not None:
+            return self._ahedged_complete(
+                messages, override_params, hedge_model, stream
+            )
+
+        completion_provider = self._completion_provider(model)
+        return completion_provider.acomplete(
+            list(messages),
+            {
+                "model": model,
+                "temperature": float(self._param("temperature", override_params)),
+                "top_p": float(self._param("top_p", override_params)),
+            },
+            stream=stream,
+        )
+
     def OLDcomplete_chat(
         self, messages, override_params: ModelOverrides = {}, stream: bool = True
     ) -> Iterator[CompletionEvent]:
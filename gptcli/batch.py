@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import ExitStack
+from typing import IO, Any, Dict, List, Optional, Set, Tuple
+
+from attr import dataclass
+
+from gptcli.assistant import Assistant
+from gptcli.completion import (
+    BadRequestError,
+    Message,
+    ModelOverrides,
+    UsageEvent,
+    run_sync,
+)
+
+logger = logging.getLogger("gptcli-batch")
+
+RETRY_BACKOFF_SECONDS = 1.0
+
+
+class BatchInputError(Exception):
+    pass
+
+
+@dataclass
+class BatchItem:
+    id: Any
+    messages: List[Message]
+    overrides: ModelOverrides
+
+
+@dataclass
+class BatchSummary:
+    completed: int = 0
+    failed: int = 0
+    skipped: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+
+    def add_usage(self, usage: UsageEvent):
+        self.prompt_tokens += usage.prompt_tokens
+        self.completion_tokens += usage.completion_tokens
+        self.cost += usage.cost
+
+
+def parse_line(assistant: Assistant, line_number: int, line: str) -> BatchItem:
+    """
+    An input line is a JSON object with either a `prompt` string or a `messages`
+    list, an optional `id` (defaults to the line number) and optional model overrides.
+    The assistant's system messages are prepended unless `messages` brings its own.
+    """
+    try:
+        data = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise BatchInputError(f"Line {line_number}: invalid JSON: {e}") from e
+    if not isinstance(data, dict):
+        raise BatchInputError(f"Line {line_number}: expected a JSON object")
+
+    init_messages = assistant.init_messages()
+    if "prompt" in data:
+        messages: List[Message] = [{"role": "user", "content": data["prompt"]}]
+    elif "messages" in data:
+        messages = data["messages"]
+        if messages and messages[0].get("role") == "system":
+            init_messages = []
+    else:
+        raise BatchInputError(f"Line {line_number}: expected `prompt` or `messages`")
+
+    overrides = {}
+    for key in assistant.supported_overrides():
+        if key in data:
+            overrides[key] = data[key]
+
+    return BatchItem(
+        id=data.get("id", line_number),
+        messages=init_messages + messages,
+        overrides=overrides,
+    )
+
+
+def read_completed_ids(out_path: str) -> Set[Any]:
+    """
+    Returns the ids of lines already answered in a previous run's output.
+    """
+    completed: Set[Any] = set()
+    if not os.path.isfile(out_path):
+        return completed
+
+    with open(out_path) as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be truncated if the previous run was killed
+                continue
+            if result.get("error") is None:
+                completed.add(result.get("id"))
+    return completed
+
+
+async def complete_item(
+    assistant: Assistant, item: BatchItem, retries: int
+) -> Tuple[Dict[str, Any], Optional[UsageEvent]]:
+    attempt = 0
+    started = time.monotonic()
+    while True:
+        attempt += 1
+        response = ""
+        usage: Optional[UsageEvent] = None
+        try:
+            async for event in assistant.acomplete_chat(
+                item.messages, override_params=item.overrides, stream=False
+            ):
+                if event.type == "message_delta":
+                    response += event.text
+                elif event.type == "usage":
+                    usage = event
+            error = None
+        except BadRequestError as e:
+            # Retrying the same request won't help
+            error = str(e)
+        except Exception as e:
+            if attempt <= retries:
+                logger.warning(f"Line {item.id} failed (attempt {attempt}): {e}")
+                await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+                continue
+            error = f"{type(e).__name__}: {e}"
+
+        result = {
+            "id": item.id,
+            "response": response if error is None else None,
+            "error": error,
+            "attempts": attempt,
+            "latency": round(time.monotonic() - started, 3),
+            "usage": None,
+        }
+        if usage is not None:
+            result["usage"] = {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "total_tokens": usage.total_tokens,
+                "cost": usage.cost,
+            }
+        return result, usage
+
+
+async def run_batch_async(
+    assistant: Assistant,
+    input_file: IO[str],
+    output_file: IO[str],
+    concurrency: int,
+    retries: int,
+    completed_ids: Set[Any],
+) -> BatchSummary:
+    summary = BatchSummary()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        while (item := await queue.get()) is not None:
+            result, usage = await complete_item(assistant, item, retries)
+            # Written as soon as the line completes, so an interrupted run can resume
+            output_file.write(json.dumps(result) + "\n")
+            output_file.flush()
+            if result["error"] is None:
+                summary.completed += 1
+            else:
+                summary.failed += 1
+            if usage is not None:
+                summary.add_usage(usage)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        for line_number, line in enumerate(input_file):
+            if not line.strip():
+                continue
+            item = parse_line(assistant, line_number, line)
+            if item.id in completed_ids:
+                summary.skipped += 1
+                continue
+            await queue.put(item)
+    finally:
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    return summary
+
+
+def run_batch(
+    assistant: Assistant,
+    input_path: str,
+    output_path: Optional[str],
+    concurrency: int,
+    retries: int,
+) -> BatchSummary:
+    completed_ids = read_completed_ids(output_path) if output_path else set()
+
+    with ExitStack() as stack:
+        input_file = (
+            stack.enter_context(open(input_path)) if input_path != "-" else sys.stdin
+        )
+        output_file = (
+            stack.enter_context(open(output_path, "a")) if output_path else sys.stdout
+        )
+        summary = run_sync(
+            run_batch_async(
+                assistant,
+                input_file,
+                output_file,
+                max(concurrency, 1),
+                retries,
+                completed_ids,
+            )
+        )
+
+    print(
+        f"Completed: {summary.completed} | Failed: {summary.failed} | Skipped: {summary.skipped} | "
+        f"Tokens: {summary.prompt_tokens + summary.completion_tokens} | Price: ${summary.cost:.3f}",
+        file=sys.stderr,
+    )
+    return summary
@@ -0,0 +1,343 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional, TypedDict
+
+from attr import dataclass
+
+from gptcli.completion import (
+    CompletionEvent,
+    CompletionProvider,
+    Message,
+    MessageDeltaEvent,
+    UsageEvent,
+)
+
+logger = logging.getLogger("gptcli-cache")
+
+DEFAULT_CACHE_DB = os.path.join(
+    os.path.expanduser("~"), ".config", "gpt-cli", "cache.db"
+)
+DEFAULT_MAX_SIZE_MB = 100.0
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+# Bumped when the key or the stored events change meaning
+KEY_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    events TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at);
+CREATE INDEX IF NOT EXISTS responses_created ON responses (created_at);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class ResponseCacheConfig(TypedDict, total=False):
+    path: str
+    # The cache is trimmed to this size, least recently used responses first
+    max_size_mb: float
+    # Seconds a response is served from the cache
+    ttl: float
+    # Cache responses at any temperature, not only the deterministic ones at 0
+    all_temperatures: bool
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    entries: int = 0
+    size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def cache_key(messages: List[Message], args: dict, tools: Any = None) -> str:
+    """
+    A hash of everything that determines the response. Equal requests get equal
+    keys regardless of dict ordering or int/float spelling of the parameters.
+    """
+    request = {
+        "version": KEY_VERSION,
+        "model": args["model"],
+        "temperature": float(args.get("temperature", 0.0)),
+        "top_p": float(args.get("top_p", 1.0)),
+        "messages": [
+            {"role": message["role"], "content": message["content"]}
+            for message in messages
+        ],
+        "tools": tools or [],
+    }
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def dump_event(event: CompletionEvent) -> Optional[dict]:
+    if isinstance(event, MessageDeltaEvent):
+        return {"type": "message_delta", "text": event.text}
+    if isinstance(event, UsageEvent):
+        return {
+            "type": "usage",
+            "prompt_tokens": event.prompt_tokens,
+            "completion_tokens": event.completion_tokens,
+            "total_tokens": event.total_tokens,
+            "cost": event.cost,
+        }
+    # Not a plain completion event, e.g. a tool call
+    return None
+
+
+def load_event(data: dict) -> CompletionEvent:
+    data = dict(data)
+    if data.pop("type") == "usage":
+        return UsageEvent(**data)
+    return MessageDeltaEvent(**data)
+
+
+class ResponseCache:
+    """
+    Complete responses in a local SQLite database, keyed by `cache_key`. The
+    database is trimmed to `max_size_mb` by evicting the least recently used
+    responses, and responses older than `ttl` seconds are never served.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_DB,
+        max_size_mb: float = DEFAULT_MAX_SIZE_MB,
+        ttl: float = DEFAULT_TTL,
+        all_temperatures: bool = False,
+    ):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.all_temperatures = all_temperatures
+        # Lookups and hits of this process, the database keeps the totals
+        self.stats = CacheStats()
+        self.lock = threading.Lock()
+        # Concurrent CI jobs may share the cache, wait for their writes
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, config: ResponseCacheConfig) -> "ResponseCache":
+        return cls(
+            os.path.expanduser(config.get("path", DEFAULT_CACHE_DB)),
+            config.get("max_size_mb", DEFAULT_MAX_SIZE_MB),
+            config.get("ttl", DEFAULT_TTL),
+            config.get("all_temperatures", False),
+        )
+
+    def accepts(self, args: dict) -> bool:
+        """
+        Whether responses to requests with these parameters are cached.
+        """
+        return self.all_temperatures or float(args.get("temperature", 0.0)) == 0.0
+
+    def _count(self, name: str):
+        self.connection.execute(
+            "INSERT INTO stats (name, value) VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key: str) -> Optional[List[CompletionEvent]]:
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT events, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[1] < now - self.ttl:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+
+            if row is None:
+                self.stats.misses += 1
+                self._count("misses")
+                return None
+
+            self.connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self.stats.hits += 1
+            self._count("hits")
+        return [load_event(event) for event in json.loads(row[0])]
+
+    def put(self, key: str, events: List[CompletionEvent]):
+        dumped = [dump_event(event) for event in events]
+        if any(event is None for event in dumped):
+            return
+        data = json.dumps(dumped)
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, events, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float):
+        self.connection.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+        )
+        (size,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if size <= self.max_size:
+            return
+        # Keep the most recently used responses that fit
+        cursor = self.connection.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "  SELECT key FROM ("
+            "    SELECT key, SUM(size) OVER ("
+            "      ORDER BY accessed_at DESC, rowid DESC"
+            "    ) AS total FROM responses"
+            "  ) WHERE total > ?"
+            ")",
+            (self.max_size,),
+        )
+        logger.debug("Evicted %d cached responses", cursor.rowcount)
+
+    def total_stats(self) -> CacheStats:
+        """
+        Hits and misses of every process that used the cache, and its contents.
+        """
+        with self.lock:
+            counts = dict(
+                self.connection.execute("SELECT name, value FROM stats").fetchall()
+            )
+            entries, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return CacheStats(
+            hits=counts.get("hits", 0),
+            misses=counts.get("misses", 0),
+            entries=entries,
+            size=size,
+        )
+
+    def close(self):
+        logger.info(
+            "Response cache: %d hits, %d misses (%.0f%% hit rate)",
+            self.stats.hits,
+            self.stats.misses,
+            self.stats.hit_rate * 100,
+        )
+        with self.lock:
+            self.connection.close()
+
+
+class CachedProvider(CompletionProvider):
+    """
+    Serves repeated requests from a ResponseCache. A response is only stored once
+    it has been received in full, and hits are replayed in the chunks they were
+    streamed in, or as a single message when not streaming.
+
+    Subclasses serve other caches with the same `accepts`, `get` and `put`
+    methods by overriding `_key`.
+    """
+
+    def __init__(self, provider: CompletionProvider, cache: Any):
+        self.provider = provider
+        self.cache = cache
+
+    def _key(self, messages: List[Message], args: dict, tools: Any = None) -> Any:
+        return cache_key(messages, args, tools)
+
+    def _check_arguments(self, kwargs: dict):
+        provider = self.provider
+        while isinstance(provider, CachedProvider):
+            provider = provider.provider
+        parameters = inspect.signature(provider.complete).parameters
+        if any(p.kind == p.VAR_KEYWORD for p in parameters.values()):
+            return
+        unsupported = [name for name in kwargs if name not in parameters]
+        if unsupported:
+            raise TypeError(
+                f"{type(provider).__name__}.complete() got unexpected arguments: "
+                + ", ".join(unsupported)
+            )
+
+    def _replay(
+        self, events: List[CompletionEvent], stream: bool
+    ) -> List[CompletionEvent]:
+        # The tokens are reported as they were, but nothing was spent on them
+        events = [
+            UsageEvent(e.prompt_tokens, e.completion_tokens, e.total_tokens, cost=0.0)
+            if isinstance(e, UsageEvent)
+            else e
+            for e in events
+        ]
+        if stream:
+            return events
+        text = "".join(e.text for e in events if isinstance(e, MessageDeltaEvent))
+        usage = [e for e in events if isinstance(e, UsageEvent)]
+        return [MessageDeltaEvent(text), *usage]
+
+    def complete(
+        self, messages: List[Message], args: dict, stream: bool = False, **kwargs
+    ) -> Iterator[CompletionEvent]:
+        if not self.cache.accepts(args):
+            return self.provider.complete(messages, args, stream, **kwargs)
+        # Checked before the lookup, so a caller retrying without the arguments
+        # the provider doesn't take (e.g. tools) doesn't count a second miss
+        self._check_arguments(kwargs)
+        key = self._key(messages, args, kwargs.get("tools"))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return iter(self._replay(cached, stream))
+        # Called here rather than in the generator, so that a provider rejecting
+        # the arguments fails the call like an uncached one would
+        events = self.provider.complete(messages, args, stream, **kwargs)
+        return self._record(key, events)
+
+    def _record(
+        self, key: Any, events: Iterator[CompletionEvent]
+    ) -> Iterator[CompletionEvent]:
+        received = []
+        for event in events:
+            received.append(event)
+            yield event
+        self.cache.put(key, received)
+
+    async def acomplete(
+        self, messages: List[Message], args: dict, stream: bool = False
+    ) -> AsyncIterator[CompletionEvent]:
+        if not self.cache.accepts(args):
+            async for event in self.provider.acomplete(messages, args, stream):
+                yield event
+            return
+
+        key = self._key(messages, args)
+        cached = self.cache.get(key)
+        if cached is not None:
+            for event in self._replay(cached, stream):
+                yield event
+            return
+
+        received = []
+        async for event in self.provider.acomplete(messages, args, stream):
+            received.append(event)
+            yield event
+        self.cache.put(key, received)
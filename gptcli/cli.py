@@ -1,19 +1,35 @@
 import re
-from typing import Any, Dict, Optional, Tuple
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
-from openai import BadRequestError, OpenAIError
 from prompt_toolkit import PromptSession
 from prompt_toolkit.history import FileHistory
 from prompt_toolkit.key_binding import KeyBindings, KeyPressEvent
 from prompt_toolkit.key_binding.bindings import named_commands
-from rich.console import Console
+from rich.console import (Console, ConsoleOptions, Group, RenderableType,
+                          RenderResult)
 from rich.live import Live
 from rich.markdown import Markdown
+from rich.padding import Padding
+from rich.panel import Panel
+from rich.segment import Segment
+from rich.table import Table
 from rich.text import Text
 
+from gptcli.assistant import Assistant
+from gptcli.compare import CompareStreamer, ComparisonResult
+from gptcli.completion import BadRequestError, CompletionError, Message
+from gptcli.composite import CompositeChatListener, ThreadedChatListener
+from gptcli.context import ContextTrim
+from gptcli.cost import PriceChatListener
+from gptcli.logging import LoggingChatListener
+from gptcli.markdown import MarkdownBlockSplitter
 from gptcli.session import (ALL_COMMANDS, COMMAND_CLEAR, COMMAND_QUIT,
-                            COMMAND_RERUN, ChatListener, InvalidArgumentError,
-                            ResponseStreamer, UserInputProvider)
+                            COMMAND_RERUN, ChatListener, ChatSession,
+                            InvalidArgumentError, ResponseStreamer,
+                            UserInputProvider)
+from gptcli.store import SessionStore, SessionStoreListener
 
 TERMINAL_WELCOME = """
 Hi! I'm here to help. Type `:q` or Ctrl-D to exit, `:c` or Ctrl-C and Enter to clear
@@ -24,12 +40,36 @@ Try `:?` for help.
 """
 
 
+class MarkdownBlock:
+    """
+    Renders a single Markdown block without the leading blank line rich emits
+    before some elements (e.g. lists), so blocks can be separated uniformly.
+    """
+
+    def __init__(self, text: str, style: str):
+        self.markdown = Markdown(text, style=style)
+
+    def __rich_console__(self, console: Console, options: ConsoleOptions) -> RenderResult:
+        lines = console.render_lines(self.markdown, options, pad=False)
+        while lines and not "".join(segment.text for segment in lines[0]):
+            lines.pop(0)
+        for line in lines:
+            yield from line
+            yield Segment.line()
+
+
 class StreamingMarkdownPrinter:
+    """
+    Completed Markdown blocks are printed once to the scrollback, only the block
+    that is still being streamed is re-rendered in the `Live` region.
+    """
+
     def __init__(self, console: Console, markdown: bool):
         self.console = console
-        self.current_text = ""
         self.markdown = markdown
         self.live: Optional[Live] = None
+        self.splitter = MarkdownBlockSplitter()
+        self.printed_blocks = 0
 
     def __enter__(self) -> "StreamingMarkdownPrinter":
         if self.markdown:
@@ -39,12 +79,20 @@ class StreamingMarkdownPrinter:
             self.live.__enter__()
         return self
 
+    def _render(self, text: str) -> RenderableType:
+        content = MarkdownBlock(text, style="green")
+        if self.printed_blocks > 0:
+            # Separate from the previous block like a single Markdown render would
+            return Padding(content, (1, 0, 0, 0))
+        return content
+
     def print(self, text: str):
-        self.current_text += text
         if self.markdown:
             assert self.live
-            content = Markdown(self.current_text, style="green")
-            self.live.update(content)
+            for block in self.splitter.feed(text):
+                self.live.console.print(self._render(block))
+                self.printed_blocks += 1
+            self.live.update(self._render(self.splitter.pending))
             self.live.refresh()
         else:
             self.console.print(Text(text, style="green"), end="")
@@ -52,16 +100,29 @@ class StreamingMarkdownPrinter:
     def __exit__(self, *args):
         if self.markdown:
             assert self.live
+            self.live.update(self._render(self.splitter.flush()))
+            self.live.refresh()
             self.live.__exit__(*args)
         self.console.print()
 
 
 class CLIResponseStreamer(ResponseStreamer):
-    def __init__(self, console: Console, markdown: bool):
+    """
+    Coalesces tokens and hands them to the printer at most `max_fps` times per
+    second, or as soon as a line (e.g. a closing code fence) is complete.
+    """
+
+    def __init__(self, console: Console, markdown: bool, max_fps: float = 0):
         self.console = console
         self.markdown = markdown
         self.printer = StreamingMarkdownPrinter(self.console, self.markdown)
         self.first_token = True
+        self.flush_interval = 1 / max_fps if max_fps > 0 else 0
+        self.buffer = ""
+        self.last_flush = 0.0
+        self.flush_timer: Optional[threading.Timer] = None
+        # Reentrant, since a KeyboardInterrupt during a flush still flushes in __exit__
+        self.lock = threading.RLock()
 
     def __enter__(self):
         self.printer.__enter__()
@@ -71,15 +132,134 @@ class CLIResponseStreamer(ResponseStreamer):
         if self.first_token and token.startswith(" "):
             token = token[1:]
         self.first_token = False
-        self.printer.print(token)
+
+        with self.lock:
+            self.buffer += token
+            elapsed = time.monotonic() - self.last_flush
+            if "\n" in token or elapsed >= self.flush_interval:
+                self._flush()
+            elif self.flush_timer is None:
+                # Don't hold back the tail of the buffer if the next token is slow to arrive
+                self.flush_timer = threading.Timer(
+                    self.flush_interval - elapsed, self._flush_locked
+                )
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def _flush_locked(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.buffer:
+            buffer, self.buffer = self.buffer, ""
+            self.printer.print(buffer)
+        self.last_flush = time.monotonic()
 
     def __exit__(self, *args):
+        self._flush_locked()
         self.printer.__exit__(*args)
 
 
+def _format_seconds(seconds: Optional[float]) -> str:
+    return f"{seconds:.2f}s" if seconds is not None else "-"
+
+
+class CLICompareStreamer(CompareStreamer):
+    """
+    Streams the responses of several models into one panel per model, side by
+    side if the terminal is wide enough, and prints a summary table at the end.
+    """
+
+    MIN_COLUMN_WIDTH = 40
+
+    def __init__(self, console: Console, models: List[str], markdown: bool):
+        self.console = console
+        self.models = models
+        self.markdown = markdown
+        self.responses: Dict[str, str] = {model: "" for model in models}
+        self.results: Dict[str, ComparisonResult] = {}
+        self.live = Live(
+            console=self.console,
+            get_renderable=self._render,
+            refresh_per_second=10,
+            vertical_overflow="visible",
+        )
+
+    def __enter__(self) -> "CLICompareStreamer":
+        self.live.__enter__()
+        return self
+
+    def _render_panel(self, model: str) -> Panel:
+        text = self.responses[model]
+        result = self.results.get(model)
+        if result is not None and result.error is not None:
+            content: RenderableType = Text(result.error, style="red")
+        elif self.markdown:
+            content = Markdown(text, style="green")
+        else:
+            content = Text(text, style="green")
+
+        subtitle = None
+        if result is not None:
+            subtitle = (
+                f"TTFT {_format_seconds(result.time_to_first_token)} | "
+                f"Latency {_format_seconds(result.latency)}"
+            )
+        return Panel(content, title=model, subtitle=subtitle, subtitle_align="right")
+
+    def _render(self) -> RenderableType:
+        panels = [self._render_panel(model) for model in self.models]
+        if self.console.width // len(self.models) >= self.MIN_COLUMN_WIDTH:
+            grid = Table.grid(expand=True)
+            for _ in panels:
+                grid.add_column(ratio=1)
+            grid.add_row(*panels)
+            return grid
+        return Group(*panels)
+
+    def on_next_token(self, model: str, token: str):
+        self.responses[model] += token
+
+    def on_model_done(self, result: ComparisonResult):
+        self.results[result.model] = result
+
+    def _summary(self) -> Table:
+        table = Table(title="Comparison", title_style="bold")
+        table.add_column("Model")
+        table.add_column("TTFT", justify="right")
+        table.add_column("Latency", justify="right")
+        table.add_column("Tokens", justify="right")
+        table.add_column("Price", justify="right")
+        for model in self.models:
+            result = self.results.get(model)
+            if result is None:
+                table.add_row(model, "-", "-", "-", "-")
+                continue
+            usage = result.usage
+            has_cost = usage is not None and usage.cost is not None
+            table.add_row(
+                model if result.error is None else f"[red]{model}[/red]",
+                _format_seconds(result.time_to_first_token),
+                _format_seconds(result.latency),
+                str(usage.total_tokens) if usage is not None else "-",
+                f"${usage.cost:.3f}" if has_cost else "-",
+            )
+        return table
+
+    def __exit__(self, *args):
+        self.live.refresh()
+        self.live.__exit__(*args)
+        self.console.print(self._summary())
+
+
 class CLIChatListener(ChatListener):
-    def __init__(self, markdown: bool):
+    def __init__(self, markdown: bool, max_fps: float = 0):
         self.markdown = markdown
+        self.max_fps = max_fps
         self.console = Console()
 
     def on_chat_start(self):
@@ -100,7 +280,7 @@ class CLIChatListener(ChatListener):
             self.console.print(
                 f"[red]Request Error. The last prompt was not saved: {type(e)}: {e}[/red]"
             )
-        elif isinstance(e, OpenAIError):
+        elif isinstance(e, CompletionError):
             self.console.print(
                 f"[red]API Error. Type `r` or Ctrl-R to try again: {type(e)}: {e}[/red]"
             )
@@ -109,8 +289,62 @@ class CLIChatListener(ChatListener):
         else:
             self.console.print(f"[red]Error: {type(e)}: {e}[/red]")
 
+    def on_context_trimmed(self, trim: ContextTrim):
+        action = "Collapsed" if trim.collapsed else "Dropped"
+        self.console.print(
+            f"{action} the {trim.dropped_messages} oldest messages to fit the "
+            f"{trim.limit}-token context of {trim.model}.",
+            style="dim",
+        )
+
+    def on_chat_resumed(self, session_id: int, messages: Sequence[Message]):
+        self.console.print(
+            f"[bold]Resumed session {session_id} ({len(messages)} messages).[/bold]"
+        )
+        # Show where the conversation left off
+        for message in messages[-2:]:
+            if message["role"] == "assistant":
+                self.console.print(MarkdownBlock(message["content"], style="green"))
+            elif message["role"] == "user":
+                self.console.print(Text(f"> {message['content']}", style="dim"))
+
     def response_streamer(self) -> ResponseStreamer:
-        return CLIResponseStreamer(self.console, self.markdown)
+        return CLIResponseStreamer(self.console, self.markdown, self.max_fps)
+
+    def compare_streamer(self, models: List[str]) -> CompareStreamer:
+        return CLICompareStreamer(self.console, models, self.markdown)
+
+
+class CLIChatSession(ChatSession):
+    def __init__(
+        self,
+        assistant: Assistant,
+        markdown: bool,
+        show_price: bool,
+        max_fps: float = 0,
+        async_logging: bool = True,
+        sessions_db: Optional[str] = None,
+    ):
+        logging_listener: ChatListener = LoggingChatListener()
+        if async_logging:
+            # Keeps log file writes off the token path
+            logging_listener = ThreadedChatListener(logging_listener)
+
+        listeners = [
+            CLIChatListener(markdown, max_fps),
+            logging_listener,
+        ]
+
+        if show_price:
+            listeners.append(PriceChatListener(assistant))
+
+        store = None
+        if sessions_db is not None:
+            store = SessionStore(sessions_db)
+            listeners.append(ThreadedChatListener(SessionStoreListener(store)))
+
+        listener = CompositeChatListener(listeners)
+        super().__init__(assistant, listener, store)
 
 
 def parse_args(input: str) -> Tuple[str, Dict[str, Any]]:
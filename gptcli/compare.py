@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional
+
+from attr import dataclass
+
+from gptcli.assistant import Assistant
+from gptcli.completion import Message, ModelOverrides, UsageEvent, run_sync
+
+logger = logging.getLogger("gptcli-compare")
+
+
+@dataclass
+class ComparisonResult:
+    model: str
+    response: str = ""
+    time_to_first_token: Optional[float] = None
+    latency: Optional[float] = None
+    usage: Optional[UsageEvent] = None
+    error: Optional[str] = None
+
+
+class CompareStreamer:
+    def __enter__(self) -> "CompareStreamer":
+        return self
+
+    def on_next_token(self, model: str, token: str):
+        pass
+
+    def on_model_done(self, result: ComparisonResult):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+def parse_models(models: str) -> List[str]:
+    return [model.strip() for model in models.split(",") if model.strip()]
+
+
+async def _complete_model(
+    assistant: Assistant,
+    messages: List[Message],
+    model: str,
+    overrides: ModelOverrides,
+    streamer: CompareStreamer,
+) -> ComparisonResult:
+    result = ComparisonResult(model=model)
+    started = time.monotonic()
+    try:
+        # Hedging could show another model's response in this model's column
+        async for event in assistant.acomplete_chat(
+            messages,
+            override_params={**overrides, "model": model},
+            stream=True,
+            hedge=False,
+        ):
+            if event.type == "message_delta":
+                if result.time_to_first_token is None:
+                    result.time_to_first_token = time.monotonic() - started
+                result.response += event.text
+                streamer.on_next_token(model, event.text)
+            elif event.type == "usage":
+                result.usage = event
+    except Exception as e:
+        # One failing model shouldn't abort the others
+        logger.exception(e)
+        result.error = f"{type(e).__name__}: {e}"
+
+    result.latency = time.monotonic() - started
+    streamer.on_model_done(result)
+    return result
+
+
+async def compare_models_async(
+    assistant: Assistant,
+    messages: List[Message],
+    models: List[str],
+    overrides: ModelOverrides,
+    streamer: CompareStreamer,
+) -> List[ComparisonResult]:
+    return list(
+        await asyncio.gather(
+            *(
+                _complete_model(assistant, messages, model, overrides, streamer)
+                for model in models
+            )
+        )
+    )
+
+
+def compare_models(
+    assistant: Assistant,
+    messages: List[Message],
+    models: List[str],
+    overrides: ModelOverrides,
+    streamer: CompareStreamer,
+) -> List[ComparisonResult]:
+    """
+    Stream the completion of `messages` from all `models` concurrently, so the
+    comparison takes as long as the slowest model rather than the sum of all.
+    """
+    with streamer:
+        return run_sync(
+            compare_models_async(assistant, messages, models, overrides, streamer)
+        )
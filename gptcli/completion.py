@@ -1,5 +1,16 @@
-from abc import abstractmethod
-from typing import Iterator, List, Literal, TypedDict, Union
+import threading
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterator,
+    List,
+    Literal,
+    TypedDict,
+    TypeVar,
+    Union,
+)
 
 from attr import dataclass
 
@@ -49,15 +60,188 @@ class UsageEvent:
 
 CompletionEvent = Union[MessageDeltaEvent, UsageEvent]
 
+T = TypeVar("T")
+
 
 class CompletionProvider:
-    @abstractmethod
+    """
+    Providers implement `complete`, `acomplete` or both. Each one defaults to
+    adapting the other, so a provider with only an async implementation still
+    works with the synchronous CLI and vice versa.
+    """
+
     def complete(
         self, messages: List[Message], args: dict, stream: bool = False
     ) -> Iterator[CompletionEvent]:
+        return iterate_sync(self.acomplete(messages, args, stream))
+
+    async def acomplete(
+        self, messages: List[Message], args: dict, stream: bool = False
+    ) -> AsyncIterator[CompletionEvent]:
+        async for event in iterate_async(self.complete(messages, args, stream)):
+            yield event
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def event_loop() -> Any:
+    """
+    The process-wide event loop that synchronous code runs coroutines on. It runs
+    in a daemon thread for the life of the process, so the async API clients bound
+    to it, and their connection pools, are reused by every call.
+    """
+    import asyncio
+
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="gptcli-event-loop", daemon=True
+            ).start()
+    return _loop
+
+
+def _submit(awaitable: Awaitable[T]) -> Any:
+    import asyncio
+
+    async def wait() -> T:
+        return await awaitable
+
+    return asyncio.run_coroutine_threadsafe(wait(), event_loop())
+
+
+def _result(future: Any) -> Any:
+    try:
+        return future.result()
+    except BaseException:
+        # e.g. a KeyboardInterrupt while waiting
+        future.cancel()
+        raise
+
+
+def run_sync(awaitable: Awaitable[T]) -> T:
+    """
+    Run `awaitable` on the process-wide event loop and wait for its result.
+    """
+    return _result(_submit(awaitable))
+
+
+def iterate_sync(events: AsyncIterator[CompletionEvent]) -> Iterator[CompletionEvent]:
+    """
+    Drive an async event stream from synchronous code on the process-wide event loop.
+    """
+    step = None
+    cancelled = False
+
+    def cancel():
+        nonlocal cancelled
+        cancelled = True
+        if step is not None:
+            step.cancel()
+
+    on_cancel(cancel)
+    try:
+        while True:
+            step = _submit(events.__anext__())
+            if cancelled:
+                # Cancelled between two steps
+                step.cancel()
+            try:
+                yield _result(step)
+            except StopAsyncIteration:
+                return
+    finally:
+        aclose = getattr(events, "aclose", None)
+        if aclose is not None:
+            try:
+                run_sync(aclose())
+            except RuntimeError:
+                # Still running the step that was interrupted, which closes it
+                pass
+
+
+async def iterate_async(events: Iterator[CompletionEvent]) -> AsyncIterator[CompletionEvent]:
+    """
+    Consume a blocking event stream in a worker thread without blocking the event loop.
+    """
+    import asyncio
+
+    iterator = iter(events)
+    done = object()
+    try:
+        while (event := await asyncio.to_thread(next, iterator, done)) is not done:
+            yield event
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            try:
+                close()
+            except ValueError:
+                # Cancelled while the worker thread is still inside `next`
+                pass
+
+
+_cancel_scopes = threading.local()
+
+
+class CancelScope:
+    """
+    Lets the consumer of a stream that is read on another thread abort it. While the
+    scope is entered on the reading thread, providers register how to close their
+    HTTP responses with `on_cancel`, so cancelling doesn't wait for a blocked read
+    to return.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], Any]] = []
+        self.cancelled = False
+
+    def __enter__(self) -> "CancelScope":
+        _cancel_scopes.current = self
+        return self
+
+    def __exit__(self, *args):
+        _cancel_scopes.current = None
+
+    def add(self, callback: Callable[[], Any]):
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        _call(callback)
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            _call(callback)
+
+
+def _call(callback: Callable[[], Any]):
+    try:
+        callback()
+    except Exception:
+        # The stream is being abandoned, its reader sees the error if it cares
         pass
 
 
+def on_cancel(callback: Callable[[], Any]):
+    """
+    Call `callback`, e.g. a response's `close`, when the consumer cancels the stream
+    being read on this thread. Does nothing outside of a `CancelScope`.
+    """
+    scope = getattr(_cancel_scopes, "current", None)
+    if scope is not None:
+        scope.add(callback)
+
+
 class CompletionError(Exception):
     pass
 
@@ -1,8 +1,14 @@
+import logging
+import queue
+import threading
+from typing import Any, Callable, List, Optional, Sequence
+
+from gptcli.compare import ComparisonResult, CompareStreamer
 from gptcli.completion import Message, ModelOverrides, UsageEvent
+from gptcli.context import ContextTrim
 from gptcli.session import ChatListener, ResponseStreamer
 
-
-from typing import List, Optional
+DEFAULT_LISTENER_QUEUE_SIZE = 1024
 
 
 class CompositeResponseStreamer(ResponseStreamer):
@@ -23,6 +29,28 @@ class CompositeResponseStreamer(ResponseStreamer):
             streamer.__exit__(*args)
 
 
+class CompositeCompareStreamer(CompareStreamer):
+    def __init__(self, streamers: List[CompareStreamer]):
+        self.streamers = streamers
+
+    def __enter__(self):
+        for streamer in self.streamers:
+            streamer.__enter__()
+        return self
+
+    def on_next_token(self, model: str, token: str):
+        for streamer in self.streamers:
+            streamer.on_next_token(model, token)
+
+    def on_model_done(self, result: ComparisonResult):
+        for streamer in self.streamers:
+            streamer.on_model_done(result)
+
+    def __exit__(self, *args):
+        for streamer in self.streamers:
+            streamer.__exit__(*args)
+
+
 class CompositeChatListener(ChatListener):
     def __init__(self, listeners: List[ChatListener]):
         self.listeners = listeners
@@ -39,25 +67,183 @@ class CompositeChatListener(ChatListener):
         for listener in self.listeners:
             listener.on_chat_rerun(success)
 
+    def on_chat_end(self):
+        for listener in self.listeners:
+            listener.on_chat_end()
+
     def on_error(self, e: Exception):
         for listener in self.listeners:
             listener.on_error(e)
 
+    def on_context_trimmed(self, trim: ContextTrim):
+        for listener in self.listeners:
+            listener.on_context_trimmed(trim)
+
+    def on_chat_resumed(self, session_id: int, messages: Sequence[Message]):
+        for listener in self.listeners:
+            listener.on_chat_resumed(session_id, messages)
+
     def response_streamer(self) -> ResponseStreamer:
         return CompositeResponseStreamer(
             [listener.response_streamer() for listener in self.listeners]
         )
 
+    def compare_streamer(self, models: List[str]) -> CompareStreamer:
+        return CompositeCompareStreamer(
+            [listener.compare_streamer(models) for listener in self.listeners]
+        )
+
     def on_chat_message(self, message: Message):
         for listener in self.listeners:
             listener.on_chat_message(message)
 
     def on_chat_response(
         self,
-        messages: List[Message],
+        messages: Sequence[Message],
         response: Message,
         overrides: ModelOverrides,
         usage: Optional[UsageEvent],
     ):
         for listener in self.listeners:
             listener.on_chat_response(messages, response, overrides, usage)
+
+
+class ListenerWorker:
+    """
+    Runs queued listener calls in order on a background thread. The queue is
+    bounded, so a listener that can't keep up eventually slows the producer down
+    instead of growing without limit.
+    """
+
+    def __init__(self, max_queue_size: int = DEFAULT_LISTENER_QUEUE_SIZE):
+        self.logger = logging.getLogger("gptcli-listener")
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn: Callable, *args: Any):
+        if self.closed:
+            fn(*args)
+            return
+        self.queue.put((fn, args))
+
+    def _run(self):
+        while (item := self.queue.get()) is not None:
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                self.logger.exception(e)
+
+    def close(self):
+        """
+        Wait for all queued calls to run and stop the worker.
+        """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+
+
+class ThreadedResponseStreamer(ResponseStreamer):
+    def __init__(self, streamer: ResponseStreamer, worker: ListenerWorker):
+        self.streamer = streamer
+        self.worker = worker
+        # Most listeners only care about the whole message, don't queue a job per
+        # token for them
+        self.streams_tokens = (
+            type(streamer).on_next_token is not ResponseStreamer.on_next_token
+        )
+
+    def __enter__(self):
+        self.worker.submit(self.streamer.__enter__)
+        return self
+
+    def on_next_token(self, token: str):
+        if self.streams_tokens:
+            self.worker.submit(self.streamer.on_next_token, token)
+
+    def __exit__(self, *args):
+        self.worker.submit(self.streamer.__exit__, *args)
+
+
+class ThreadedCompareStreamer(CompareStreamer):
+    def __init__(self, streamer: CompareStreamer, worker: ListenerWorker):
+        self.streamer = streamer
+        self.worker = worker
+        self.streams_tokens = (
+            type(streamer).on_next_token is not CompareStreamer.on_next_token
+        )
+
+    def __enter__(self):
+        self.worker.submit(self.streamer.__enter__)
+        return self
+
+    def on_next_token(self, model: str, token: str):
+        if self.streams_tokens:
+            self.worker.submit(self.streamer.on_next_token, model, token)
+
+    def on_model_done(self, result: ComparisonResult):
+        self.worker.submit(self.streamer.on_model_done, result)
+
+    def __exit__(self, *args):
+        self.worker.submit(self.streamer.__exit__, *args)
+
+
+class ThreadedChatListener(ChatListener):
+    """
+    Hands all events of the wrapped listener to a worker thread, so slow listeners
+    (e.g. logging to a file) don't hold up the on-screen streaming. Events are
+    delivered in order and the queue is drained when the chat ends.
+    """
+
+    def __init__(
+        self, listener: ChatListener, max_queue_size: int = DEFAULT_LISTENER_QUEUE_SIZE
+    ):
+        self.listener = listener
+        self.worker = ListenerWorker(max_queue_size)
+
+    def on_chat_start(self):
+        self.worker.submit(self.listener.on_chat_start)
+
+    def on_chat_clear(self):
+        self.worker.submit(self.listener.on_chat_clear)
+
+    def on_chat_rerun(self, success: bool):
+        self.worker.submit(self.listener.on_chat_rerun, success)
+
+    def on_chat_end(self):
+        self.worker.submit(self.listener.on_chat_end)
+        self.worker.close()
+
+    def on_error(self, e: Exception):
+        self.worker.submit(self.listener.on_error, e)
+
+    def on_context_trimmed(self, trim: ContextTrim):
+        self.worker.submit(self.listener.on_context_trimmed, trim)
+
+    def on_chat_resumed(self, session_id: int, messages: Sequence[Message]):
+        self.worker.submit(self.listener.on_chat_resumed, session_id, messages)
+
+    def response_streamer(self) -> ResponseStreamer:
+        return ThreadedResponseStreamer(self.listener.response_streamer(), self.worker)
+
+    def compare_streamer(self, models: List[str]) -> CompareStreamer:
+        return ThreadedCompareStreamer(
+            self.listener.compare_streamer(models), self.worker
+        )
+
+    def on_chat_message(self, message: Message):
+        self.worker.submit(self.listener.on_chat_message, message)
+
+    def on_chat_response(
+        self,
+        messages: Sequence[Message],
+        response: Message,
+        overrides: ModelOverrides,
+        usage: Optional[UsageEvent],
+    ):
+        self.worker.submit(
+            self.listener.on_chat_response, messages, response, overrides, usage
+        )
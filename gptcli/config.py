@@ -1,11 +1,15 @@
 import os
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional
 from attr import dataclass
 import yaml
 
 from gptcli.assistant import AssistantConfig
 from gptcli.providers.llama import LLaMAModelConfig
 
+if TYPE_CHECKING:
+    from gptcli.cache import ResponseCacheConfig
+    from gptcli.similarity import SimilarityCacheConfig
+
 
 CONFIG_FILE_PATHS = [
     os.path.join(os.path.expanduser("~"), ".config", "gpt-cli", "gpt.yml"),
@@ -18,6 +22,16 @@ class GptCliConfig:
     default_assistant: str = "general"
     markdown: bool = True
     show_price: bool = True
+    max_fps: float = 30
+    async_logging: bool = True
+    # Where conversations are saved for --resume, None disables saving them
+    sessions_db: Optional[str] = os.path.join(
+        os.path.expanduser("~"), ".config", "gpt-cli", "sessions.db"
+    )
+    # Serve repeated deterministic requests from disk, None disables the cache
+    response_cache: "Optional[ResponseCacheConfig]" = None
+    # Serve requests nearly identical to an earlier one from disk, None disables it
+    similarity_cache: "Optional[SimilarityCacheConfig]" = None
     api_key: Optional[str] = os.environ.get("OPENAI_API_KEY")
     openai_api_key: Optional[str] = os.environ.get("OPENAI_API_KEY")
     openai_base_url: Optional[str] = os.environ.get("OPENAI_BASE_URL")
@@ -29,6 +43,14 @@ class GptCliConfig:
     assistants: Dict[str, AssistantConfig] = {}
     interactive: Optional[bool] = None
     llama_models: Optional[Dict[str, LLaMAModelConfig]] = None
+    # Least recently used LLaMA models are unloaded to keep the loaded ones within
+    # this many GB, None keeps every model that was used loaded
+    llama_ram_budget_gb: Optional[float] = None
+    # Load the default assistant's LLaMA model in the background at startup
+    llama_preload: bool = False
+    http_pool_size: int = 10
+    http_keepalive_expiry: float = 60.0
+    http2: bool = False
 
 
 def choose_config_file(paths: List[str]) -> str:
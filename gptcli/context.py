@@ -0,0 +1,179 @@
+import logging
+from typing import (
+    TYPE_CHECKING,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Tuple,
+    TypedDict,
+)
+
+from attr import dataclass
+
+from gptcli.completion import Message
+from gptcli.tokens import (
+    TOKENS_PER_REPLY,
+    count_message_tokens,
+    get_encoding,
+    max_message_tokens,
+)
+
+if TYPE_CHECKING:
+    from gptcli.tokens import TokenCounter
+
+logger = logging.getLogger("gptcli-context")
+
+# Model name prefix -> context window in tokens. The longest matching prefix wins.
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4-1106": 128000,
+    "gpt-4-0125": 128000,
+    "gpt-4o": 128000,
+    "chatgpt-4o": 128000,
+    "o1": 128000,
+    "claude-2": 100000,
+    "claude-3": 200000,
+    "gemini-1.0-pro": 30720,
+    "gemini-pro": 30720,
+    "gemini-1.5": 1048576,
+    "command": 4096,
+    "command-r": 128000,
+    "c4ai-aya": 8192,
+}
+
+# Tokens left free for the response
+DEFAULT_RESERVE_TOKENS = 1024
+
+# How much of each message a collapsed turn keeps
+COLLAPSED_MESSAGE_CHARS = 200
+
+TrimPolicy = Literal["drop", "collapse", "off"]
+
+
+class ContextConfig(TypedDict, total=False):
+    # "drop" removes the oldest turns, "collapse" replaces them with a short excerpt
+    policy: TrimPolicy
+    # Tokens left free for the response
+    reserve: int
+    # Overrides the model's context window, e.g. for fine-tuned or local models
+    limit: int
+
+
+@dataclass
+class ContextTrim:
+    model: str
+    limit: int
+    tokens_before: int
+    tokens_after: int
+    dropped_messages: int
+    collapsed: bool
+
+
+def context_window(model: str) -> Optional[int]:
+    prefixes = [prefix for prefix in CONTEXT_WINDOWS if model.startswith(prefix)]
+    if not prefixes:
+        return None
+    return CONTEXT_WINDOWS[max(prefixes, key=len)]
+
+
+def collapse_messages(messages: Sequence[Message]) -> List[Message]:
+    excerpts = []
+    for message in messages:
+        content = message["content"]
+        if len(content) > COLLAPSED_MESSAGE_CHARS:
+            content = content[:COLLAPSED_MESSAGE_CHARS] + "..."
+        excerpts.append(f"{message['role']}: {content}")
+    return [
+        {
+            "role": "user",
+            "content": "Excerpts of our earlier conversation, which was shortened to fit "
+            "the context window:\n\n" + "\n\n".join(excerpts),
+        },
+        {"role": "assistant", "content": "Understood."},
+    ]
+
+
+def fit_to_context(
+    messages: Sequence[Message],
+    model: str,
+    num_pinned: int,
+    config: ContextConfig,
+    counter: "Optional[TokenCounter]" = None,
+) -> Tuple[Sequence[Message], Optional[ContextTrim]]:
+    """
+    Drop (or collapse) the oldest turns after the first `num_pinned` messages until
+    the prompt fits the model's context window. System messages and the latest
+    turn are always kept.
+
+    The messages are only tokenized when their byte length doesn't already fit.
+    `counter`, the conversation's TokenCounter, saves tokenizing them again. When
+    the tokenizer can't be loaded, the messages are sent untrimmed.
+    """
+    policy = config.get("policy", "drop")
+    limit = config.get("limit") or context_window(model)
+    if policy == "off" or limit is None:
+        return messages, None
+
+    budget = limit - config.get("reserve", DEFAULT_RESERVE_TOKENS)
+    if sum(max_message_tokens(m) for m in messages) + TOKENS_PER_REPLY <= budget:
+        return messages, None
+
+    try:
+        encoding = get_encoding(model)
+        if counter is not None and (counter.model, len(counter)) == (
+            model,
+            len(messages),
+        ):
+            counts = counter.counts()
+        else:
+            counts = [count_message_tokens(message, encoding) for message in messages]
+    except Exception as e:
+        # e.g. tiktoken failing to download its encoding offline
+        logger.warning("Cannot count the tokens of %s, not trimming: %s", model, e)
+        return messages, None
+    total = sum(counts) + TOKENS_PER_REPLY
+    if total <= budget:
+        return messages, None
+
+    # A turn starts at a user message, the latest one is never dropped
+    cuts = [
+        i for i in range(num_pinned + 1, len(messages)) if messages[i]["role"] == "user"
+    ]
+    if not cuts:
+        return messages, None
+
+    suffix = [0] * (len(messages) + 1)
+    for i in range(len(messages) - 1, -1, -1):
+        suffix[i] = suffix[i + 1] + counts[i]
+    head_tokens = sum(counts[:num_pinned]) + TOKENS_PER_REPLY
+
+    for cut in cuts:
+        middle = [m for m in messages[num_pinned:cut] if m["role"] == "system"]
+        dropped = [m for m in messages[num_pinned:cut] if m["role"] != "system"]
+        if policy == "collapse":
+            middle += collapse_messages(dropped)
+        trimmed = list(messages[:num_pinned]) + middle + list(messages[cut:])
+        tokens = (
+            head_tokens
+            + sum(count_message_tokens(message, encoding) for message in middle)
+            + suffix[cut]
+        )
+        if tokens <= budget:
+            break
+    else:
+        logger.warning(
+            "The latest turn alone exceeds the %d token budget of %s", budget, model
+        )
+
+    return trimmed, ContextTrim(
+        model=model,
+        limit=limit,
+        tokens_before=total,
+        tokens_after=tokens,
+        dropped_messages=len(dropped),
+        collapsed=policy == "collapse",
+    )
@@ -5,7 +5,7 @@ from gptcli.session import ChatListener
 from rich.console import Console
 
 import logging
-from typing import List, Optional
+from typing import Optional, Sequence
 
 
 class PriceChatListener(ChatListener):
@@ -20,7 +20,7 @@ class PriceChatListener(ChatListener):
 
     def on_chat_response(
         self,
-        messages: List[Message],
+        messages: Sequence[Message],
         response: Message,
         args: ModelOverrides,
         usage: Optional[UsageEvent] = None,
@@ -0,0 +1,277 @@
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from gptcli.completion import MessageDeltaEvent, UsageEvent
+
+DEFAULT_SOCKET_PATH = os.path.join(
+    os.path.expanduser("~"), ".config", "gpt-cli", "daemon.sock"
+)
+
+logger = logging.getLogger("gptcli-daemon")
+
+
+def socket_path() -> str:
+    return os.environ.get("GPT_CLI_DAEMON_SOCKET", DEFAULT_SOCKET_PATH)
+
+
+def encode_event(event: Any) -> bytes:
+    if isinstance(event, MessageDeltaEvent):
+        payload = {"type": event.type, "text": event.text}
+    elif isinstance(event, UsageEvent):
+        payload = {
+            "type": event.type,
+            "prompt_tokens": event.prompt_tokens,
+            "completion_tokens": event.completion_tokens,
+            "total_tokens": event.total_tokens,
+            "cost": event.cost,
+        }
+    else:
+        payload = event
+    return (json.dumps(payload) + "\n").encode("utf-8")
+
+
+def decode_event(line: bytes) -> Dict[str, Any]:
+    return json.loads(line.decode("utf-8"))
+
+
+def _prompts(argv: List[str]) -> List[str]:
+    """
+    The values of all -p/--prompt options, in any of the forms argparse accepts.
+    """
+    prompts = []
+    for i, arg in enumerate(argv):
+        if arg in ("-p", "--prompt"):
+            if i + 1 < len(argv):
+                prompts.append(argv[i + 1])
+        elif arg.startswith("--prompt="):
+            prompts.append(arg[len("--prompt=") :])
+        elif arg.startswith("-p"):
+            prompts.append(arg[len("-p") :])
+    return prompts
+
+
+def _wants_daemon(argv: List[str]) -> bool:
+    if "--no_daemon" in argv or "--daemon" in argv:
+        return False
+    if any(arg == "--compare" or arg.startswith("--compare=") for arg in argv):
+        # Comparisons render a rich layout, which only the client can draw
+        return False
+    return bool(_prompts(argv))
+
+
+def run_via_daemon(argv: List[str], path: Optional[str] = None) -> bool:
+    """
+    Forward a one-shot `--prompt` invocation to a running daemon and stream the
+    response to stdout. Returns False if the request should run in-process
+    instead, either because no daemon is listening or the daemon declined it.
+    """
+    if not _wants_daemon(argv):
+        return False
+
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return False
+
+    stdin = "".join(sys.stdin.readlines()) if "-" in _prompts(argv) else None
+
+    with sock, sock.makefile("rb") as reader:
+        sock.sendall(
+            (json.dumps({"argv": argv, "stdin": stdin}) + "\n").encode("utf-8")
+        )
+        try:
+            for line in reader:
+                event = decode_event(line)
+                if event["type"] == "message_delta":
+                    sys.stdout.write(event["text"])
+                    sys.stdout.flush()
+                elif event["type"] == "error":
+                    # Like the in-process CLI, which prints errors to stdout
+                    print(event["message"])
+                    sys.exit(1)
+                elif event["type"] == "fallback":
+                    if stdin is not None:
+                        # The prompt was already consumed, let the in-process path
+                        # re-read it
+                        sys.stdin = io.StringIO(stdin)
+                    return False
+                elif event["type"] == "done":
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sys.stdout.flush()
+
+    return True
+
+
+class InvalidArguments(Exception):
+    pass
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    server: "DaemonServer"
+
+    def send(self, event: Any):
+        self.wfile.write(encode_event(event))
+        self.wfile.flush()
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        request = json.loads(line.decode("utf-8"))
+        try:
+            args = self.server.parse_request(request["argv"])
+        except InvalidArguments as e:
+            self.send({"type": "error", "message": str(e)})
+            return
+        if args is None:
+            self.send({"type": "fallback"})
+            return
+
+        prompt = list(args.prompt)
+        if "-" in prompt:
+            if request.get("stdin") is None:
+                # The client didn't recognize the option, e.g. an abbreviated one,
+                # and left stdin unread
+                self.send({"type": "fallback"})
+                return
+            prompt[prompt.index("-")] = request["stdin"]
+
+        events = self.server.complete(args, "\n".join(prompt))
+        try:
+            for event in events:
+                self.send(event)
+            self.send({"type": "done"})
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away (e.g. Ctrl-C)
+            logger.info("Client disconnected")
+        except Exception as e:
+            logger.exception(e)
+            self.send({"type": "error", "message": f"Error: {type(e)}: {e}"})
+        finally:
+            # Closes the provider stream as well
+            events.close()
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        path: str,
+        parse_args: Callable[[List[str]], Any],
+        init_assistant: Callable[[Any], Any],
+        validate_args: Callable[[Any], Optional[str]] = lambda args: None,
+    ):
+        self._parse_args = parse_args
+        self._init_assistant = init_assistant
+        self._validate_args = validate_args
+        self.assistants: Dict[Tuple, Any] = {}
+        super().__init__(path, DaemonRequestHandler)
+
+    def parse_request(self, argv: List[str]) -> Optional[Any]:
+        try:
+            args = self._parse_args(argv)
+        except SystemExit:
+            # Invalid arguments, --help, --version: let the client report them
+            return None
+        error = self._validate_args(args)
+        if error is not None:
+            raise InvalidArguments(error)
+        if (
+            args.prompt is None
+            or args.execute is not None
+            or args.compare is not None
+            or args.daemon
+        ):
+            return None
+        return args
+
+    def get_assistant(self, args) -> Any:
+        key = (
+            args.assistant_name,
+            args.model,
+            args.temperature,
+            args.top_p,
+            getattr(args, "cache", True),
+        )
+        assistant = self.assistants.get(key)
+        if assistant is None:
+            assistant = self.assistants[key] = self._init_assistant(args)
+        return assistant
+
+    def complete(self, args, prompt: str):
+        assistant = self.get_assistant(args)
+        messages = assistant.init_messages()
+        messages.append({"role": "user", "content": prompt})
+        logger.info("User: %s", prompt)
+
+        result = ""
+        events = assistant.complete_chat(messages, stream=not args.no_stream)
+        try:
+            for event in events:
+                if event.type == "message_delta":
+                    result += event.text
+                yield event
+        finally:
+            if hasattr(events, "close"):
+                events.close()
+            logger.info("Assistant: %s", result)
+
+
+def _remove_stale_socket(path: str):
+    if not os.path.exists(path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        print(f"A gpt daemon is already listening on {path}.")
+        sys.exit(1)
+    finally:
+        probe.close()
+
+
+def run_daemon(
+    parse_args: Callable[[List[str]], Any],
+    init_assistant: Callable[[Any], Any],
+    path: Optional[str] = None,
+    validate_args: Callable[[Any], Optional[str]] = lambda args: None,
+):
+    path = path or socket_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _remove_stale_socket(path)
+
+    # Only the user can connect, from the moment the socket exists
+    umask = os.umask(0o177)
+    try:
+        server = DaemonServer(path, parse_args, init_assistant, validate_args)
+    finally:
+        os.umask(umask)
+    logger.info("Daemon listening on %s", path)
+    print(f"gpt daemon listening on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
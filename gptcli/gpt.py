@@ -7,36 +7,26 @@ if sys.version_info < MIN_PYTHON:
     sys.exit("Python %s.%s or later is required.\n" % MIN_PYTHON)
 
 import os
-from typing import cast
-import openai
-import google.generativeai as genai
+from typing import List, Optional, cast
 import argparse
 import sys
 import logging
 import datetime
-import gptcli.providers.anthropic
-import gptcli.providers.cohere
+import gptcli
 from gptcli.assistant import (
-    Assistant,
     DEFAULT_ASSISTANTS,
     AssistantGlobalArgs,
     init_assistant,
 )
-from gptcli.cli import (
-    CLIChatListener,
-    CLIUserInputProvider,
-)
-from gptcli.composite import CompositeChatListener
 from gptcli.config import (
     CONFIG_FILE_PATHS,
     GptCliConfig,
     choose_config_file,
     read_yaml_config,
 )
+from gptcli.daemon import run_daemon, run_via_daemon
+from gptcli.providers import configure_providers
 from gptcli.providers.llama import init_llama_models
-from gptcli.logging import LoggingChatListener
-from gptcli.cost import PriceChatListener
-from gptcli.session import ChatSession
 from gptcli.shell import execute, simple_response
 
 
@@ -54,7 +44,7 @@ def exception_handler(type, value, traceback):
 sys.excepthook = exception_handler
 
 
-def parse_args(config: GptCliConfig):
+def parse_args(config: GptCliConfig, argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser(
         description="Run a chat session with ChatGPT. See https://github.com/kharvd/gpt-cli for more information."
     )
@@ -125,6 +115,71 @@ Implies --no_markdown.",
         help="If specified, passes the prompt to the assistant and allows the user to edit the produced shell command \
 before executing it. Implies --no_stream. Use `-` to read the prompt from standard input.",
     )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        default=None,
+        help="Run every line of the given JSONL file through the assistant and write one JSON result per line. \
+Each line has either a `prompt` string or a `messages` list, an optional `id` and optional `model`, \
+`temperature` and `top_p` overrides. Use `-` to read from standard input.",
+    )
+    parser.add_argument(
+        "--out",
+        type=str,
+        default=None,
+        help="The JSONL file --batch results are appended to (default: standard output). Lines whose id is \
+already answered in this file are skipped, so an interrupted batch can be resumed.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="The maximum number of --batch requests in flight at once.",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="How many times a failed --batch request is retried.",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        metavar="MODELS",
+        help="A comma-separated list of models to send the --prompt to concurrently. The responses are \
+streamed side by side, followed by a table of time to first token, latency, token usage and price per model.",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        nargs="?",
+        const="latest",
+        default=None,
+        metavar="ID",
+        help="Continue a saved conversation, by default the latest one. Use `:sessions` in a chat session \
+to list the saved conversations.",
+    )
+    parser.add_argument(
+        "--sessions_db",
+        type=str,
+        default=config.sessions_db,
+        help="The SQLite database conversations are saved to.",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_false",
+        dest="cache",
+        help="Do not read or write the response caches configured with `response_cache` and \
+`similarity_cache`.",
+        default=True,
+    )
+    parser.add_argument(
+        "--cache_stats",
+        action="store_true",
+        default=False,
+        help="Print the hit rate and size of the response cache and exit.",
+    )
     parser.add_argument(
         "--no_stream",
         action="store_true",
@@ -139,6 +194,34 @@ response in a script. Ignored when the --prompt option is not specified.",
         help="Disable price logging.",
         default=config.show_price,
     )
+    parser.add_argument(
+        "--sync_logging",
+        action="store_false",
+        dest="async_logging",
+        help="Write the session log from the chat thread instead of a background thread.",
+        default=config.async_logging,
+    )
+    parser.add_argument(
+        "--max_fps",
+        type=float,
+        default=config.max_fps,
+        help="The maximum number of times per second the streamed response is redrawn. Tokens arriving in \
+between are coalesced. 0 redraws on every token.",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        default=False,
+        help="Run a background server that keeps the configuration, assistants and API clients warm. \
+Subsequent `--prompt` invocations are forwarded to it over a Unix socket and run in-process if no daemon \
+is running. The socket path can be set with the GPT_CLI_DAEMON_SOCKET environment variable.",
+    )
+    parser.add_argument(
+        "--no_daemon",
+        action="store_true",
+        default=False,
+        help="Do not forward the request to a running daemon.",
+    )
     parser.add_argument(
         "--version",
         "-v",
@@ -147,24 +230,119 @@ response in a script. Ignored when the --prompt option is not specified.",
         help="Print the version number and exit.",
     )
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
+
+
+def parse_search_args(config: GptCliConfig, argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="gpt search",
+        description="Search the saved conversations.",
+    )
+    parser.add_argument(
+        "query",
+        type=str,
+        nargs="+",
+        help="The words to search for. Messages containing all of them are listed, best match first.",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=20,
+        help="The maximum number of messages to list.",
+    )
+    parser.add_argument(
+        "--sessions_db",
+        type=str,
+        default=config.sessions_db,
+        help="The SQLite database conversations are saved to.",
+    )
+    return parser.parse_args(argv)
+
+
+def parse_llama_tune_args(argv: List[str]):
+    from gptcli.llama_tune import DEFAULT_BATCH_SIZES, DEFAULT_GENERATED_TOKENS
+
+    parser = argparse.ArgumentParser(
+        prog="gpt llama-tune",
+        description="Find the fastest thread and batch settings for a LLaMA model on this host. \
+The best settings are saved and used when the model is loaded, unless the config file sets them.",
+    )
+    parser.add_argument(
+        "model",
+        type=str,
+        help="The name of the model in `llama_models`.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=str,
+        default=None,
+        help="A comma-separated list of thread counts to try (default: fractions of the CPU count).",
+    )
+    parser.add_argument(
+        "--batch_sizes",
+        type=str,
+        default=",".join(str(size) for size in DEFAULT_BATCH_SIZES),
+        help="A comma-separated list of batch sizes to try.",
+    )
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        default=DEFAULT_GENERATED_TOKENS,
+        help="The number of tokens generated per run.",
+    )
+    parser.add_argument(
+        "--no_save",
+        action="store_false",
+        dest="save",
+        default=True,
+        help="Print the best settings without saving them.",
+    )
+    return parser.parse_args(argv)
+
+
+def args_error(args) -> Optional[str]:
+    """
+    Why the combination of arguments is invalid, or None when it's valid.
+    """
+    if (
+        sum(option is not None for option in [args.prompt, args.execute, args.batch])
+        > 1
+    ):
+        return "The --prompt, --execute and --batch options are mutually exclusive. Please specify only one of them."
+    if args.resume not in (None, "latest") and not args.resume.isdigit():
+        return "The --resume option takes a session ID."
+    if args.compare is not None and args.prompt is None:
+        return "The --compare option requires --prompt."
+    return None
 
 
 def validate_args(args):
-    if args.prompt is not None and args.execute is not None:
-        print(
-            "The --prompt and --execute options are mutually exclusive. Please specify only one of them."
-        )
+    error = args_error(args)
+    if error is not None:
+        print(error)
         sys.exit(1)
 
 
 def main():
+    # Hand one-shot prompts to a warm daemon before paying for config parsing and imports
+    if run_via_daemon(sys.argv[1:]):
+        return
+
     config_file_path = choose_config_file(CONFIG_FILE_PATHS)
     if config_file_path:
         config = read_yaml_config(config_file_path)
     else:
         config = GptCliConfig()
+
+    if sys.argv[1:2] == ["search"]:
+        run_search(parse_search_args(config, sys.argv[2:]))
+        return
+    if sys.argv[1:2] == ["llama-tune"]:
+        run_llama_tune(config, parse_llama_tune_args(sys.argv[2:]))
+        return
+
     args = parse_args(config)
+    validate_args(args)
 
     if args.log_file is not None:
         filename = datetime.datetime.now().strftime(args.log_file)
@@ -176,34 +354,81 @@ def main():
         # Disable overly verbose logging for markdown_it
         logging.getLogger("markdown_it").setLevel(logging.INFO)
 
-    if config.openai_base_url:
-        openai.base_url = config.openai_base_url
+    # API keys are applied when the provider for the chosen model is first loaded
+    configure_providers(config)
+
+    if args.cache_stats:
+        run_cache_stats(config)
+        return
 
-    if config.api_key:
-        openai.api_key = config.api_key
-    elif config.openai_api_key:
-        openai.api_key = config.openai_api_key
+    cache = None
+    if config.response_cache is not None:
+        from gptcli.cache import ResponseCache
 
-    if config.anthropic_api_key:
-        gptcli.providers.anthropic.api_key = config.anthropic_api_key
+        cache = ResponseCache.from_config(config.response_cache)
+    similarity_cache = None
+    if config.similarity_cache is not None:
+        from gptcli.similarity import SimilarityCache
 
-    if config.cohere_api_key:
-        gptcli.providers.cohere.api_key = config.cohere_api_key
+        similarity_cache = SimilarityCache.from_config(config.similarity_cache)
 
-    if config.google_api_key:
-        genai.configure(api_key=config.google_api_key)
+    def init_cached_assistant(args):
+        assistant = init_assistant(cast(AssistantGlobalArgs, args), config.assistants)
+        if args.cache:
+            assistant.cache = cache
+            assistant.similarity_cache = similarity_cache
+        return assistant
+
+    assistant = init_cached_assistant(args)
 
     if config.llama_models is not None:
-        init_llama_models(config.llama_models)
+        # Preloading starts before the first prompt is typed
+        init_llama_models(
+            config.llama_models,
+            ram_budget_gb=config.llama_ram_budget_gb,
+            preload=assistant._param("model", {}) if config.llama_preload else None,
+        )
 
-    assistant = init_assistant(cast(AssistantGlobalArgs, args), config.assistants)
+    try:
+        if args.daemon:
+            run_daemon(
+                lambda argv: parse_args(config, argv),
+                init_cached_assistant,
+                validate_args=args_error,
+            )
+        elif args.compare is not None:
+            run_compare(args, assistant)
+        elif args.prompt is not None:
+            run_non_interactive(args, assistant)
+        elif args.execute is not None:
+            run_execute(args, assistant)
+        elif args.batch is not None:
+            run_batch_mode(args, assistant)
+        else:
+            run_interactive(args, assistant)
+    finally:
+        # Logs the hit rates of this run
+        if cache is not None:
+            cache.close()
+        if similarity_cache is not None:
+            similarity_cache.close()
+
+
+def run_cache_stats(config: GptCliConfig):
+    from gptcli.cache import ResponseCache
+
+    if config.response_cache is None:
+        print("The response cache is disabled. Enable it with `response_cache` in the config file.")
+        sys.exit(1)
 
-    if args.prompt is not None:
-        run_non_interactive(args, assistant)
-    elif args.execute is not None:
-        run_execute(args, assistant)
-    else:
-        run_interactive(args, assistant)
+    cache = ResponseCache.from_config(config.response_cache)
+    stats = cache.total_stats()
+    cache.close()
+    print(f"Entries:  {stats.entries}")
+    print(f"Size:     {stats.size / 1024 / 1024:.1f} MB")
+    print(f"Hits:     {stats.hits}")
+    print(f"Misses:   {stats.misses}")
+    print(f"Hit rate: {stats.hit_rate:.1%}")
 
 
 def run_execute(args, assistant):
@@ -229,29 +454,143 @@ def run_non_interactive(args, assistant):
     simple_response(assistant, "\n".join(args.prompt), stream=not args.no_stream)
 
 
-class CLIChatSession(ChatSession):
-    def __init__(self, assistant: Assistant, markdown: bool, show_price: bool):
-        listeners = [
-            CLIChatListener(markdown),
-            LoggingChatListener(),
-        ]
+def run_compare(args, assistant):
+    from rich.console import Console
 
-        if show_price:
-            listeners.append(PriceChatListener(assistant))
+    from gptcli.cli import CLICompareStreamer
+    from gptcli.compare import compare_models, parse_models
 
-        listener = CompositeChatListener(listeners)
-        super().__init__(assistant, listener)
+    models = parse_models(args.compare)
+    if len(models) == 0:
+        print("The --compare option requires at least one model.")
+        sys.exit(1)
+
+    logger.info(
+        "Comparing models %s with prompt '%s'. Assistant config: %s",
+        models,
+        args.prompt,
+        assistant.config,
+    )
+    if "-" in args.prompt:
+        args.prompt[args.prompt.index("-")] = "".join(sys.stdin.readlines())
+
+    messages = assistant.init_messages()
+    messages.append({"role": "user", "content": "\n".join(args.prompt)})
+    streamer = CLICompareStreamer(Console(), models, args.markdown)
+    try:
+        compare_models(assistant, messages, models, {}, streamer)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_batch_mode(args, assistant):
+    from gptcli.batch import BatchInputError, run_batch
+
+    logger.info(
+        "Starting a batch session with input '%s'. Assistant config: %s",
+        args.batch,
+        assistant.config,
+    )
+    try:
+        run_batch(assistant, args.batch, args.out, args.concurrency, args.retries)
+    except BatchInputError as e:
+        print(e)
+        sys.exit(1)
+
+
+def run_search(args):
+    from gptcli.store import SearchError, SessionStore
+
+    if args.sessions_db is None:
+        print("Session history is disabled.")
+        sys.exit(1)
+
+    # Highlight the matches only when a terminal will render the escape codes
+    highlight = ("\033[1m", "\033[0m") if sys.stdout.isatty() else ("", "")
+    store = SessionStore(args.sessions_db)
+    try:
+        results = store.search(" ".join(args.query), args.limit, highlight)
+    except SearchError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        store.close()
+
+    for result in results:
+        date = datetime.datetime.fromtimestamp(result.created_at).strftime(
+            "%Y-%m-%d %H:%M"
+        )
+        snippet = " ".join(result.snippet.split())
+        print(f"[session {result.session_id}] {date} {result.role}: {snippet}")
+
+
+def run_llama_tune(config: GptCliConfig, args):
+    from gptcli.llama_tune import save_tuned_settings, thread_candidates, tune
+
+    if not config.llama_models or args.model not in config.llama_models:
+        print(f"LLaMA model {args.model} is not configured in `llama_models`.")
+        sys.exit(1)
+    try:
+        threads = (
+            [int(n) for n in args.threads.split(",")]
+            if args.threads
+            else thread_candidates()
+        )
+        batch_sizes = [int(n) for n in args.batch_sizes.split(",")]
+    except ValueError:
+        print("The --threads and --batch_sizes options take comma-separated numbers.")
+        sys.exit(1)
+
+    init_llama_models({args.model: config.llama_models[args.model]})
+    print(
+        f"{'threads':>8} {'batch threads':>14} {'batch':>6} "
+        f"{'prompt tok/s':>13} {'gen tok/s':>10}"
+    )
+
+    def on_result(result):
+        print(
+            f"{result.n_threads:>8} {result.n_threads_batch:>14} {result.n_batch:>6} "
+            f"{result.prompt_eval:>13.1f} {result.generation:>10.1f}",
+            flush=True,
+        )
+
+    best = tune(
+        config.llama_models[args.model],
+        threads,
+        batch_sizes,
+        args.tokens,
+        on_result=on_result,
+    )
+    print(
+        f"Best: n_threads={best.n_threads} n_threads_batch={best.n_threads_batch} "
+        f"n_batch={best.n_batch}"
+    )
+    if args.save:
+        save_tuned_settings(args.model, best)
+        print("Saved. The settings are used whenever the model is loaded on this host.")
 
 
 def run_interactive(args, assistant):
+    # The interactive UI pulls in rich and prompt_toolkit, which one-shot runs don't need
+    from gptcli.cli import CLIChatSession, CLIUserInputProvider
+
     logger.info("Starting a new chat session. Assistant config: %s", assistant.config)
     session = CLIChatSession(
-        assistant=assistant, markdown=args.markdown, show_price=args.show_price
+        assistant=assistant,
+        markdown=args.markdown,
+        show_price=args.show_price,
+        max_fps=args.max_fps,
+        async_logging=args.async_logging,
+        sessions_db=args.sessions_db,
     )
     history_filename = os.path.expanduser("~/.config/gpt-cli/history")
     os.makedirs(os.path.dirname(history_filename), exist_ok=True)
     input_provider = CLIUserInputProvider(history_filename=history_filename)
-    session.loop(input_provider)
+    if args.resume is None:
+        session.loop(input_provider)
+    else:
+        session_id = None if args.resume == "latest" else int(args.resume)
+        session.loop(input_provider, resume=True, session_id=session_id)
 
 
 if __name__ == "__main__":
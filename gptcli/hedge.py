@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, TypedDict
+
+from attr import dataclass
+
+from gptcli.completion import CompletionEvent
+
+logger = logging.getLogger("gptcli-hedge")
+
+DEFAULT_HEDGE_DELAY = 2.0
+
+PRIMARY = "primary"
+SECONDARY = "secondary"
+
+
+class HedgeConfig(TypedDict, total=False):
+    # The model the request is also sent to if the primary is slow to respond
+    model: str
+    # Seconds to wait for the primary's first token before starting the secondary
+    delay: float
+
+
+@dataclass
+class HedgeStats:
+    requests: int = 0
+    fired: int = 0
+    primary_wins: int = 0
+    secondary_wins: int = 0
+
+
+_stats_lock = threading.Lock()
+
+
+def _record(stats: HedgeStats, fired: bool, winner: Optional[str]):
+    with _stats_lock:
+        stats.requests += 1
+        if fired:
+            stats.fired += 1
+        if winner == PRIMARY:
+            stats.primary_wins += 1
+        elif winner == SECONDARY:
+            stats.secondary_wins += 1
+        logger.info("Hedge stats: %s", stats)
+
+
+_DONE = object()
+
+
+async def hedged_complete(
+    primary: Callable[[], AsyncIterator[CompletionEvent]],
+    secondary: Callable[[], AsyncIterator[CompletionEvent]],
+    delay: float,
+    stats: HedgeStats,
+) -> AsyncIterator[CompletionEvent]:
+    """
+    Stream from `primary`, and also from `secondary` if the primary hasn't produced
+    any text after `delay` seconds (or failed). Whichever side produces text first
+    wins and the other one is cancelled, which closes its HTTP stream. Providers
+    that only implement the blocking `complete` finish their current read in a
+    worker thread before the stream is closed.
+    """
+    import asyncio
+
+    queue: asyncio.Queue = asyncio.Queue()
+    tasks: Dict[str, asyncio.Task] = {}
+    # Events (e.g. usage) a side produced before it won
+    buffered: Dict[str, List[CompletionEvent]] = {PRIMARY: [], SECONDARY: []}
+    errors: Dict[str, BaseException] = {}
+    winner: Optional[str] = None
+    started = time.monotonic()
+
+    async def pump(side: str, events: AsyncIterator[CompletionEvent]):
+        try:
+            async for event in events:
+                await queue.put((side, event))
+            await queue.put((side, _DONE))
+        except Exception as e:
+            await queue.put((side, e))
+        finally:
+            aclose = getattr(events, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def start(side: str, factory: Callable[[], AsyncIterator[CompletionEvent]]):
+        tasks[side] = asyncio.create_task(pump(side, factory()))
+
+    async def cancel(side: str):
+        task = tasks.get(side)
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    start(PRIMARY, primary)
+    try:
+        while True:
+            timeout = None
+            if SECONDARY not in tasks:
+                timeout = max(delay - (time.monotonic() - started), 0)
+            try:
+                side, event = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                logger.info(
+                    "No response from the primary model after %.1fs, starting the secondary",
+                    delay,
+                )
+                start(SECONDARY, secondary)
+                continue
+
+            if winner is not None and side != winner:
+                continue
+
+            if isinstance(event, Exception):
+                if winner is not None:
+                    raise event
+                errors[side] = event
+                if SECONDARY not in tasks:
+                    logger.info("The primary model failed, starting the secondary")
+                    start(SECONDARY, secondary)
+                elif len(errors) == len(tasks):
+                    # Both sides failed, report the primary's error
+                    raise errors[PRIMARY]
+                continue
+
+            if event is _DONE:
+                if winner is None:
+                    # Finished without any text, e.g. an empty response
+                    winner = side
+                    for buffered_event in buffered[side]:
+                        yield buffered_event
+                return
+
+            if winner is None:
+                if event.type != "message_delta":
+                    buffered[side].append(event)
+                    continue
+                winner = side
+                logger.info(
+                    "The %s model responded first after %.2fs",
+                    side,
+                    time.monotonic() - started,
+                )
+                await cancel(SECONDARY if side == PRIMARY else PRIMARY)
+                for buffered_event in buffered[side]:
+                    yield buffered_event
+            yield event
+    finally:
+        for side in list(tasks):
+            await cancel(side)
+        _record(stats, SECONDARY in tasks, winner)
@@ -0,0 +1,175 @@
+import json
+import os
+import socket
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from attr import dataclass
+
+from gptcli.providers.llama import LLaMAModelConfig, load_llama
+
+TUNED_SETTINGS_PATH = os.path.join(
+    os.path.expanduser("~"), ".config", "gpt-cli", "llama-tune.json"
+)
+
+DEFAULT_BATCH_SIZES = [128, 256, 512, 1024]
+DEFAULT_GENERATED_TOKENS = 64
+
+# About 500 tokens with the common tokenizers
+TUNE_PROMPT = (
+    "The quick brown fox jumps over the lazy dog while the five boxing wizards "
+    "jump quickly. Pack my box with five dozen liquor jugs, then explain how a "
+    "compiler turns source code into machine instructions, step by step. "
+) * 12
+
+
+@dataclass
+class TuneResult:
+    n_threads: int
+    n_threads_batch: int
+    n_batch: int
+    # Tokens per second
+    prompt_eval: float
+    generation: float
+
+
+def _host() -> str:
+    return socket.gethostname()
+
+
+def _read(path: str) -> Dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def tuned_settings(model: str, path: str = TUNED_SETTINGS_PATH) -> Dict[str, int]:
+    """
+    The settings `gpt llama-tune` saved for the model on this host.
+    """
+    settings = _read(path).get(_host(), {}).get(model, {})
+    return {
+        key: settings[key]
+        for key in ("n_threads", "n_threads_batch", "n_batch")
+        if key in settings
+    }
+
+
+def save_tuned_settings(
+    model: str, result: TuneResult, path: str = TUNED_SETTINGS_PATH
+):
+    data = _read(path)
+    data.setdefault(_host(), {})[model] = {
+        "n_threads": result.n_threads,
+        "n_threads_batch": result.n_threads_batch,
+        "n_batch": result.n_batch,
+        "prompt_eval_tokens_per_second": round(result.prompt_eval, 1),
+        "generation_tokens_per_second": round(result.generation, 1),
+        "tuned_at": time.time(),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def thread_candidates(cpu_count: Optional[int] = None) -> List[int]:
+    """
+    Thread counts worth trying: fractions of the logical CPUs, which include the
+    physical core count on hosts with two threads per core.
+    """
+    cpus = cpu_count or os.cpu_count() or 1
+    return sorted({max(1, cpus // 8), max(1, cpus // 4), max(1, cpus // 2), cpus})
+
+
+def measure_speed(llm: Any, prompt: str, tokens: int) -> Dict[str, float]:
+    """
+    Prompt evaluation and generation speed of one completion, in tokens per
+    second. The first token arrives once the whole prompt was evaluated.
+    """
+    prompt_tokens = len(llm.tokenize(prompt.encode("utf-8")))
+    started = time.perf_counter()
+    first_token = None
+    generated = 0
+    for _ in llm.create_completion(
+        prompt, max_tokens=tokens, temperature=0.0, stream=True
+    ):
+        if first_token is None:
+            first_token = time.perf_counter()
+        generated += 1
+    finished = time.perf_counter()
+
+    assert first_token is not None
+    return {
+        "prompt_eval": prompt_tokens / max(first_token - started, 1e-9),
+        "generation": (generated - 1) / max(finished - first_token, 1e-9),
+    }
+
+
+def tune(
+    model_config: LLaMAModelConfig,
+    threads: Sequence[int],
+    batch_sizes: Sequence[int],
+    tokens: int = DEFAULT_GENERATED_TOKENS,
+    loader: Callable[[LLaMAModelConfig], Any] = load_llama,
+    measure: Callable[[Any, str, int], Dict[str, float]] = measure_speed,
+    on_result: Callable[[TuneResult], None] = lambda result: None,
+) -> TuneResult:
+    """
+    Find the fastest settings in two sweeps. Generation speed depends on
+    n_threads and prompt evaluation on n_threads_batch and n_batch, so the
+    thread counts are swept first and the batch sizes with the best of them.
+    """
+
+    def run(n_threads: int, n_threads_batch: int, n_batch: int) -> TuneResult:
+        config = {
+            **model_config,
+            "n_threads": n_threads,
+            "n_threads_batch": n_threads_batch,
+            "n_batch": n_batch,
+            # Every run has to evaluate the whole prompt
+            "prompt_cache_mb": 0,
+        }
+        llm = loader(config)
+        try:
+            speed = measure(llm, TUNE_PROMPT, tokens)
+        finally:
+            close = getattr(llm, "close", None)
+            if close is not None:
+                close()
+        result = TuneResult(
+            n_threads=n_threads,
+            n_threads_batch=n_threads_batch,
+            n_batch=n_batch,
+            prompt_eval=speed["prompt_eval"],
+            generation=speed["generation"],
+        )
+        on_result(result)
+        return result
+
+    default_batch = model_config.get("n_batch", 512)
+    results = [run(n, n, default_batch) for n in threads]
+    n_threads = max(results, key=lambda result: result.generation).n_threads
+    n_threads_batch = max(results, key=lambda result: result.prompt_eval).n_threads
+
+    results += [
+        run(n_threads, n_threads_batch, n_batch)
+        for n_batch in batch_sizes
+        if n_batch != default_batch or n_threads != n_threads_batch
+    ]
+    best_prompt_eval = max(
+        (r for r in results if r.n_threads_batch == n_threads_batch),
+        key=lambda result: result.prompt_eval,
+    )
+    best_generation = max(
+        (r for r in results if r.n_threads == n_threads),
+        key=lambda result: result.generation,
+    )
+    return TuneResult(
+        n_threads=n_threads,
+        n_threads_batch=n_threads_batch,
+        n_batch=best_prompt_eval.n_batch,
+        prompt_eval=best_prompt_eval.prompt_eval,
+        generation=best_generation.generation,
+    )
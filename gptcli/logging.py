@@ -1,5 +1,8 @@
 import logging
+from typing import Sequence
+
 from gptcli.completion import Message
+from gptcli.context import ContextTrim
 from gptcli.session import ChatListener
 
 
@@ -20,5 +23,14 @@ class LoggingChatListener(ChatListener):
     def on_error(self, e: Exception):
         self.logger.exception(e)
 
+    def on_context_trimmed(self, trim: ContextTrim):
+        self.logger.info(
+            f"Trimmed {trim.dropped_messages} messages to fit the context of {trim.model}: "
+            f"{trim.tokens_before} -> {trim.tokens_after} tokens"
+        )
+
+    def on_chat_resumed(self, session_id: int, messages: Sequence[Message]):
+        self.logger.info(f"Resumed session {session_id} with {len(messages)} messages.")
+
     def on_chat_message(self, message: Message):
         self.logger.info(f"{message['role']}: {message['content']}")
@@ -0,0 +1,87 @@
+from typing import List, Optional
+
+
+def _fence_marker(line: str) -> Optional[str]:
+    stripped = line.lstrip(" ")
+    if len(line) - len(stripped) > 3:
+        return None
+    for char in ("`", "~"):
+        if stripped.startswith(char * 3):
+            return char * (len(stripped) - len(stripped.lstrip(char)))
+    return None
+
+
+class MarkdownBlockSplitter:
+    """
+    Splits streamed Markdown text into completed top-level blocks (paragraphs,
+    fenced code, lists, ...) and the trailing block that is still being written.
+
+    Only newly completed lines are scanned on each `feed`, so the cost per token is
+    bounded by the size of the pending block rather than the whole response.
+    """
+
+    def __init__(self):
+        self.pending = ""
+        # Start of the first line in `pending` that hasn't been scanned yet
+        self._scan_pos = 0
+        # Fence (e.g. "```") of the code block that is currently open
+        self._fence: Optional[str] = None
+        # End of the last blank line, if the block may end there
+        self._boundary: Optional[int] = None
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Add streamed text and return the blocks that were completed by it.
+        """
+        self.pending += text
+        blocks = []
+
+        while (newline := self.pending.find("\n", self._scan_pos)) != -1:
+            line = self.pending[self._scan_pos : newline]
+            line_end = newline + 1
+
+            if self._fence is not None:
+                if line.strip().startswith(self._fence) and line.strip(
+                    self._fence[0] + " \t"
+                ) == "":
+                    self._fence = None
+                    blocks.append(self._split(line_end))
+                    continue
+            elif line.strip() == "":
+                if self.pending[:line_end].strip() != "":
+                    self._boundary = line_end
+            else:
+                # A blank line only ends the block if the next line isn't indented,
+                # otherwise it may continue a list item or an indented code block
+                if self._boundary is not None and not line[0].isspace():
+                    blocks.append(self._split(self._boundary))
+                    continue
+                self._boundary = None
+                self._fence = _fence_marker(line)
+
+            self._scan_pos = line_end
+
+        # The block also ends as soon as an unindented line starts after a blank line
+        if (
+            self._boundary is not None
+            and self._scan_pos < len(self.pending)
+            and not self.pending[self._scan_pos].isspace()
+        ):
+            blocks.append(self._split(self._boundary))
+
+        return blocks
+
+    def flush(self) -> str:
+        """
+        Return the pending text and reset the splitter.
+        """
+        pending = self.pending
+        self.__init__()
+        return pending
+
+    def _split(self, pos: int) -> str:
+        block = self.pending[:pos]
+        self.pending = self.pending[pos:]
+        self._scan_pos = 0
+        self._boundary = None
+        return block
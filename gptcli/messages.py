@@ -0,0 +1,108 @@
+import itertools
+import weakref
+from typing import Iterable, Iterator, List, Optional, Sequence, Union, overload
+
+from gptcli.completion import Message
+
+
+class MessageSnapshot(Sequence[Message]):
+    """
+    An immutable view of the first `length` messages of a MessageLog. Taking a
+    snapshot doesn't copy the messages.
+    """
+
+    __slots__ = ("_messages", "_length", "_parent", "__weakref__")
+
+    def __init__(
+        self,
+        messages: List[Message],
+        length: int,
+        parent: Optional["MessageSnapshot"] = None,
+    ):
+        self._messages = messages
+        self._length = length
+        # Keeps the snapshot the log knows about alive as long as this prefix is
+        self._parent = parent
+
+    def __len__(self) -> int:
+        return self._length
+
+    @overload
+    def __getitem__(self, index: int) -> Message:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> Sequence[Message]:
+        ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Message, Sequence[Message]]:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if start == 0 and step == 1:
+                # Prefixes, e.g. all but the last message, are snapshots as well
+                parent = self if self._parent is None else self._parent
+                return MessageSnapshot(self._messages, stop, parent)
+            return self._messages[: self._length][index]
+
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("message index out of range")
+        return self._messages[index]
+
+    def __iter__(self) -> Iterator[Message]:
+        for i in range(self._length):
+            yield self._messages[i]
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, (list, tuple, MessageSnapshot)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+class MessageLog:
+    """
+    The messages of a conversation, with O(1) append, truncation and snapshots.
+
+    Snapshots share the log's storage. Messages are only ever appended to it,
+    and truncating below a snapshot that is still referenced moves the log to
+    new storage instead of overwriting messages the snapshot refers to.
+    """
+
+    def __init__(self, messages: Iterable[Message] = ()):
+        self._messages: List[Message] = list(messages)
+        self._ids = itertools.count()
+        # The snapshots of the current storage that are still referenced
+        self._snapshots: "weakref.WeakValueDictionary[int, MessageSnapshot]" = (
+            weakref.WeakValueDictionary()
+        )
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __getitem__(self, index: int) -> Message:
+        return self._messages[index]
+
+    def __iter__(self) -> Iterator[Message]:
+        return iter(self._messages)
+
+    def append(self, message: Message):
+        self._messages.append(message)
+
+    def truncate(self, length: int):
+        """
+        Drop all messages after the first `length`.
+        """
+        if any(len(snapshot) > length for snapshot in self._snapshots.values()):
+            self._messages = self._messages[:length]
+            self._snapshots = weakref.WeakValueDictionary()
+        else:
+            del self._messages[length:]
+
+    def snapshot(self) -> MessageSnapshot:
+        snapshot = MessageSnapshot(self._messages, len(self._messages))
+        self._snapshots[next(self._ids)] = snapshot
+        return snapshot
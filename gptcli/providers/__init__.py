@@ -0,0 +1,147 @@
+import importlib
+import threading
+from types import ModuleType
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, TypeVar
+
+
+class ProviderSpec(NamedTuple):
+    prefixes: Tuple[str, ...]
+    module: str
+    class_name: str
+
+
+# Model name prefix -> provider module. Modules are only imported when a model
+# with a matching prefix is first used, so the SDKs of unused providers are never
+# loaded.
+PROVIDERS: List[ProviderSpec] = [
+    ProviderSpec(
+        ("gpt", "ft:gpt", "oai-compat:", "chatgpt", "o1"),
+        "gptcli.providers.openai",
+        "OpenAICompletionProvider",
+    ),
+    ProviderSpec(("claude",), "gptcli.providers.anthropic", "AnthropicCompletionProvider"),
+    ProviderSpec(("llama",), "gptcli.providers.llama", "LLaMACompletionProvider"),
+    ProviderSpec(("command", "c4ai"), "gptcli.providers.cohere", "CohereCompletionProvider"),
+    ProviderSpec(("dol",), "gptcli.providers.dolphin", "DolphinCompletionProvider"),
+    ProviderSpec(("gemini",), "gptcli.providers.google", "GoogleCompletionProvider"),
+]
+
+DEFAULT_HTTP_POOL_SIZE = 10
+DEFAULT_HTTP_KEEPALIVE_EXPIRY = 60.0
+
+_provider_config: Optional[Any] = None
+_loaded_modules: Dict[str, ModuleType] = {}
+
+ClientKey = Tuple[str, Optional[str], Optional[str], Any]
+_clients: Dict[ClientKey, Any] = {}
+_clients_lock = threading.Lock()
+
+T = TypeVar("T")
+
+
+def configure_providers(config: Any):
+    """
+    Remember the CLI config so that provider modules can pick up their API keys
+    when they are first loaded. Modules that are already loaded are reconfigured.
+    """
+    global _provider_config
+    _provider_config = config
+    for module in _loaded_modules.values():
+        _configure_module(module)
+
+
+def _configure_module(module: ModuleType):
+    configure = getattr(module, "configure", None)
+    if configure is not None and _provider_config is not None:
+        configure(_provider_config)
+
+
+def find_provider_spec(model: str) -> Optional[ProviderSpec]:
+    for spec in PROVIDERS:
+        if model.startswith(spec.prefixes):
+            return spec
+    return None
+
+
+def load_provider_module(spec: ProviderSpec) -> ModuleType:
+    module = _loaded_modules.get(spec.module)
+    if module is None:
+        module = importlib.import_module(spec.module)
+        _configure_module(module)
+        _loaded_modules[spec.module] = module
+    return module
+
+
+def get_provider_class(model: str) -> type:
+    spec = find_provider_spec(model)
+    if spec is None:
+        raise ValueError(f"Unknown model: {model}")
+    return getattr(load_provider_module(spec), spec.class_name)
+
+
+def get_client(
+    provider: str,
+    api_key: Optional[str],
+    base_url: Optional[str],
+    factory: Callable[[], T],
+    scope: Any = None,
+) -> T:
+    """
+    Return the process-wide API client for (provider, api key, base URL), creating
+    it with `factory` on first use. Reusing clients keeps their connection pools,
+    so consecutive requests skip DNS, TCP and TLS setup.
+
+    Async clients are bound to an event loop and should pass it as `scope`. The
+    CLI runs them on `gptcli.completion.event_loop`, which lives as long as the
+    process; clients of event loops that have since been closed are dropped.
+    """
+    key = (provider, api_key, base_url, scope)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            for stale in [k for k in _clients if _is_closed_loop(k[3])]:
+                del _clients[stale]
+            client = _clients[key] = factory()
+    return client
+
+
+def _is_closed_loop(scope: Any) -> bool:
+    is_closed = getattr(scope, "is_closed", None)
+    return is_closed is not None and is_closed()
+
+
+def clear_clients():
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        close = getattr(client, "close", None)
+        result = close() if close is not None else None
+        if hasattr(result, "close"):
+            # Async clients can't be closed outside of their (possibly finished) event loop
+            result.close()
+
+
+def http_pool_options() -> Tuple[int, float, bool]:
+    """
+    Returns (pool size, keepalive expiry in seconds, HTTP/2) from the config.
+    """
+    return (
+        getattr(_provider_config, "http_pool_size", DEFAULT_HTTP_POOL_SIZE),
+        getattr(_provider_config, "http_keepalive_expiry", DEFAULT_HTTP_KEEPALIVE_EXPIRY),
+        getattr(_provider_config, "http2", False),
+    )
+
+
+def httpx_client_kwargs() -> Dict[str, Any]:
+    import httpx
+
+    pool_size, keepalive_expiry, http2 = http_pool_options()
+    return {
+        "limits": httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        "http2": http2,
+    }
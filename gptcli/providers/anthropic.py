@@ -1,5 +1,6 @@
+import asyncio
 import os
-from typing import Iterator, List, Optional
+from typing import AsyncIterator, Iterator, List, Optional
 import anthropic
 
 from gptcli.completion import (
@@ -11,44 +12,82 @@ from gptcli.completion import (
     MessageDeltaEvent,
     Pricing,
     UsageEvent,
+    on_cancel,
 )
+from gptcli.providers import get_client as get_shared_client, httpx_client_kwargs
 
 api_key = os.environ.get("ANTHROPIC_API_KEY")
 
 
+def configure(config):
+    global api_key
+    if config.anthropic_api_key:
+        api_key = config.anthropic_api_key
+
+
 def get_client():
     if not api_key:
         raise ValueError("ANTHROPIC_API_KEY environment variable not set")
 
-    return anthropic.Anthropic(api_key=api_key)
+    return get_shared_client(
+        "anthropic",
+        api_key,
+        None,
+        lambda: anthropic.Anthropic(
+            api_key=api_key,
+            http_client=anthropic.DefaultHttpxClient(**httpx_client_kwargs()),
+        ),
+    )
+
+
+def get_async_client():
+    if not api_key:
+        raise ValueError("ANTHROPIC_API_KEY environment variable not set")
+
+    return get_shared_client(
+        "anthropic-async",
+        api_key,
+        None,
+        lambda: anthropic.AsyncAnthropic(
+            api_key=api_key,
+            http_client=anthropic.DefaultAsyncHttpxClient(**httpx_client_kwargs()),
+        ),
+        scope=asyncio.get_running_loop(),
+    )
+
+
+def make_request_kwargs(messages: List[Message], args: dict) -> dict:
+    kwargs = {
+        "stop_sequences": [anthropic.HUMAN_PROMPT],
+        "max_tokens": 4096,
+        "model": args["model"],
+    }
+
+    if "temperature" in args:
+        kwargs["temperature"] = args["temperature"]
+    if "top_p" in args:
+        kwargs["top_p"] = args["top_p"]
+
+    if len(messages) > 0 and messages[0]["role"] == "system":
+        kwargs["system"] = messages[0]["content"]
+        messages = messages[1:]
+
+    kwargs["messages"] = messages
+    return kwargs
 
 
 class AnthropicCompletionProvider(CompletionProvider):
     def complete(
         self, messages: List[Message], args: dict, stream: bool = False
     ) -> Iterator[CompletionEvent]:
-        kwargs = {
-            "stop_sequences": [anthropic.HUMAN_PROMPT],
-            "max_tokens": 4096,
-            "model": args["model"],
-        }
-
-        if "temperature" in args:
-            kwargs["temperature"] = args["temperature"]
-        if "top_p" in args:
-            kwargs["top_p"] = args["top_p"]
-
-        if len(messages) > 0 and messages[0]["role"] == "system":
-            kwargs["system"] = messages[0]["content"]
-            messages = messages[1:]
-
-        kwargs["messages"] = messages
+        kwargs = make_request_kwargs(messages, args)
 
         client = get_client()
         input_tokens = None
         try:
             if stream:
                 with client.messages.stream(**kwargs) as completion:
+                    on_cancel(completion.close)
                     for event in completion:
                         if event.type == "content_block_delta":
                             yield MessageDeltaEvent(event.delta.text)
@@ -82,6 +121,49 @@ class AnthropicCompletionProvider(CompletionProvider):
         except anthropic.APIError as e:
             raise CompletionError(e.message) from e
 
+    async def acomplete(
+        self, messages: List[Message], args: dict, stream: bool = False
+    ) -> AsyncIterator[CompletionEvent]:
+        kwargs = make_request_kwargs(messages, args)
+
+        client = get_async_client()
+        input_tokens = None
+        try:
+            if stream:
+                async with client.messages.stream(**kwargs) as completion:
+                    async for event in completion:
+                        if event.type == "content_block_delta":
+                            yield MessageDeltaEvent(event.delta.text)
+                        if event.type == "message_start":
+                            input_tokens = event.message.usage.input_tokens
+                        if (
+                            event.type == "message_delta"
+                            and (pricing := claude_pricing(args["model"]))
+                            and input_tokens
+                        ):
+                            yield UsageEvent.with_pricing(
+                                prompt_tokens=input_tokens,
+                                completion_tokens=event.usage.output_tokens,
+                                total_tokens=input_tokens + event.usage.output_tokens,
+                                pricing=pricing,
+                            )
+
+            else:
+                response = await client.messages.create(**kwargs, stream=False)
+                yield MessageDeltaEvent("".join(c.text for c in response.content))
+                if pricing := claude_pricing(args["model"]):
+                    yield UsageEvent.with_pricing(
+                        prompt_tokens=response.usage.input_tokens,
+                        completion_tokens=response.usage.output_tokens,
+                        total_tokens=response.usage.input_tokens
+                        + response.usage.output_tokens,
+                        pricing=pricing,
+                    )
+        except anthropic.BadRequestError as e:
+            raise BadRequestError(e.message) from e
+        except anthropic.APIError as e:
+            raise CompletionError(e.message) from e
+
 
 CLAUDE_PRICE_PER_TOKEN: Pricing = {
     "prompt": 11.02 / 1_000_000,
@@ -1,6 +1,8 @@
+import asyncio
 import os
 import cohere
-from typing import Iterator, List
+import httpx
+from typing import AsyncIterator, Iterator, List, Optional
 
 from gptcli.completion import (
     CompletionEvent,
@@ -12,9 +14,17 @@ from gptcli.completion import (
     Pricing,
     UsageEvent,
 )
+from gptcli.providers import get_client, httpx_client_kwargs
 
 api_key = os.environ.get("COHERE_API_KEY")
 
+
+def configure(config):
+    global api_key
+    if config.cohere_api_key:
+        api_key = config.cohere_api_key
+
+
 ROLE_MAP = {
     "system": "SYSTEM",
     "user": "USER",
@@ -35,86 +45,81 @@ def map_message(message: Message) -> cohere.Message:
 
 class CohereCompletionProvider(CompletionProvider):
     def __init__(self):
-        self.client = cohere.Client(api_key=api_key)
+        self.client = get_client(
+            "cohere",
+            api_key,
+            None,
+            lambda: cohere.Client(
+                api_key=api_key, httpx_client=httpx.Client(**httpx_client_kwargs())
+            ),
+        )
 
     def complete(
         self, messages: List[Message], args: dict, stream: bool = False
     ) -> Iterator[CompletionEvent]:
-        kwargs = {}
-        if "temperature" in args:
-            kwargs["temperature"] = args["temperature"]
-        if "top_p" in args:
-            kwargs["p"] = args["top_p"]
+        kwargs = make_chat_kwargs(messages, args)
 
-        model = args["model"]
+        try:
+            if stream:
+                response_iter = self.client.chat_stream(**kwargs)
 
-        if messages[0]["role"] == "system":
-            kwargs["preamble"] = messages[0]["content"]
-            messages = messages[1:]
+                for response in response_iter:
+                    if response.event_type == "text-generation":
+                        yield MessageDeltaEvent(response.text)
 
-        message = messages[-1]
-        assert message["role"] == "user", "Last message must be user message"
+                    if response.event_type == "stream-end" and (
+                        usage := usage_event(response.response.meta, args["model"])
+                    ):
+                        yield usage
 
-        chat_history = [map_message(m) for m in messages[:-1]]
+            else:
+                response = self.client.chat(**kwargs)
+                yield MessageDeltaEvent(response.text)
+
+                if usage := usage_event(response.meta, args["model"]):
+                    yield usage
+
+        except cohere.BadRequestError as e:
+            raise BadRequestError(e.body) from e
+        except (
+            cohere.TooManyRequestsError,
+            cohere.InternalServerError,
+            cohere.core.api_error.ApiError,  # type: ignore
+        ) as e:
+            raise CompletionError(e.body) from e
+
+    async def acomplete(
+        self, messages: List[Message], args: dict, stream: bool = False
+    ) -> AsyncIterator[CompletionEvent]:
+        kwargs = make_chat_kwargs(messages, args)
+        client = get_client(
+            "cohere-async",
+            api_key,
+            None,
+            lambda: cohere.AsyncClient(
+                api_key=api_key,
+                httpx_client=httpx.AsyncClient(**httpx_client_kwargs()),
+            ),
+            scope=asyncio.get_running_loop(),
+        )
 
         try:
             if stream:
-                response_iter = self.client.chat_stream(
-                    chat_history=chat_history,
-                    message=message["content"],
-                    model=model,
-                    **kwargs,
-                )
-
-                for response in response_iter:
+                async for response in client.chat_stream(**kwargs):
                     if response.event_type == "text-generation":
                         yield MessageDeltaEvent(response.text)
 
-                    if (
-                        response.event_type == "stream-end"
-                        and response.response.meta
-                        and response.response.meta.tokens
-                        and (pricing := COHERE_PRICING.get(args["model"]))
+                    if response.event_type == "stream-end" and (
+                        usage := usage_event(response.response.meta, args["model"])
                     ):
-                        input_tokens = int(
-                            response.response.meta.tokens.input_tokens or 0
-                        )
-                        output_tokens = int(
-                            response.response.meta.tokens.output_tokens or 0
-                        )
-                        total_tokens = input_tokens + output_tokens
-
-                        yield UsageEvent.with_pricing(
-                            prompt_tokens=input_tokens,
-                            completion_tokens=output_tokens,
-                            total_tokens=total_tokens,
-                            pricing=pricing,
-                        )
+                        yield usage
 
             else:
-                response = self.client.chat(
-                    chat_history=chat_history,
-                    message=message["content"],
-                    model=model,
-                    **kwargs,
-                )
+                response = await client.chat(**kwargs)
                 yield MessageDeltaEvent(response.text)
 
-                if (
-                    response.meta
-                    and response.meta.tokens
-                    and (pricing := COHERE_PRICING.get(args["model"]))
-                ):
-                    input_tokens = int(response.meta.tokens.input_tokens or 0)
-                    output_tokens = int(response.meta.tokens.output_tokens or 0)
-                    total_tokens = input_tokens + output_tokens
-
-                    yield UsageEvent.with_pricing(
-                        prompt_tokens=input_tokens,
-                        completion_tokens=output_tokens,
-                        total_tokens=total_tokens,
-                        pricing=pricing,
-                    )
+                if usage := usage_event(response.meta, args["model"]):
+                    yield usage
 
         except cohere.BadRequestError as e:
             raise BadRequestError(e.body) from e
@@ -126,6 +131,40 @@ class CohereCompletionProvider(CompletionProvider):
             raise CompletionError(e.body) from e
 
 
+def make_chat_kwargs(messages: List[Message], args: dict) -> dict:
+    kwargs = {}
+    if "temperature" in args:
+        kwargs["temperature"] = args["temperature"]
+    if "top_p" in args:
+        kwargs["p"] = args["top_p"]
+
+    if messages[0]["role"] == "system":
+        kwargs["preamble"] = messages[0]["content"]
+        messages = messages[1:]
+
+    message = messages[-1]
+    assert message["role"] == "user", "Last message must be user message"
+
+    kwargs["chat_history"] = [map_message(m) for m in messages[:-1]]
+    kwargs["message"] = message["content"]
+    kwargs["model"] = args["model"]
+    return kwargs
+
+
+def usage_event(meta, model: str) -> Optional[UsageEvent]:
+    if not (meta and meta.tokens and (pricing := COHERE_PRICING.get(model))):
+        return None
+
+    input_tokens = int(meta.tokens.input_tokens or 0)
+    output_tokens = int(meta.tokens.output_tokens or 0)
+    return UsageEvent.with_pricing(
+        prompt_tokens=input_tokens,
+        completion_tokens=output_tokens,
+        total_tokens=input_tokens + output_tokens,
+        pricing=pricing,
+    )
+
+
 COHERE_PRICING: dict[str, Pricing] = {
     "command-r": {
         "prompt": 0.5 / 1_000_000,
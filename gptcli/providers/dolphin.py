@@ -1,7 +1,25 @@
+import asyncio
+import codecs
+import hashlib
+import json
 import os
 import sys
-from typing import Dict, Iterator, List, Optional, TypedDict, cast
+import threading
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, Iterator, List, Optional, TypedDict, cast
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+
+from gptcli.completion import (
+    CompletionError,
+    CompletionEvent,
+    CompletionProvider,
+    MessageDeltaEvent,
+    on_cancel,
+)
+from gptcli.providers import get_client, http_pool_options, httpx_client_kwargs
 
 class DolphinModelConfig(TypedDict):
     path: str
@@ -32,46 +50,190 @@ def make_prompt(messages: List[dict], model_config: DolphinModelConfig) -> str:
     prompt += f"\n{model_config['assistant_prompt']}"
     return prompt
 
-class DolphinCompletionProvider():
+def get_session(service_url: str) -> requests.Session:
+    def make_session() -> requests.Session:
+        pool_size, _, _ = http_pool_options()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    return get_client("dolphin", None, service_url, make_session)
+
+def get_service_url(model: str) -> str:
+    gpu = "dfa" in model
+
+    if (gpu):
+        #SERVICE_URL = "https://cave.keychaotic.com:6102"
+        SERVICE_URL = "https://cave.keychaotic.com:6102"
+    else:
+        SERVICE_URL = "https://cave.keychaotic.com:6102"
+        #SERVICE_URL = "http://192.168.1.85:6101"
+    return SERVICE_URL
+
+def error_message(status_code: int, body: str) -> str:
+    if status_code == 429:
+        return "The llama host is busy, try again later."
+    return f"The llama host returned status {status_code}: {body}"
+
+def message_checksum(checksum: str, message: dict) -> str:
+    """
+    The checksum of a message history, chained from the checksum of the history
+    before the message. Has to match llamahost's.
+    """
+    data = json.dumps([checksum, message["role"], message["content"]], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def prefix_checksums(messages: List[dict]) -> List[str]:
+    checksums = [""]
+    for message in messages:
+        checksums.append(message_checksum(checksums[-1], message))
+    return checksums
+
+class ConversationRef(TypedDict):
+    conversation_id: str
+    prefix_length: int
+    prefix_checksum: str
+
+class Conversations:
+    """
+    The llama host keeps the conversations it completed, so the next turn only
+    sends the new messages. This remembers the conversation ID for the checksum
+    of each completed history, most recently used last.
+    """
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self.lock = threading.Lock()
+        self.ids: "OrderedDict[tuple, str]" = OrderedDict()
+
+    def find(self, service_url: str, messages: List[dict]) -> ConversationRef:
+        checksums = prefix_checksums(messages)
+        with self.lock:
+            for length in range(len(messages) - 1, 0, -1):
+                conversation_id = self.ids.get((service_url, checksums[length]))
+                if conversation_id is not None:
+                    return ConversationRef(
+                        conversation_id=conversation_id,
+                        prefix_length=length,
+                        prefix_checksum=checksums[length],
+                    )
+        return new_conversation()
+
+    def remember(self, service_url: str, messages: List[dict], reply: str, conversation_id: str):
+        history = [*messages, {"role": "assistant", "content": reply}]
+        key = (service_url, prefix_checksums(history)[-1])
+        with self.lock:
+            self.ids[key] = conversation_id
+            self.ids.move_to_end(key)
+            while len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+
+
+CONVERSATIONS = Conversations()
+
+def new_conversation() -> ConversationRef:
+    return ConversationRef(conversation_id=uuid.uuid4().hex, prefix_length=0, prefix_checksum="")
+
+def make_payload(
+    messages: List[dict], args: dict, stream: bool, conversation: ConversationRef
+) -> dict:
+    payload = {
+        **conversation,
+        "messages": messages[conversation["prefix_length"] :],
+        "stream": stream,
+    }
+    if "temperature" in args:
+        payload["temperature"] = args["temperature"]
+    if "top_p" in args:
+        payload["top_p"] = args["top_p"]
+    return payload
+
+class DolphinCompletionProvider(CompletionProvider):
 
     def complete(
         self, messages: List[dict], args: dict, stream: bool = False
-    ) -> Iterator[str]:
-        model_config: Optional[Dict[str, DolphinModelConfig]] = {
-            "path": "/home/juan/dolphin-2.7-mixtral-8x7b.Q4_K_M.gguf",
-            "human_prompt": "Human",
-            "assistant_prompt": "Assistant",
-        }
-
-        gpu = "dfa" in args["model"]
-
-        if (gpu):
-            #SERVICE_URL = "https://cave.keychaotic.com:6102"
-            SERVICE_URL = "https://cave.keychaotic.com:6102"
-        else:
-            SERVICE_URL = "https://cave.keychaotic.com:6102"
-            #SERVICE_URL = "http://192.168.1.85:6101"
-
-        prompt = make_prompt(messages, model_config)
-        #print(model_config)
-
-        payload = {
-            "messages": messages,
-            "stream": stream,
-        }
-        if "temperature" in args:
-            payload["temperature"] = args["temperature"]
-        if "top_p" in args:
-            payload["top_p"] = args["top_p"]
+    ) -> Iterator[CompletionEvent]:
+        SERVICE_URL = get_service_url(args["model"])
+        session = get_session(SERVICE_URL)
+        conversation = CONVERSATIONS.find(SERVICE_URL, messages)
+
+        def post(conversation: ConversationRef) -> requests.Response:
+            payload = make_payload(messages, args, stream, conversation)
+            return session.post(SERVICE_URL + "/complete", json=payload, stream=stream)#, verify=False)
 
         #print("attempting " + SERVICE_URL + "/complete")
-        response = requests.post(SERVICE_URL + "/complete", json=payload, stream=stream)#, verify=False)
+        response = post(conversation)
+        if response.status_code == 409:
+            # The host evicted the conversation or has a different history for it
+            response.close()
+            conversation = new_conversation()
+            response = post(conversation)
+        on_cancel(response.close)
         #response = requests.post(SERVICE_URL + "/complete", json=payload, stream=stream)
         #response = requests.get('https://cave.keychaotic.com:6102/complete', verify=False)
 
-        if stream:
-            for chunk in response.iter_content(chunk_size=None):
-                yield chunk.decode("utf-8")
-        else:
-            completion = response.json()["completion"]
-            yield completion
+        # Closing the response returns the connection to the session's pool, also
+        # when the caller stops iterating early
+        with response:
+            if response.status_code != 200:
+                raise CompletionError(error_message(response.status_code, response.text))
+            reply = ""
+            if stream:
+                # A multi-byte character can be split across chunks
+                decoder = codecs.getincrementaldecoder("utf-8")()
+                for chunk in response.iter_content(chunk_size=None):
+                    if text := decoder.decode(chunk):
+                        reply += text
+                        yield MessageDeltaEvent(text)
+                if text := decoder.decode(b"", final=True):
+                    reply += text
+                    yield MessageDeltaEvent(text)
+            else:
+                reply = response.json()["completion"]
+                yield MessageDeltaEvent(reply)
+
+        # Hosts without conversation support don't answer with the ID
+        if response.headers.get("X-Conversation-Id") == conversation["conversation_id"]:
+            CONVERSATIONS.remember(SERVICE_URL, messages, reply, conversation["conversation_id"])
+
+    async def acomplete(
+        self, messages: List[dict], args: dict, stream: bool = False
+    ) -> AsyncIterator[CompletionEvent]:
+        service_url = get_service_url(args["model"])
+        client = get_client(
+            "dolphin-async",
+            None,
+            service_url,
+            lambda: httpx.AsyncClient(timeout=None, **httpx_client_kwargs()),
+            scope=asyncio.get_running_loop(),
+        )
+        conversation = CONVERSATIONS.find(service_url, messages)
+
+        for attempt in range(2):
+            payload = make_payload(messages, args, stream, conversation)
+            async with client.stream("POST", service_url + "/complete", json=payload) as response:
+                if response.status_code == 409 and attempt == 0:
+                    # The host evicted the conversation or has a different history for it
+                    conversation = new_conversation()
+                    continue
+                if response.status_code != 200:
+                    await response.aread()
+                    raise CompletionError(error_message(response.status_code, response.text))
+                reply = ""
+                if stream:
+                    # aiter_text decodes incrementally, so multi-byte characters split
+                    # across chunks are handled
+                    async for text in response.aiter_text():
+                        reply += text
+                        yield MessageDeltaEvent(text)
+                else:
+                    await response.aread()
+                    reply = response.json()["completion"]
+                    yield MessageDeltaEvent(reply)
+
+            # Hosts without conversation support don't answer with the ID
+            if response.headers.get("X-Conversation-Id") == conversation["conversation_id"]:
+                CONVERSATIONS.remember(service_url, messages, reply, conversation["conversation_id"])
+            return
@@ -5,7 +5,7 @@ from google.generativeai.types.safety_types import (
     HarmBlockThreshold,
     HarmCategory,
 )
-from typing import Iterator, List, Optional
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
 
 from gptcli.completion import (
     CompletionEvent,
@@ -16,6 +16,12 @@ from gptcli.completion import (
     UsageEvent,
 )
 
+
+def configure(config):
+    if config.google_api_key:
+        genai.configure(api_key=config.google_api_key)
+
+
 ROLE_MAP = {
     "user": "user",
     "assistant": "model",
@@ -37,26 +43,32 @@ SAFETY_SETTINGS = [
 ]
 
 
+def make_request(
+    messages: List[Message], args: dict
+) -> Tuple[genai.GenerativeModel, List[ContentDict], GenerationConfig]:
+    generation_config = GenerationConfig(
+        temperature=args.get("temperature"),
+        top_p=args.get("top_p"),
+    )
+
+    if messages[0]["role"] == "system":
+        system_instruction = "suckit"# messages[0]["content"]
+        messages = messages[1:]
+    else:
+        system_instruction = "-"
+
+    chat_history = [map_message(m) for m in messages]
+
+    model = genai.GenerativeModel(args["model"], system_instruction=system_instruction)
+    return model, chat_history, generation_config
+
+
 class GoogleCompletionProvider(CompletionProvider):
     def complete(
         self, messages: List[Message], args: dict, stream: bool = False
     ) -> Iterator[CompletionEvent]:
-        generation_config = GenerationConfig(
-            temperature=args.get("temperature"),
-            top_p=args.get("top_p"),
-        )
-
         model_name = args["model"]
-
-        if messages[0]["role"] == "system":
-            system_instruction = "suckit"# messages[0]["content"]
-            messages = messages[1:]
-        else:
-            system_instruction = "-"
-
-        chat_history = [map_message(m) for m in messages]
-
-        model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+        model, chat_history, generation_config = make_request(messages, args)
 
         if stream:
             response = model.generate_content(
@@ -77,17 +89,44 @@ class GoogleCompletionProvider(CompletionProvider):
             )
             yield MessageDeltaEvent(response.text)
 
-        prompt_tokens = response.usage_metadata.prompt_token_count
-        completion_tokens = response.usage_metadata.candidates_token_count
-        total_tokens = prompt_tokens + completion_tokens
-        pricing = get_gemini_pricing(model_name, prompt_tokens)
-        if pricing:
-            yield UsageEvent.with_pricing(
-                prompt_tokens=prompt_tokens,
-                completion_tokens=completion_tokens,
-                total_tokens=total_tokens,
-                pricing=pricing,
-            )
+        if usage := usage_event(response, model_name):
+            yield usage
+
+    async def acomplete(
+        self, messages: List[Message], args: dict, stream: bool = False
+    ) -> AsyncIterator[CompletionEvent]:
+        model_name = args["model"]
+        model, chat_history, generation_config = make_request(messages, args)
+
+        response = await model.generate_content_async(
+            chat_history,
+            generation_config=generation_config,
+            safety_settings=SAFETY_SETTINGS,
+            stream=stream,
+        )
+        if stream:
+            async for chunk in response:
+                yield MessageDeltaEvent(chunk.text)
+        else:
+            yield MessageDeltaEvent(response.text)
+
+        if usage := usage_event(response, model_name):
+            yield usage
+
+
+def usage_event(response, model_name: str) -> Optional[UsageEvent]:
+    prompt_tokens = response.usage_metadata.prompt_token_count
+    completion_tokens = response.usage_metadata.candidates_token_count
+    total_tokens = prompt_tokens + completion_tokens
+    pricing = get_gemini_pricing(model_name, prompt_tokens)
+    if not pricing:
+        return None
+    return UsageEvent.with_pricing(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=total_tokens,
+        pricing=pricing,
+    )
 
 
 def get_gemini_pricing(model: str, prompt_tokens: int) -> Optional[Pricing]:
@@ -1,13 +1,27 @@
+import importlib.util
+import logging
 import os
 import sys
-from typing import Iterator, List, Optional, TypedDict, cast
+import threading
+from collections import OrderedDict
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Iterator,
+    List,
+    Optional,
+    TypedDict,
+    cast,
+)
+
+from attr import dataclass
 
-try:
+if TYPE_CHECKING:
     from llama_cpp import Completion, CompletionChunk, Llama
 
-    LLAMA_AVAILABLE = True
-except ImportError:
-    LLAMA_AVAILABLE = False
+# llama_cpp is imported on first completion; importing it at startup is slow
+LLAMA_AVAILABLE = importlib.util.find_spec("llama_cpp") is not None
 
 from gptcli.completion import (
     CompletionEvent,
@@ -17,16 +31,203 @@ from gptcli.completion import (
 )
 
 
-class LLaMAModelConfig(TypedDict):
+class _LLaMAModelConfig(TypedDict):
     path: str
     human_prompt: str
     assistant_prompt: str
 
 
+class LLaMAModelConfig(_LLaMAModelConfig, total=False):
+    # Memory for saved KV states of earlier prompts, 0 disables saving them
+    prompt_cache_mb: int
+    # The maximum number of tokens in a response
+    max_tokens: int
+    # Passed to llama_cpp.Llama, see its documentation. Thread and batch settings
+    # default to the ones saved by `gpt llama-tune`, if any
+    n_ctx: int
+    n_threads: int
+    n_threads_batch: int
+    n_batch: int
+    use_mmap: bool
+    use_mlock: bool
+    rope_freq_base: float
+    rope_freq_scale: float
+
+
+# The LLaMAModelConfig keys passed to llama_cpp.Llama and their defaults
+LLAMA_PARAMS = {
+    "n_ctx": 2048,
+    "n_threads": None,
+    "n_threads_batch": None,
+    "n_batch": 512,
+    "use_mmap": True,
+    "use_mlock": True,
+    "rope_freq_base": 0.0,
+    "rope_freq_scale": 0.0,
+}
+DEFAULT_MAX_TOKENS = 1024
+
 LLAMA_MODELS: Optional[dict[str, LLaMAModelConfig]] = None
 
+# Enough for the KV states of a few long conversations with a 7B model
+DEFAULT_PROMPT_CACHE_MB = 1024
+
+logger = logging.getLogger("gptcli-llama")
+
+
+def llama_params(model_config: LLaMAModelConfig) -> dict:
+    params = {
+        key: model_config.get(key, default) for key, default in LLAMA_PARAMS.items()
+    }
+    # None leaves the choice to llama_cpp
+    return {key: value for key, value in params.items() if value is not None}
+
+
+def load_llama(model_config: LLaMAModelConfig) -> "Llama":
+    from llama_cpp import Llama, LlamaRAMCache
+
+    with suppress_stderr():
+        llm = Llama(
+            model_path=model_config["path"],
+            verbose=False,
+            **llama_params(model_config),
+        )
+
+    # llama_cpp only evaluates the tokens after the longest prefix the prompt has
+    # in common with the tokens already in the context. The cache saves the state
+    # after each completion and restores the one sharing the longest prefix with
+    # the next prompt, so interleaved conversations don't evaluate their history
+    # again either.
+    cache_mb = model_config.get("prompt_cache_mb", DEFAULT_PROMPT_CACHE_MB)
+    if cache_mb > 0:
+        llm.set_cache(LlamaRAMCache(capacity_bytes=cache_mb * 2**20))
+    return llm
+
+
+def model_size(model_config: LLaMAModelConfig) -> int:
+    """
+    The memory a loaded model is expected to take: its weights and prompt cache.
+    """
+    cache_mb = model_config.get("prompt_cache_mb", DEFAULT_PROMPT_CACHE_MB)
+    return os.path.getsize(model_config["path"]) + cache_mb * 2**20
+
+
+@dataclass
+class LoadedModel:
+    llm: Any
+    # Estimated resident size in bytes, see model_size
+    size: int
+    # A Llama instance runs one completion at a time
+    lock: threading.Lock
+
+
+class LLaMAModelManager:
+    """
+    Keeps loaded models in memory across completions. When loading a model would
+    exceed the RAM budget, the least recently used models are unloaded first.
+    """
+
+    def __init__(
+        self,
+        ram_budget: Optional[int] = None,
+        loader: Callable[[LLaMAModelConfig], Any] = load_llama,
+    ):
+        self.ram_budget = ram_budget
+        self.loader = loader
+        self._models: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Held while a model loads, so concurrent requests for it wait for one load
+        self._loading: dict[str, threading.Lock] = {}
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._models)
 
-def init_llama_models(models: dict[str, LLaMAModelConfig]):
+    def get(self, name: str, model_config: LLaMAModelConfig) -> LoadedModel:
+        with self._lock:
+            model = self._models.get(name)
+            if model is not None:
+                self._models.move_to_end(name)
+                return model
+            loading = self._loading.setdefault(name, threading.Lock())
+
+        with loading:
+            with self._lock:
+                model = self._models.get(name)
+                if model is not None:
+                    self._models.move_to_end(name)
+                    return model
+
+            size = model_size(model_config)
+            self._make_room(size)
+            logger.info("Loading LLaMA model %s from %s", name, model_config["path"])
+            model = LoadedModel(
+                llm=self.loader(model_config), size=size, lock=threading.Lock()
+            )
+            with self._lock:
+                self._models[name] = model
+            return model
+
+    def _make_room(self, size: int):
+        if self.ram_budget is None:
+            return
+        while True:
+            with self._lock:
+                used = sum(model.size for model in self._models.values())
+                if used + size <= self.ram_budget or not self._models:
+                    break
+                name = next(iter(self._models))
+            logger.info("Unloading LLaMA model %s to stay within the RAM budget", name)
+            self.unload(name)
+        if size > self.ram_budget:
+            logger.warning(
+                "The LLaMA model needs %d MB, more than the %d MB RAM budget",
+                size // 2**20,
+                self.ram_budget // 2**20,
+            )
+
+    def preload(self, name: str, model_config: LLaMAModelConfig) -> threading.Thread:
+        """
+        Load a model on a background thread, so it is ready by the first prompt.
+        """
+
+        def load():
+            try:
+                self.get(name, model_config)
+            except Exception:
+                logger.exception("Failed to preload LLaMA model %s", name)
+
+        thread = threading.Thread(
+            target=load, name=f"llama-preload-{name}", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def unload(self, name: str) -> bool:
+        with self._lock:
+            model = self._models.pop(name, None)
+        if model is None:
+            return False
+        # Wait for a running completion, the generator keeps its own reference
+        with model.lock:
+            close = getattr(model.llm, "close", None)
+            if close is not None:
+                close()
+        return True
+
+    def unload_all(self):
+        for name in self.loaded():
+            self.unload(name)
+
+
+LLAMA_MANAGER = LLaMAModelManager()
+
+
+def init_llama_models(
+    models: dict[str, LLaMAModelConfig],
+    ram_budget_gb: Optional[float] = None,
+    preload: Optional[str] = None,
+):
     if not LLAMA_AVAILABLE:
         print(
             "Error: To use llama, you need to install gpt-command-line with the llama optional dependency: \
@@ -42,8 +243,20 @@ pip install gpt-command-line[llama]."
             print(f"LLaMA model names must start with `llama`, but got `{name}`.")
             sys.exit(1)
 
+    from gptcli.llama_tune import tuned_settings
+
     global LLAMA_MODELS
-    LLAMA_MODELS = models
+    # Settings in the config take precedence over the tuned ones
+    LLAMA_MODELS = {
+        name: cast(LLaMAModelConfig, {**tuned_settings(name), **model_config})
+        for name, model_config in models.items()
+    }
+    models = LLAMA_MODELS
+
+    if ram_budget_gb is not None:
+        LLAMA_MANAGER.ram_budget = int(ram_budget_gb * 2**30)
+    if preload is not None and preload in models:
+        LLAMA_MANAGER.preload(preload, models[preload])
 
 
 def role_to_name(role: str, model_config: LLaMAModelConfig) -> str:
@@ -73,14 +286,7 @@ class LLaMACompletionProvider(CompletionProvider):
         assert LLAMA_MODELS, "LLaMA models not initialized"
 
         model_config = LLAMA_MODELS[args["model"]]
-
-        with suppress_stderr():
-            llm = Llama(
-                model_path=model_config["path"],
-                n_ctx=2048,
-                verbose=False,
-                use_mlock=True,
-            )
+        model = LLAMA_MANAGER.get(args["model"], model_config)
         prompt = make_prompt(messages, model_config)
         print(prompt)
 
@@ -90,19 +296,20 @@ class LLaMACompletionProvider(CompletionProvider):
         if "top_p" in args:
             extra_args["top_p"] = args["top_p"]
 
-        gen = llm.create_completion(
-            prompt,
-            max_tokens=1024,
-            stop=model_config["human_prompt"],
-            stream=stream,
-            echo=False,
-            **extra_args,
-        )
-        if stream:
-            for x in cast(Iterator[CompletionChunk], gen):
-                yield MessageDeltaEvent(x["choices"][0]["text"])
-        else:
-            yield MessageDeltaEvent(cast(Completion, gen)["choices"][0]["text"])
+        with model.lock:
+            gen = model.llm.create_completion(
+                prompt,
+                max_tokens=model_config.get("max_tokens", DEFAULT_MAX_TOKENS),
+                stop=model_config["human_prompt"],
+                stream=stream,
+                echo=False,
+                **extra_args,
+            )
+            if stream:
+                for x in cast(Iterator["CompletionChunk"], gen):
+                    yield MessageDeltaEvent(x["choices"][0]["text"])
+            else:
+                yield MessageDeltaEvent(cast("Completion", gen)["choices"][0]["text"])
 
 
 # https://stackoverflow.com/a/50438156
@@ -1,20 +1,130 @@
-from typing import Iterator, List, cast
+import asyncio
+from typing import AsyncIterator, Iterator, List, Optional, Set, Tuple, cast
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from openai.types.chat import ChatCompletionMessageParam
 
-import tiktoken
 import json
 
-from gptcli.completion import CompletionProvider, Message
+from gptcli.completion import (
+    BadRequestError,
+    CompletionError,
+    CompletionEvent,
+    CompletionProvider,
+    Message,
+    MessageDeltaEvent,
+    Pricing,
+    UsageEvent,
+    on_cancel,
+)
+from gptcli.providers import get_client, httpx_client_kwargs
+from gptcli.tokens import count_messages_tokens
+
+
+def configure(config):
+    if config.openai_base_url:
+        openai.base_url = config.openai_base_url
+
+    if config.api_key:
+        openai.api_key = config.api_key
+    elif config.openai_api_key:
+        openai.api_key = config.openai_api_key
 
 
 class OpenAICompletionProvider(CompletionProvider):
     def __init__(self):
-        self.client = OpenAI(api_key=openai.api_key)
+        api_key, base_url = openai.api_key, openai.base_url
+        self.client = get_client(
+            "openai",
+            api_key,
+            base_url,
+            lambda: OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=openai.DefaultHttpxClient(**httpx_client_kwargs()),
+            ),
+        )
 
     def complete(
         self, messages: List[Message], args: dict, stream: bool = False, tools = []
+    ) -> Iterator[str]:
+        try:
+            yield from self._complete(messages, args, stream, tools)
+        except openai.BadRequestError as e:
+            raise BadRequestError(e.message) from e
+        except openai.APIError as e:
+            raise CompletionError(e.message) from e
+
+    async def acomplete(
+        self, messages: List[Message], args: dict, stream: bool = False
+    ) -> AsyncIterator[CompletionEvent]:
+        api_key, base_url = openai.api_key, openai.base_url
+        client = get_client(
+            "openai-async",
+            api_key,
+            base_url,
+            lambda: AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=openai.DefaultAsyncHttpxClient(**httpx_client_kwargs()),
+            ),
+            scope=asyncio.get_running_loop(),
+        )
+
+        kwargs = {}
+        if "temperature" in args:
+            kwargs["temperature"] = args["temperature"]
+        if "top_p" in args:
+            kwargs["top_p"] = args["top_p"]
+
+        try:
+            if stream:
+                create = client.chat.completions.create
+                request = dict(
+                    messages=cast(List[ChatCompletionMessageParam], messages),
+                    stream=True,
+                    model=args["model"],
+                    **kwargs,
+                )
+                options = stream_options(args["model"], client.base_url)
+                try:
+                    response_iter = await create(**request, **options)
+                except openai.BadRequestError:
+                    if not can_drop_stream_options(args["model"], options):
+                        raise
+                    _no_stream_options.add(str(client.base_url))
+                    response_iter = await create(**request)
+                try:
+                    async for response in response_iter:
+                        # The usage comes in a last chunk without choices
+                        if usage := usage_event(response.usage, args["model"]):
+                            yield usage
+                        if not response.choices:
+                            continue
+                        next_choice = response.choices[0]
+                        if next_choice.delta.content:
+                            yield MessageDeltaEvent(next_choice.delta.content)
+                finally:
+                    await response_iter.close()
+            else:
+                response = await client.chat.completions.create(
+                    messages=cast(List[ChatCompletionMessageParam], messages),
+                    model=args["model"],
+                    stream=False,
+                    **kwargs,
+                )
+                next_choice = response.choices[0]
+                if next_choice.message.content:
+                    yield MessageDeltaEvent(next_choice.message.content)
+                if usage := usage_event(response.usage, args["model"]):
+                    yield usage
+        except openai.BadRequestError as e:
+            raise BadRequestError(e.message) from e
+        except openai.APIError as e:
+            raise CompletionError(e.message) from e
+
+    def _complete(
+        self, messages: List[Message], args: dict, stream: bool = False, tools = []
     ) -> Iterator[str]:
         kwargs = {}
         if "temperature" in args:
@@ -42,6 +152,7 @@ class OpenAICompletionProvider(CompletionProvider):
                 tools=tools,
                 **kwargs,
             )
+            on_cancel(response_iter.close)
 
             #for response in response_iter:
             #    next_choice = response.choices[0]
@@ -86,17 +197,33 @@ class OpenAICompletionProvider(CompletionProvider):
             
                                     
         elif stream and len(tools) == 0:
-            response_iter = self.client.chat.completions.create(
+            create = self.client.chat.completions.create
+            request = dict(
                 messages=cast(List[ChatCompletionMessageParam], messages),
                 stream=True,
                 model=args["model"],
                 **kwargs,
             )
+            options = stream_options(args["model"], self.client.base_url)
+            try:
+                response_iter = create(**request, **options)
+            except openai.BadRequestError:
+                if not can_drop_stream_options(args["model"], options):
+                    raise
+                _no_stream_options.add(str(self.client.base_url))
+                response_iter = create(**request)
+            on_cancel(response_iter.close)
 
-            for response in response_iter:
-                next_choice = response.choices[0]
-                if next_choice.finish_reason is None and next_choice.delta.content:
-                    yield next_choice.delta.content
+            with response_iter:
+                for response in response_iter:
+                    # The usage comes in a last chunk without choices
+                    if usage := usage_event(response.usage, args["model"]):
+                        yield usage
+                    if not response.choices:
+                        continue
+                    next_choice = response.choices[0]
+                    if next_choice.delta.content:
+                        yield MessageDeltaEvent(next_choice.delta.content)
         elif not stream and len(tools) > 0:
             response = self.client.chat.completions.create(
                 messages=cast(List[ChatCompletionMessageParam], messages),
@@ -117,22 +244,76 @@ class OpenAICompletionProvider(CompletionProvider):
             )
             next_choice = response.choices[0]
             if next_choice.message.content:
-                yield next_choice.message.content
+                yield MessageDeltaEvent(next_choice.message.content)
+            if usage := usage_event(response.usage, args["model"]):
+                yield usage
+
+
+# Base URLs of `oai-compat:` servers that rejected stream_options, e.g. older
+# vLLM versions. Their streamed responses come without usage.
+_no_stream_options: Set[str] = set()
+
+
+def stream_options(model: str, base_url) -> dict:
+    """
+    Ask for the usage of streamed responses, unless the server rejected that.
+    """
+    if model.startswith("oai-compat:") and str(base_url) in _no_stream_options:
+        return {}
+    return {"stream_options": {"include_usage": True}}
+
+
+def can_drop_stream_options(model: str, options: dict) -> bool:
+    """
+    Whether a rejected streaming request is retried without `options`. Only
+    `oai-compat:` servers may not know stream_options, OpenAI always does.
+    """
+    return bool(options) and model.startswith("oai-compat:")
+
+
+def usage_event(usage, model: str) -> Optional[UsageEvent]:
+    if usage is None:
+        return None
+    pricing = openai_pricing(model)
+    if pricing is None:
+        return None
+    return UsageEvent.with_pricing(
+        prompt_tokens=usage.prompt_tokens,
+        completion_tokens=usage.completion_tokens,
+        total_tokens=usage.total_tokens,
+        pricing=pricing,
+    )
+
+
+# Checked in order, so longer prefixes come first
+OPENAI_PRICING: List[Tuple[str, Pricing]] = [
+    ("gpt-4o-mini", {"prompt": 0.15 / 1_000_000, "response": 0.60 / 1_000_000}),
+    ("gpt-4o", {"prompt": 2.50 / 1_000_000, "response": 10.0 / 1_000_000}),
+    ("gpt-4-turbo", {"prompt": 10.0 / 1_000_000, "response": 30.0 / 1_000_000}),
+    ("gpt-4", {"prompt": 30.0 / 1_000_000, "response": 60.0 / 1_000_000}),
+    ("gpt-3.5-turbo", {"prompt": 0.50 / 1_000_000, "response": 1.50 / 1_000_000}),
+    ("o1-mini", {"prompt": 3.0 / 1_000_000, "response": 12.0 / 1_000_000}),
+    ("o1", {"prompt": 15.0 / 1_000_000, "response": 60.0 / 1_000_000}),
+]
+
+# Models behind `oai-compat:` are often self-hosted, like llamahost.py, so their
+# tokens are counted without a price
+OAI_COMPAT_PRICING: Pricing = {"prompt": 0.0, "response": 0.0}
+
+
+def openai_pricing(model: str) -> Optional[Pricing]:
+    if model.startswith("oai-compat:"):
+        return OAI_COMPAT_PRICING
+    for prefix, pricing in OPENAI_PRICING:
+        if model.startswith(prefix):
+            return pricing
+    return None
 
 
 def num_tokens_from_messages_openai(messages: List[Message], model: str) -> int:
-    encoding = tiktoken.encoding_for_model(model)
-    num_tokens = 0
-    for message in messages:
-        # every message follows <im_start>{role/name}\n{content}<im_end>\n
-        num_tokens += 4
-        for key, value in message.items():
-            assert isinstance(value, str)
-            num_tokens += len(encoding.encode(value))
-            if key == "name":  # if there's a name, the role is omitted
-                num_tokens += -1  # role is always required and always 1 token
-    num_tokens += 2  # every reply is primed with <im_start>assistant
-    return num_tokens
+    # The encoder is loaded once per model and each message's count is cached,
+    # so counting a growing conversation only tokenizes the new messages
+    return count_messages_tokens(messages, model)
 
 
 def num_tokens_from_completion_openai(completion: Message, model: str) -> int:
@@ -0,0 +1,119 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Iterator
+
+from attr import dataclass
+
+from gptcli.completion import CancelScope, CompletionEvent
+
+logger = logging.getLogger("gptcli-reader")
+
+DEFAULT_READER_QUEUE_SIZE = 4096
+
+# How often a reader blocked on a full queue checks whether it was cancelled
+_PUT_POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+@dataclass
+class StreamReaderStats:
+    events: int = 0
+    max_depth: int = 0
+    # Seconds events spent in the queue before they were consumed
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def mean_wait(self) -> float:
+        return self.total_wait / self.events if self.events else 0.0
+
+
+class StreamReader:
+    """
+    Drains a completion event stream on a background thread into a bounded queue,
+    so reading from the network and rendering don't hold each other up.
+
+    Closing the reader (or leaving the `with` block, e.g. on KeyboardInterrupt)
+    cancels it: the HTTP responses the provider registered with `on_cancel` are
+    closed right away, so a stalled read doesn't keep the request open, and the
+    reader thread stops and closes the stream.
+    """
+
+    def __init__(
+        self,
+        events: Iterator[CompletionEvent],
+        max_queue_size: int = DEFAULT_READER_QUEUE_SIZE,
+    ):
+        self.events = events
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self.cancelled = threading.Event()
+        self.scope = CancelScope()
+        self.stats = StreamReaderStats()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+
+    def __enter__(self) -> "StreamReader":
+        self.thread.start()
+        return self
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def _put(self, item: Any) -> bool:
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put((time.monotonic(), item), timeout=_PUT_POLL_INTERVAL)
+            except queue.Full:
+                continue
+            self.stats.max_depth = max(self.stats.max_depth, self.queue.qsize())
+            return True
+        return False
+
+    def _read(self):
+        iterator = iter(self.events)
+        try:
+            with self.scope:
+                for event in iterator:
+                    if not self._put(event):
+                        return
+            self._put(_DONE)
+        except Exception as e:
+            # Re-raised on the consumer's thread
+            self._put(e)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    def __iter__(self) -> Iterator[CompletionEvent]:
+        while True:
+            enqueued, item = self.queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+
+            wait = time.monotonic() - enqueued
+            self.stats.events += 1
+            self.stats.total_wait += wait
+            self.stats.max_wait = max(self.stats.max_wait, wait)
+            yield item
+
+    def close(self):
+        if self.cancelled.is_set():
+            return
+        self.cancelled.set()
+        self.scope.cancel()
+        logger.debug(
+            "Read %d events, max queue depth %d, mean wait %.4fs, max wait %.4fs",
+            self.stats.events,
+            self.stats.max_depth,
+            self.stats.mean_wait,
+            self.stats.max_wait,
+        )
+
+    def __exit__(self, *args):
+        self.close()
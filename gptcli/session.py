@@ -1,14 +1,29 @@
+import time
 from abc import abstractmethod
 from typing_extensions import TypeGuard
 from gptcli.assistant import Assistant
+from gptcli.compare import (
+    CompareStreamer,
+    compare_models,
+    compare_models_async,
+    parse_models,
+)
+from gptcli.context import ContextTrim
 from gptcli.completion import (
     Message,
     ModelOverrides,
     CompletionError,
     BadRequestError,
+    CompletionEvent,
     UsageEvent,
 )
-from typing import Any, Dict, List, Optional, Tuple
+from gptcli.messages import MessageLog, MessageSnapshot
+from gptcli.reader import StreamReader
+from gptcli.tokens import TokenCounter
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from gptcli.store import SearchResult, SessionInfo, SessionStore
 
 
 class ResponseStreamer:
@@ -32,18 +47,30 @@ class ChatListener:
     def on_chat_rerun(self, success: bool):
         pass
 
+    def on_chat_end(self):
+        pass
+
     def on_error(self, error: Exception):
         pass
 
+    def on_context_trimmed(self, trim: ContextTrim):
+        pass
+
+    def on_chat_resumed(self, session_id: int, messages: Sequence[Message]):
+        pass
+
     def response_streamer(self) -> ResponseStreamer:
         return ResponseStreamer()
 
+    def compare_streamer(self, models: List[str]) -> CompareStreamer:
+        return CompareStreamer()
+
     def on_chat_message(self, message: Message):
         pass
 
     def on_chat_response(
         self,
-        messages: List[Message],
+        messages: Sequence[Message],
         response: Message,
         overrides: ModelOverrides,
         usage: Optional[UsageEvent] = None,
@@ -66,78 +93,216 @@ COMMAND_CLEAR = (":clear", ":c")
 COMMAND_QUIT = (":quit", ":q")
 COMMAND_RERUN = (":rerun", ":r")
 COMMAND_HELP = (":help", ":h", ":?")
+COMMAND_COMPARE = (":compare",)
+COMMAND_SESSIONS = (":sessions",)
+COMMAND_SEARCH = (":search",)
 ALL_COMMANDS = [*COMMAND_CLEAR, *COMMAND_QUIT, *COMMAND_RERUN, *COMMAND_HELP]
 COMMANDS_HELP = """
 Commands:
 - `:clear` / `:c` / Ctrl+C - Clear the conversation.
 - `:quit` / `:q` / Ctrl+D - Quit the program.
 - `:rerun` / `:r` / Ctrl+R - Re-run the last message.
+- `:compare model1,model2,...` - Re-run the last message with each model side by side. The conversation is not changed.
+- `:sessions` - List the saved conversations. `:sessions <id>` resumes one.
+- `:search <query>` - Search the saved conversations.
 - `:help` / `:h` / `:?` - Show this help message.
 """
 
 
+def format_sessions(sessions: List["SessionInfo"]) -> str:
+    if not sessions:
+        return "No saved sessions."
+    lines = ["| ID | Updated | Messages | Title |", "| --- | --- | --- | --- |"]
+    for session in sessions:
+        updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(session.updated_at))
+        title = session.title.replace("\n", " ").replace("|", "\\|")
+        lines.append(f"| {session.id} | {updated} | {session.messages} | {title} |")
+    return "\n".join(lines)
+
+
+def format_search_results(results: List["SearchResult"]) -> str:
+    if not results:
+        return "No matching messages."
+    lines = ["| Session | Date | Role | Match |", "| --- | --- | --- | --- |"]
+    for result in results:
+        date = time.strftime("%Y-%m-%d %H:%M", time.localtime(result.created_at))
+        snippet = result.snippet.replace("\n", " ").replace("|", "\\|")
+        lines.append(f"| {result.session_id} | {date} | {result.role} | {snippet} |")
+    return "\n".join(lines)
+
+
+class PartialResponse:
+    """
+    The assistant's response as far as it has been streamed.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.usage: Optional[UsageEvent] = None
+
+    def add(self, event: CompletionEvent, stream: ResponseStreamer):
+        if event.type == "message_delta":
+            self.text += event.text
+            stream.on_next_token(event.text)
+        elif event.type == "usage":
+            self.usage = event
+
+
 class ChatSession:
     def __init__(
         self,
         assistant: Assistant,
         listener: ChatListener,
+        store: Optional["SessionStore"] = None,
     ):
         self.assistant = assistant
-        self.messages: List[Message] = assistant.init_messages()
+        self.store = store
+        self._messages = MessageLog(assistant.init_messages())
+        self._token_counter = TokenCounter(
+            assistant._param("model", {}), self._messages
+        )
         self.user_prompts: List[Tuple[Message, ModelOverrides]] = []
         self.listener = listener
 
+    @property
+    def messages(self) -> MessageSnapshot:
+        """
+        The conversation so far. Snapshots are immutable and cheap to take.
+        """
+        return self._messages.snapshot()
+
+    def prompt_tokens(self, overrides: ModelOverrides = {}) -> int:
+        """
+        The number of tokens the conversation so far takes up in the prompt.
+        Only messages added since the last call are tokenized.
+        """
+        return self._counter(overrides).total
+
+    def _counter(self, overrides: ModelOverrides) -> TokenCounter:
+        model = self.assistant._param("model", overrides)
+        if model != self._token_counter.model:
+            self._token_counter = TokenCounter(model, self._messages)
+        return self._token_counter
+
+    def _append(self, message: Message):
+        self._messages.append(message)
+        self._token_counter.append(message)
+
+    def _truncate(self, length: int):
+        self._messages.truncate(length)
+        self._token_counter.truncate(length)
+
     def _clear(self):
-        self.messages = self.assistant.init_messages()
+        self._messages = MessageLog(self.assistant.init_messages())
+        self._token_counter = TokenCounter(self._token_counter.model, self._messages)
         self.user_prompts = []
         self.listener.on_chat_clear()
 
-    def _rerun(self):
+    def _rerun_overrides(self) -> Optional[ModelOverrides]:
+        """
+        Drop the last response and return the overrides to re-run the last user
+        message with, or None if there's nothing to re-run.
+        """
         if len(self.user_prompts) == 0:
             self.listener.on_chat_rerun(False)
-            return
+            return None
 
-        if self.messages[-1]["role"] == "assistant":
-            self.messages = self.messages[:-1]
+        if self._messages[-1]["role"] == "assistant":
+            self._truncate(len(self._messages) - 1)
 
         self.listener.on_chat_rerun(True)
         _, args = self.user_prompts[-1]
-        self._respond(args)
+        return args
+
+    def _rerun(self):
+        args = self._rerun_overrides()
+        if args is not None:
+            self._respond(args)
+
+    def _compare_request(
+        self, user_input: str
+    ) -> Optional[Tuple[Sequence[Message], List[str], ModelOverrides]]:
+        _, _, models_arg = user_input.partition(" ")
+        models = parse_models(models_arg)
+        if len(models) == 0:
+            self.listener.on_error(
+                InvalidArgumentError("Usage: :compare model1,model2,...")
+            )
+            return None
+        if len(self.user_prompts) == 0:
+            self.listener.on_error(InvalidArgumentError("Nothing to compare."))
+            return None
+
+        messages = self.messages
+        if messages[-1]["role"] == "assistant":
+            messages = messages[:-1]
+
+        _, args = self.user_prompts[-1]
+        return messages, models, args
+
+    def _compare(self, user_input: str):
+        request = self._compare_request(user_input)
+        if request is None:
+            return
+
+        messages, models, args = request
+        try:
+            compare_models(
+                self.assistant,
+                messages,
+                models,
+                args,
+                self.listener.compare_streamer(models),
+            )
+        except KeyboardInterrupt:
+            pass
+
+    def _completion_args(self, overrides: ModelOverrides) -> Dict[str, Any]:
+        return {
+            "override_params": overrides,
+            "on_trim": self.listener.on_context_trimmed,
+            "token_counter": self._counter(overrides),
+        }
 
     def _respond(self, overrides: ModelOverrides) -> bool:
         """
         Respond to the user's input and return whether the assistant's response was saved.
         """
-        next_response: str = ""
-        usage: Optional[UsageEvent] = None
+        response = PartialResponse()
         try:
             completion_iter = self.assistant.complete_chat(
-                self.messages, override_params=overrides
+                self.messages, **self._completion_args(overrides)
             )
 
-            with self.listener.response_streamer() as stream:
-                for event in completion_iter:
-                    if event.type == "message_delta":
-                        next_response += event.text
-                        stream.on_next_token(event.text)
-                    elif event.type == "usage":
-                        usage = event
+            # Rendering stalls don't hold up reading the response from the network
+            with StreamReader(completion_iter) as reader:
+                with self.listener.response_streamer() as stream:
+                    for event in reader:
+                        response.add(event, stream)
 
         except KeyboardInterrupt:
             # If the user interrupts the chat completion, we'll just return what we have so far
             pass
-        except BadRequestError as e:
-            self.listener.on_error(e)
-            return False
         except CompletionError as e:
-            self.listener.on_error(e)
-            return True
+            return self._on_completion_error(e)
+
+        return self._save_response(response, overrides)
+
+    def _on_completion_error(self, error: CompletionError) -> bool:
+        self.listener.on_error(error)
+        # Rejected requests are dropped, other failures can be re-run
+        return not isinstance(error, BadRequestError)
 
-        next_message: Message = {"role": "assistant", "content": next_response}
+    def _save_response(
+        self, response: PartialResponse, overrides: ModelOverrides
+    ) -> bool:
+        next_message: Message = {"role": "assistant", "content": response.text}
         self.listener.on_chat_message(next_message)
-        self.listener.on_chat_response(self.messages, next_message, overrides, usage)
+        self.listener.on_chat_response(
+            self.messages, next_message, overrides, response.usage
+        )
 
-        self.messages = self.messages + [next_message]
+        self._append(next_message)
         return True
 
     def _validate_args(self, args: Dict[str, Any]) -> TypeGuard[ModelOverrides]:
@@ -154,45 +319,193 @@ class ChatSession:
 
     def _add_user_message(self, user_input: str, args: ModelOverrides):
         user_message: Message = {"role": "user", "content": user_input}
-        self.messages = self.messages + [user_message]
+        self._append(user_message)
         self.listener.on_chat_message(user_message)
         self.user_prompts.append((user_message, args))
 
     def _rollback_user_message(self):
-        self.messages = self.messages[:-1]
-        self.user_prompts = self.user_prompts[:-1]
+        self._truncate(len(self._messages) - 1)
+        self.user_prompts.pop()
 
     def _print_help(self):
         with self.listener.response_streamer() as stream:
             stream.on_next_token(COMMANDS_HELP)
 
-    def process_input(self, user_input: str, args: Dict[str, Any]):
+    def resume(self, session_id: Optional[int] = None) -> bool:
         """
-        Process the user's input and return whether the session should continue.
+        Replace the conversation with a stored one, by default the latest.
+        """
+        if self.store is None:
+            self.listener.on_error(InvalidArgumentError("Session history is disabled."))
+            return False
+
+        if session_id is None:
+            session_id = self.store.latest_session_id()
+        stored = self.store.load(session_id) if session_id is not None else None
+        if stored is None:
+            self.listener.on_error(
+                InvalidArgumentError(f"No saved session with ID {session_id}.")
+            )
+            return False
+
+        self._messages = MessageLog(stored.messages)
+        self._token_counter = TokenCounter(self._token_counter.model, self._messages)
+        self.user_prompts = stored.user_prompts
+        self.listener.on_chat_resumed(stored.id, self.messages)
+        return True
+
+    def _sessions(self, user_input: str):
+        _, _, session_id = user_input.partition(" ")
+        if session_id.strip():
+            if not session_id.strip().isdigit():
+                self.listener.on_error(InvalidArgumentError("Usage: :sessions [id]"))
+                return
+            self.resume(int(session_id))
+            return
+
+        if self.store is None:
+            self.listener.on_error(InvalidArgumentError("Session history is disabled."))
+            return
+        with self.listener.response_streamer() as stream:
+            stream.on_next_token(format_sessions(self.store.list_sessions()))
+
+    def _search(self, user_input: str):
+        from gptcli.store import SearchError
+
+        _, _, query = user_input.partition(" ")
+        if not query.strip():
+            self.listener.on_error(InvalidArgumentError("Usage: :search <query>"))
+            return
+        if self.store is None:
+            self.listener.on_error(InvalidArgumentError("Session history is disabled."))
+            return
+
+        try:
+            results = self.store.search(query)
+        except SearchError as e:
+            self.listener.on_error(e)
+            return
+        with self.listener.response_streamer() as stream:
+            stream.on_next_token(format_search_results(results))
+
+    def _parse_input(self, user_input: str, args: Dict[str, Any]) -> str:
+        """
+        Run the commands that don't wait for a model and return what's left to do:
+        "quit", "rerun", "compare", "respond" to a new user message, or "done".
         """
         if not self._validate_args(args):
-            return True
+            return "done"
 
+        command = user_input.split(" ", 1)[0]
         if user_input in COMMAND_QUIT:
-            return False
+            return "quit"
         elif user_input in COMMAND_CLEAR:
             self._clear()
-            return True
         elif user_input in COMMAND_RERUN:
-            self._rerun()
-            return True
+            return "rerun"
         elif user_input in COMMAND_HELP:
             self._print_help()
-            return True
+        elif command in COMMAND_COMPARE:
+            return "compare"
+        elif command in COMMAND_SESSIONS:
+            self._sessions(user_input)
+        elif command in COMMAND_SEARCH:
+            self._search(user_input)
+        else:
+            self._add_user_message(user_input, args)
+            return "respond"
+        return "done"
 
-        self._add_user_message(user_input, args)
-        response_saved = self._respond(args)
-        if not response_saved:
+    def process_input(self, user_input: str, args: Dict[str, Any]):
+        """
+        Process the user's input and return whether the session should continue.
+        """
+        action = self._parse_input(user_input, args)
+        if action == "rerun":
+            self._rerun()
+        elif action == "compare":
+            self._compare(user_input)
+        elif action == "respond" and not self._respond(args):
             self._rollback_user_message()
+        return action != "quit"
 
-        return True
-
-    def loop(self, input_provider: UserInputProvider):
+    def loop(
+        self,
+        input_provider: UserInputProvider,
+        resume: bool = False,
+        session_id: Optional[int] = None,
+    ):
         self.listener.on_chat_start()
-        while self.process_input(*input_provider.get_user_input()):
+        if resume:
+            self.resume(session_id)
+        try:
+            while self.process_input(*input_provider.get_user_input()):
+                pass
+        finally:
+            self.listener.on_chat_end()
+
+
+class AsyncChatSession(ChatSession):
+    """
+    A ChatSession whose responses are streamed with the providers' asyncio-native
+    `acomplete`, so a single thread can serve many sessions.
+    """
+
+    async def _rerun(self):
+        args = self._rerun_overrides()
+        if args is not None:
+            await self._respond(args)
+
+    async def _compare(self, user_input: str):
+        request = self._compare_request(user_input)
+        if request is None:
+            return
+
+        messages, models, args = request
+        with self.listener.compare_streamer(models) as streamer:
+            await compare_models_async(
+                self.assistant, messages, models, args, streamer
+            )
+
+    async def _respond(self, overrides: ModelOverrides) -> bool:
+        response = PartialResponse()
+        try:
+            completion_iter = self.assistant.acomplete_chat(
+                self.messages, **self._completion_args(overrides)
+            )
+
+            with self.listener.response_streamer() as stream:
+                async for event in completion_iter:
+                    response.add(event, stream)
+
+        except KeyboardInterrupt:
             pass
+        except CompletionError as e:
+            return self._on_completion_error(e)
+
+        return self._save_response(response, overrides)
+
+    async def process_input(self, user_input: str, args: Dict[str, Any]):
+        action = self._parse_input(user_input, args)
+        if action == "rerun":
+            await self._rerun()
+        elif action == "compare":
+            await self._compare(user_input)
+        elif action == "respond" and not await self._respond(args):
+            self._rollback_user_message()
+        return action != "quit"
+
+    async def loop(
+        self,
+        input_provider: UserInputProvider,
+        resume: bool = False,
+        session_id: Optional[int] = None,
+    ):
+        self.listener.on_chat_start()
+        if resume:
+            self.resume(session_id)
+        try:
+            while await self.process_input(*input_provider.get_user_input()):
+                pass
+        finally:
+            self.listener.on_chat_end()
@@ -0,0 +1,396 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from array import array
+from typing import Any, List, Optional, Tuple, TypedDict
+
+from attr import dataclass
+
+from gptcli.cache import (
+    DEFAULT_MAX_SIZE_MB,
+    DEFAULT_TTL,
+    CachedProvider,
+    CacheStats,
+    dump_event,
+    load_event,
+)
+from gptcli.completion import CompletionEvent, CompletionProvider, Message
+
+logger = logging.getLogger("gptcli-similarity")
+
+DEFAULT_SIMILARITY_DB = os.path.join(
+    os.path.expanduser("~"), ".config", "gpt-cli", "similar.db"
+)
+DEFAULT_THRESHOLD = 0.8
+
+# Characters per shingle
+SHINGLE_SIZE = 4
+# MinHash signature length, split into BANDS bands of ROWS values for LSH. Two
+# prompts share a band with probability 1 - (1 - J^ROWS)^BANDS for Jaccard
+# similarity J: 0.99 at J = 0.7. Candidates are then checked against the
+# configured threshold, so it can be changed without reindexing.
+NUM_HASHES = 64
+BANDS = 16
+ROWS = 4
+# Candidates checked per lookup, the most recent first
+MAX_CANDIDATES = 64
+
+_BIN_SHIFT = 64 - 6  # log2(NUM_HASHES) high bits pick the bin
+_VALUE_MASK = (1 << _BIN_SHIFT) - 1
+_MASK64 = (1 << 64) - 1
+_EMPTY = _VALUE_MASK + 1
+# Keeps borrowed values of densified bins distinct from their source bin
+_DENSIFY_OFFSET = 0x9E3779B97F4A7C15
+
+# Bumped when the schema or the meaning of the stored keys changes. Older
+# databases are cleared, they are only a cache.
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+DROP TABLE IF EXISTS entries;
+DROP TABLE IF EXISTS buckets;
+CREATE TABLE entries (
+    id INTEGER PRIMARY KEY,
+    scope TEXT NOT NULL,
+    signature BLOB NOT NULL,
+    events TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX entries_created ON entries (created_at);
+CREATE TABLE buckets (
+    key INTEGER NOT NULL,
+    entry_id INTEGER NOT NULL,
+    PRIMARY KEY (key, entry_id)
+) WITHOUT ROWID;
+CREATE INDEX buckets_entry ON buckets (entry_id);
+"""
+
+
+class SimilarityCacheConfig(TypedDict, total=False):
+    path: str
+    # Estimated Jaccard similarity of the shingled prompts above which a cached
+    # response is returned
+    threshold: float
+    # The cache is trimmed to this size, least recently used responses first
+    max_size_mb: float
+    # Seconds a response is served from the cache
+    ttl: float
+    # Cache responses at any temperature, not only the deterministic ones at 0
+    all_temperatures: bool
+
+
+@dataclass
+class SimilarityKey:
+    # Hash of everything that has to match exactly
+    scope: str
+    signature: List[int]
+
+
+# Dates with an optional time, times of day and UUIDs
+_VOLATILE = re.compile(
+    r"\d{4}-\d{2}-\d{2}"
+    r"(?:[t ]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:z|[+-]\d{2}:?\d{2})?)?"
+    r"|\b\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?\b"
+    r"|\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b"
+)
+_NUMBERS = re.compile(r"\d+(?:\.\d+)?")
+_NORMALIZE_SPACE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """
+    Fold the differences that don't change a prompt's meaning: case, runs of
+    whitespace, timestamps and UUIDs. Other numbers are kept, see `numbers`.
+    """
+    text = _VOLATILE.sub("0", text.lower())
+    return _NORMALIZE_SPACE.sub(" ", text).strip()
+
+
+def numbers(text: str) -> List[str]:
+    """
+    The numbers in a prompt apart from timestamps and UUIDs. Prompts that differ
+    in one, like "What is 4 * 9?" and "What is 17 * 23?", need different
+    responses however similar they are otherwise.
+    """
+    return _NUMBERS.findall(_VOLATILE.sub(" ", text.lower()))
+
+
+def shingle_hashes(text: str) -> List[int]:
+    """
+    64-bit hashes of the distinct character shingles of the normalized text.
+    """
+    data = normalize(text).encode("utf-8")
+    if len(data) < SHINGLE_SIZE:
+        shingles = {data}
+    else:
+        shingles = {
+            data[i : i + SHINGLE_SIZE] for i in range(len(data) - SHINGLE_SIZE + 1)
+        }
+    # CRC32 is computed in C, the multiplication spreads it over 64 bits
+    return [
+        (zlib.crc32(shingle) * 0x9E3779B97F4A7C15 + 0x632BE59BD9B4E019) & _MASK64
+        for shingle in shingles
+    ]
+
+
+def minhash(hashes: List[int]) -> List[int]:
+    """
+    One-permutation MinHash: each hash lands in one of NUM_HASHES bins by its
+    high bits and each bin keeps its minimum, so the signature costs a single
+    pass over the shingles. Empty bins borrow from the next non-empty bin.
+    """
+    bins = [_EMPTY] * NUM_HASHES
+    for h in hashes:
+        i = h >> _BIN_SHIFT
+        value = h & _VALUE_MASK
+        if value < bins[i]:
+            bins[i] = value
+
+    if _EMPTY in bins and len(hashes) > 0:
+        filled = [i for i, value in enumerate(bins) if value != _EMPTY]
+        for i in range(NUM_HASHES):
+            if bins[i] != _EMPTY:
+                continue
+            distance, source = min(((j - i) % NUM_HASHES, j) for j in filled)
+            bins[i] = (bins[source] + distance * _DENSIFY_OFFSET) & _VALUE_MASK
+    return bins
+
+
+def similarity(a: List[int], b: List[int]) -> float:
+    """
+    The Jaccard similarity estimated from two signatures.
+    """
+    return sum(x == y for x, y in zip(a, b)) / NUM_HASHES
+
+
+def bucket_keys(scope: str, signature: List[int]) -> List[int]:
+    keys = []
+    for band in range(BANDS):
+        values = array("Q", signature[band * ROWS : (band + 1) * ROWS]).tobytes()
+        digest = hashlib.blake2b(
+            values,
+            digest_size=8,
+            key=scope.encode("ascii")[:64],
+            salt=band.to_bytes(16, "little"),
+        ).digest()
+        # SQLite integers are signed
+        keys.append(int.from_bytes(digest, "little", signed=True))
+    return keys
+
+
+def prompt_text(messages: List[Message]) -> str:
+    system = [m["content"] for m in messages if m["role"] == "system"]
+    final = messages[-1]["content"] if messages else ""
+    return "\n".join([*system, final])
+
+
+def prompt_scope(
+    name: str, messages: List[Message], args: dict, tools: Any = None
+) -> str:
+    """
+    A hash of the parts of a request that must match exactly for a response to be
+    reused: the assistant, model parameters, any conversation before the final
+    message, apart from the system prompt, and the numbers in the prompt.
+    """
+    request = {
+        "assistant": name,
+        "model": args["model"],
+        "temperature": float(args.get("temperature", 0.0)),
+        "top_p": float(args.get("top_p", 1.0)),
+        "history": [
+            {"role": m["role"], "content": m["content"]}
+            for m in messages[:-1]
+            if m["role"] != "system"
+        ],
+        "tools": tools or [],
+        "numbers": numbers(prompt_text(messages)),
+    }
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SimilarityCache:
+    """
+    Responses indexed by the MinHash signature of their prompt in a local SQLite
+    database. Each signature is split into LSH bands, and a lookup only compares
+    signatures with the prompts that share a band, so it stays fast however many
+    responses are stored. Like the ResponseCache, the database is trimmed to
+    `max_size_mb` and responses older than `ttl` seconds are never served.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_SIMILARITY_DB,
+        threshold: float = DEFAULT_THRESHOLD,
+        all_temperatures: bool = False,
+        max_size_mb: float = DEFAULT_MAX_SIZE_MB,
+        ttl: float = DEFAULT_TTL,
+    ):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.threshold = threshold
+        self.all_temperatures = all_temperatures
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        (version,) = self.connection.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            with self.connection:
+                self.connection.executescript(SCHEMA)
+                self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    @classmethod
+    def from_config(cls, config: SimilarityCacheConfig) -> "SimilarityCache":
+        return cls(
+            os.path.expanduser(config.get("path", DEFAULT_SIMILARITY_DB)),
+            config.get("threshold", DEFAULT_THRESHOLD),
+            config.get("all_temperatures", False),
+            config.get("max_size_mb", DEFAULT_MAX_SIZE_MB),
+            config.get("ttl", DEFAULT_TTL),
+        )
+
+    def accepts(self, args: dict) -> bool:
+        return self.all_temperatures or float(args.get("temperature", 0.0)) == 0.0
+
+    def lookup(
+        self, key: SimilarityKey
+    ) -> Optional[Tuple[float, List[CompletionEvent]]]:
+        """
+        The most similar stored response above the threshold and its similarity.
+        """
+        keys = bucket_keys(key.scope, key.signature)
+        now = time.time()
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, scope, signature, events FROM entries WHERE id IN ("
+                "  SELECT DISTINCT entry_id FROM buckets WHERE key IN (%s)"
+                "  ORDER BY entry_id DESC LIMIT ?"
+                ") AND created_at >= ?" % ",".join("?" * len(keys)),
+                (*keys, MAX_CANDIDATES, now - self.ttl),
+            ).fetchall()
+
+        best: Optional[Tuple[float, int, str]] = None
+        for entry_id, scope, signature_bytes, events in rows:
+            if scope != key.scope:
+                continue
+            score = similarity(key.signature, list(array("Q", signature_bytes)))
+            if score >= self.threshold and (best is None or score > best[0]):
+                best = (score, entry_id, events)
+        if best is None:
+            return None
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE entries SET accessed_at = ? WHERE id = ?", (now, best[1])
+            )
+        return best[0], [load_event(event) for event in json.loads(best[2])]
+
+    def get(self, key: SimilarityKey) -> Optional[List[CompletionEvent]]:
+        found = self.lookup(key)
+        if found is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        logger.info("Serving a cached response with similarity %.2f", found[0])
+        return found[1]
+
+    def put(self, key: SimilarityKey, events: List[CompletionEvent]):
+        dumped = [dump_event(event) for event in events]
+        if any(event is None for event in dumped):
+            return
+        signature = array("Q", key.signature).tobytes()
+        data = json.dumps(dumped)
+        now = time.time()
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO entries "
+                "(scope, signature, events, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key.scope,
+                    signature,
+                    data,
+                    len(key.scope) + len(signature) + len(data),
+                    now,
+                    now,
+                ),
+            )
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO buckets (key, entry_id) VALUES (?, ?)",
+                [
+                    (bucket, cursor.lastrowid)
+                    for bucket in bucket_keys(key.scope, key.signature)
+                ],
+            )
+            self._evict(now)
+
+    def _evict(self, now: float):
+        expired = self.connection.execute(
+            "SELECT id FROM entries WHERE created_at < ?", (now - self.ttl,)
+        ).fetchall()
+        (size,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        evicted = []
+        if size > self.max_size:
+            # Keep the most recently used responses that fit
+            evicted = self.connection.execute(
+                "SELECT id FROM ("
+                "  SELECT id, SUM(size) OVER ("
+                "    ORDER BY accessed_at DESC, id DESC"
+                "  ) AS total FROM entries"
+                ") WHERE total > ?",
+                (self.max_size,),
+            ).fetchall()
+        ids = list({row[0] for row in [*expired, *evicted]})
+        if not ids:
+            return
+        self.connection.executemany(
+            "DELETE FROM entries WHERE id = ?", [(i,) for i in ids]
+        )
+        self.connection.executemany(
+            "DELETE FROM buckets WHERE entry_id = ?", [(i,) for i in ids]
+        )
+        logger.debug("Evicted %d similar responses", len(ids))
+
+    def close(self):
+        logger.info(
+            "Similarity cache: %d hits, %d misses (%.0f%% hit rate)",
+            self.stats.hits,
+            self.stats.misses,
+            self.stats.hit_rate * 100,
+        )
+        with self.lock:
+            self.connection.close()
+
+
+class SimilarityCachedProvider(CachedProvider):
+    """
+    Serves requests whose system prompt and final message are nearly the same
+    as those of an earlier request of the same assistant and model.
+    """
+
+    def __init__(
+        self, provider: CompletionProvider, cache: SimilarityCache, name: str
+    ):
+        super().__init__(provider, cache)
+        self.name = name
+
+    def _key(
+        self, messages: List[Message], args: dict, tools: Any = None
+    ) -> SimilarityKey:
+        return SimilarityKey(
+            scope=prompt_scope(self.name, messages, args, tools),
+            signature=minhash(shingle_hashes(prompt_text(messages))),
+        )
@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from attr import dataclass
+
+from gptcli.completion import Message, ModelOverrides, UsageEvent
+from gptcli.session import ChatListener
+
+logger = logging.getLogger("gptcli-store")
+
+DEFAULT_SESSIONS_DB = os.path.join(
+    os.path.expanduser("~"), ".config", "gpt-cli", "sessions.db"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id),
+    -- Position in the conversation. A row replaces the rows at and after its
+    -- position that were written before it, e.g. when a response is re-run
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    overrides TEXT,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    cost REAL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id);
+"""
+
+# Full-text index over the message contents. It is an external-content table, so
+# the text is stored once, and a trigger indexes each message in the transaction
+# that writes it. Created separately because not every SQLite has FTS5.
+SEARCH_SCHEMA = """
+BEGIN;
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, content='messages', content_rowid='id', tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+-- Index the messages written before the table existed
+INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+COMMIT;
+"""
+
+TITLE_LENGTH = 80
+
+# Tokens of context around the matches in a search snippet
+SNIPPET_TOKENS = 16
+
+
+@dataclass
+class SessionInfo:
+    id: int
+    title: str
+    updated_at: float
+    messages: int
+
+
+@dataclass
+class StoredSession:
+    id: int
+    messages: List[Message]
+    # Each user prompt with the overrides its response was generated with
+    user_prompts: List[Tuple[Message, ModelOverrides]]
+
+
+@dataclass
+class SearchResult:
+    session_id: int
+    message_id: int
+    role: str
+    # The matching part of the message, with the matched terms highlighted
+    snippet: str
+    created_at: float
+
+
+class SearchError(Exception):
+    pass
+
+
+def fts_query(query: str) -> str:
+    """
+    Turn free text into an FTS5 query matching messages that contain all of its
+    words. Each word is quoted, so punctuation isn't read as query syntax.
+    """
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+class SessionStore:
+    """
+    Conversations in a local SQLite database. Messages are only ever appended, a
+    conversation is rebuilt from its rows in a single indexed query.
+    """
+
+    def __init__(self, path: str = DEFAULT_SESSIONS_DB):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        # Written to by the listener's worker thread, read from the session's
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.searchable = self._init_search()
+
+    def _init_search(self) -> bool:
+        exists = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+        ).fetchone()
+        if exists:
+            return True
+        try:
+            self.connection.executescript(SEARCH_SCHEMA)
+        except sqlite3.OperationalError as e:
+            if self.connection.in_transaction:
+                self.connection.rollback()
+            logger.warning("Conversation search is unavailable: %s", e)
+            return False
+        return True
+
+    def create_session(self, title: str) -> int:
+        now = time.time()
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO sessions (title, created_at, updated_at) VALUES (?, ?, ?)",
+                (title[:TITLE_LENGTH], now, now),
+            )
+        assert cursor.lastrowid is not None
+        return cursor.lastrowid
+
+    def append(
+        self,
+        session_id: int,
+        messages: Sequence[Tuple[int, Message]],
+        overrides: Optional[ModelOverrides] = None,
+        usage: Optional[UsageEvent] = None,
+    ):
+        """
+        Append `(seq, message)` pairs in one transaction. The overrides and usage
+        belong to the last message, the response.
+        """
+        now = time.time()
+        rows = [
+            (session_id, seq, message["role"], message["content"])
+            + (None, None, None, None, now)
+            for seq, message in messages
+        ]
+        if rows and (overrides is not None or usage is not None):
+            rows[-1] = rows[-1][:4] + (
+                json.dumps(overrides or {}),
+                usage.prompt_tokens if usage else None,
+                usage.completion_tokens if usage else None,
+                usage.cost if usage else None,
+                now,
+            )
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO messages (session_id, seq, role, content, overrides, "
+                "prompt_tokens, completion_tokens, cost, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.connection.execute(
+                "UPDATE sessions SET updated_at = ? WHERE id = ?", (now, session_id)
+            )
+
+    def latest_session_id(self) -> Optional[int]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id FROM sessions ORDER BY updated_at DESC, id DESC LIMIT 1"
+            ).fetchone()
+        return row[0] if row else None
+
+    def list_sessions(self, limit: int = 20) -> List[SessionInfo]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT s.id, s.title, s.updated_at, COUNT(m.id) FROM sessions s "
+                "LEFT JOIN messages m ON m.session_id = s.id "
+                "GROUP BY s.id ORDER BY s.updated_at DESC, s.id DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [SessionInfo(*row) for row in rows]
+
+    def load(self, session_id: int) -> Optional[StoredSession]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT seq, role, content, overrides FROM messages "
+                "WHERE session_id = ? ORDER BY id",
+                (session_id,),
+            ).fetchall()
+        if not rows:
+            return None
+
+        messages: List[Message] = []
+        overrides: List[Optional[ModelOverrides]] = []
+        for seq, role, content, overrides_json in rows:
+            del messages[seq:]
+            del overrides[seq:]
+            messages.append({"role": role, "content": content})
+            overrides.append(json.loads(overrides_json) if overrides_json else None)
+
+        user_prompts = []
+        for i, message in enumerate(messages):
+            if message["role"] != "user":
+                continue
+            response_overrides = overrides[i + 1] if i + 1 < len(overrides) else None
+            user_prompts.append((message, response_overrides or {}))
+        return StoredSession(id=session_id, messages=messages, user_prompts=user_prompts)
+
+    def search(
+        self,
+        query: str,
+        limit: int = 20,
+        highlight: Tuple[str, str] = ("**", "**"),
+    ) -> List[SearchResult]:
+        """
+        The messages containing all words of `query`, best match first.
+        """
+        if not self.searchable:
+            raise SearchError("Conversation search requires SQLite with FTS5.")
+        match = fts_query(query)
+        if not match:
+            return []
+
+        # The index keeps the rows that a later row replaced (e.g. a re-run
+        # response), which are no longer part of the conversation
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT m.session_id, m.id, m.role, f.snippet, m.created_at FROM ("
+                "  SELECT rowid, rank, snippet(messages_fts, 0, ?, ?, '...', ?) AS snippet"
+                "  FROM messages_fts WHERE messages_fts MATCH ?"
+                ") f JOIN messages m ON m.id = f.rowid "
+                "WHERE NOT EXISTS ("
+                "  SELECT 1 FROM messages r WHERE r.session_id = m.session_id"
+                "  AND r.id > m.id AND r.seq <= m.seq"
+                ") ORDER BY f.rank LIMIT ?",
+                (*highlight, SNIPPET_TOKENS, match, limit),
+            ).fetchall()
+        return [SearchResult(*row) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class SessionStoreListener(ChatListener):
+    """
+    Records the conversation in a SessionStore. A prompt is written together with
+    its response, so prompts the session rolls back are never stored. Meant to be
+    wrapped in a ThreadedChatListener to keep the writes off the token path.
+    """
+
+    def __init__(self, store: SessionStore):
+        self.store = store
+        self.session_id: Optional[int] = None
+        # Number of leading messages of the conversation that are stored
+        self.stored = 0
+
+    def on_chat_clear(self):
+        self.session_id = None
+        self.stored = 0
+
+    def on_chat_resumed(self, session_id: int, messages: Sequence[Message]):
+        self.session_id = session_id
+        self.stored = len(messages)
+
+    def on_chat_response(
+        self,
+        messages: Sequence[Message],
+        response: Message,
+        overrides: ModelOverrides,
+        usage: Optional[UsageEvent] = None,
+    ):
+        if self.session_id is None:
+            prompt = messages[-1]["content"] if len(messages) > 0 else ""
+            self.session_id = self.store.create_session(prompt)
+            self.stored = 0
+
+        # A re-run response replaces the one at the same position
+        start = min(self.stored, len(messages))
+        rows = [(seq, messages[seq]) for seq in range(start, len(messages))]
+        rows.append((len(messages), response))
+        self.store.append(self.session_id, rows, overrides, usage)
+        self.stored = len(messages) + 1
+
+    def on_chat_end(self):
+        self.store.close()
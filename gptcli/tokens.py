@@ -0,0 +1,122 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, List, Sequence, Tuple
+
+from gptcli.completion import Message
+
+# Used to estimate the token counts of models tiktoken doesn't know (e.g. Claude)
+DEFAULT_ENCODING = "cl100k_base"
+
+TOKEN_CACHE_SIZE = 10000
+
+# every message follows <im_start>{role/name}\n{content}<im_end>\n
+TOKENS_PER_MESSAGE = 4
+# every reply is primed with <im_start>assistant
+TOKENS_PER_REPLY = 2
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> Any:
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+_token_cache: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+def count_text_tokens(text: str, encoding: Any) -> int:
+    """
+    The number of tokens in `text`, cached by the hash of the text and the encoding.
+    """
+    key = (encoding.name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+    with _token_cache_lock:
+        count = _token_cache.get(key)
+        if count is not None:
+            _token_cache.move_to_end(key)
+            return count
+
+    count = len(encoding.encode(text))
+    with _token_cache_lock:
+        _token_cache[key] = count
+        if len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return count
+
+
+def count_message_tokens(message: Message, encoding: Any) -> int:
+    num_tokens = TOKENS_PER_MESSAGE
+    for key, value in message.items():
+        assert isinstance(value, str)
+        num_tokens += count_text_tokens(value, encoding)
+        if key == "name":  # if there's a name, the role is omitted
+            num_tokens += -1  # role is always required and always 1 token
+    return num_tokens
+
+
+def count_messages_tokens(messages: Sequence[Message], model: str) -> int:
+    encoding = get_encoding(model)
+    return (
+        sum(count_message_tokens(message, encoding) for message in messages)
+        + TOKENS_PER_REPLY
+    )
+
+
+class TokenCounter:
+    """
+    Keeps the prompt size of a growing conversation. Appending and truncating are
+    O(1). Messages are tokenized once, the first time the total is asked for after
+    they were appended, so the tokenizer isn't loaded until it's needed.
+    """
+
+    def __init__(self, model: str, messages: Sequence[Message] = ()):
+        self.model = model
+        self._messages: List[Message] = list(messages)
+        # _prefix[i] is the number of tokens in the first i messages
+        self._prefix: List[int] = [0]
+
+    def append(self, message: Message):
+        self._messages.append(message)
+
+    def truncate(self, length: int):
+        del self._messages[length:]
+        del self._prefix[length + 1 :]
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def _count(self):
+        if len(self._prefix) <= len(self._messages):
+            encoding = get_encoding(self.model)
+            for message in self._messages[len(self._prefix) - 1 :]:
+                self._prefix.append(
+                    self._prefix[-1] + count_message_tokens(message, encoding)
+                )
+
+    @property
+    def total(self) -> int:
+        self._count()
+        return self._prefix[-1] + TOKENS_PER_REPLY
+
+    def counts(self) -> List[int]:
+        """
+        The number of tokens in each message.
+        """
+        self._count()
+        return [b - a for a, b in zip(self._prefix, self._prefix[1:])]
+
+
+def max_message_tokens(message: Message) -> int:
+    """
+    An upper bound on `count_message_tokens` that doesn't need the tokenizer:
+    every token encodes at least one byte.
+    """
+    return TOKENS_PER_MESSAGE + sum(
+        len(value.encode("utf-8")) for value in message.values()
+    )
@@ -1,11 +1,21 @@
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import queue
 import sys
-from typing import Dict, Iterator, List, Optional, TypedDict, cast
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, TypedDict, cast
 from flask import Flask, request, jsonify, Response
-from threading import Lock
+from threading import Event, Lock, Thread
 
 try:
-    from llama_cpp import Completion, CompletionChunk, Llama
+    from llama_cpp import CompletionChunk, Llama, LlamaRAMCache
 
     DOLPHIN_AVAILABLE = True
 except ImportError:
@@ -24,6 +34,25 @@ model_config: Optional[Dict[str, DolphinModelConfig]] = {
     "path": "/home/juan/dolphin-2.7-mixtral-8x7b.Q4_K_M.gguf",
     "human_prompt": "Human",
     "assistant_prompt": "Assistant",
+    # Memory for saved KV states of earlier prompts, 0 disables saving them
+    "prompt_cache_mb": 4096,
+    "max_tokens": 1024,
+    # Passed to Llama, the rest of LLAMA_PARAMS keep their defaults
+    "n_ctx": 2048,
+    "use_mlock": True,
+}
+
+# The model_config keys passed to Llama and their defaults. None leaves the choice
+# to llama_cpp. `gpt llama-tune` finds the best thread and batch settings.
+LLAMA_PARAMS = {
+    "n_ctx": 2048,
+    "n_threads": None,
+    "n_threads_batch": None,
+    "n_batch": 512,
+    "use_mmap": True,
+    "use_mlock": True,
+    "rope_freq_base": 0.0,
+    "rope_freq_scale": 0.0,
 }
 
 def init_dolphin_models(models: dict[str, DolphinModelConfig]):
@@ -62,64 +91,813 @@ def make_prompt(messages: List[dict], model_config: DolphinModelConfig) -> str:
     prompt += f"\n{model_config['assistant_prompt']}"
     return prompt
 
-llm = None
-llm_lock = Lock()
-
-def get_llm(model_config):
-    global llm
-    if llm is None:
-        with llm_lock:
-            if llm is None:
-                with suppress_stderr():
-                    llm = Llama(
-                        model_path=model_config["path"],
-                        n_ctx=2048,
-                        verbose=False,
-                        use_mlock=True,
-                    )
+def llama_params(model_config) -> dict:
+    params = {key: model_config.get(key, default) for key, default in LLAMA_PARAMS.items()}
+    return {key: value for key, value in params.items() if value is not None}
+
+def load_llm(model_config, prompt_cache_mb: int):
+    with suppress_stderr():
+        llm = Llama(
+            model_path=model_config["path"],
+            verbose=False,
+            **llama_params(model_config),
+        )
+    # Only the tokens after the longest prefix shared with the tokens in the
+    # context, or with a saved earlier prompt, are evaluated
+    if prompt_cache_mb > 0:
+        llm.set_cache(LlamaRAMCache(capacity_bytes=prompt_cache_mb * 2**20))
     return llm
 
+def stream_completion(llm, model_config, prompt: str, args: dict, result: dict) -> Iterator[str]:
+    """
+    Stream the text of a completion. Once it finished, `result` holds the
+    finish_reason and the prompt_tokens and completion_tokens counts.
+    """
+    args = {"max_tokens": model_config.get("max_tokens", 1024), **args}
+    stop = [model_config["human_prompt"], *args.pop("stop", [])]
+    gen = llm.create_completion(prompt, stop=stop, stream=True, echo=False, **args)
+    text = ""
+    try:
+        for x in cast("Iterator[CompletionChunk]", gen):
+            choice = x["choices"][0]
+            if choice["finish_reason"] is not None:
+                result["finish_reason"] = choice["finish_reason"]
+            if choice["text"]:
+                text += choice["text"]
+                yield choice["text"]
+    finally:
+        gen.close()
+    result["prompt_tokens"] = len(llm.tokenize(prompt.encode("utf-8")))
+    result["completion_tokens"] = len(llm.tokenize(text.encode("utf-8"), add_bos=False))
+
+def message_checksum(checksum: str, message: dict) -> str:
+    """
+    The checksum of a message history, chained from the checksum of the history
+    before the message. Has to match DolphinCompletionProvider's.
+    """
+    data = json.dumps([checksum, message["role"], message["content"]], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+class Conversation:
+    """
+    The rendered messages of a conversation, and the checksum of each of its
+    prefixes, so a turn only renders and hashes the new messages.
+    """
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.checksums = [""]
+
+    def matches(self, prefix_length: int, prefix_checksum: Optional[str]) -> bool:
+        return prefix_length < len(self.checksums) and self.checksums[prefix_length] == prefix_checksum
+
+    def truncate(self, length: int):
+        del self.lines[length:]
+        del self.checksums[length + 1 :]
+
+    def append(self, message: dict):
+        self.lines.append(f"{role_to_name(message['role'], model_config)} {message['content']}")
+        self.checksums.append(message_checksum(self.checksums[-1], message))
+
+    def prompt(self) -> str:
+        return "\n".join(self.lines) + f"\n{model_config['assistant_prompt']}"
+
+class Conversations:
+    """
+    The conversations clients continue by sending only their new messages. The
+    least recently used ones are dropped beyond `size`, and their clients send
+    the whole conversation again.
+    """
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self.lock = Lock()
+        self.conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        conversation = self.conversations.get(conversation_id)
+        if conversation is not None:
+            self.conversations.move_to_end(conversation_id)
+        return conversation
+
+    def new(self, conversation_id: str) -> Conversation:
+        conversation = self.conversations[conversation_id] = Conversation()
+        self.conversations.move_to_end(conversation_id)
+        while len(self.conversations) > self.size:
+            self.conversations.popitem(last=False)
+        return conversation
+
+    def __len__(self) -> int:
+        return len(self.conversations)
+
+class StateCache:
+    """
+    The llama states, KV cache included, after the last turn of each
+    conversation. Restoring one only leaves the new messages to evaluate. The
+    least recently used states are dropped beyond the memory budget.
+    """
+
+    def __init__(self, budget_mb: int):
+        self.budget = budget_mb * 2**20
+        self.size = 0
+        self.lock = Lock()
+        self.states: OrderedDict = OrderedDict()
+
+    def get(self, conversation_id: str):
+        with self.lock:
+            state = self.states.get(conversation_id)
+            if state is not None:
+                self.states.move_to_end(conversation_id)
+            return state
+
+    @staticmethod
+    def state_size(state) -> int:
+        # Besides the llama state, a LlamaState holds copies of the input ids and
+        # the logits as numpy arrays
+        return state.llama_state_size + sum(
+            getattr(array, "nbytes", 0)
+            for array in (getattr(state, "input_ids", None), getattr(state, "scores", None))
+        )
+
+    def put(self, conversation_id: str, state):
+        size = self.state_size(state)
+        with self.lock:
+            if (old := self.states.pop(conversation_id, None)) is not None:
+                self.size -= self.state_size(old)
+            if size > self.budget:
+                return
+            self.states[conversation_id] = state
+            self.size += size
+            while self.size > self.budget:
+                _, evicted = self.states.popitem(last=False)
+                self.size -= self.state_size(evicted)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"states": len(self.states), "size_mb": round(self.size / 2**20, 1)}
+
+def run_conversation(llm, states: StateCache, conversation_id: Optional[str], texts: Iterator[str]) -> Iterator[str]:
+    """
+    Run a completion in the llama state of its conversation, and save the state
+    for the next turn once the completion finished. Conversations bypass the
+    llama_cpp prompt cache, which is left to the other completions.
+    """
+    if conversation_id is None:
+        yield from texts
+        return
+    # The saved state already holds the KV cache, the prompt cache would save
+    # another copy of it after every turn
+    cache, llm.cache = llm.cache, None
+    try:
+        if (state := states.get(conversation_id)) is not None:
+            llm.load_state(state)
+        yield from texts
+        states.put(conversation_id, llm.save_state())
+    finally:
+        llm.cache = cache
+
+DONE = object()
+
+class Job:
+    """
+    A completion waiting for, or running on, a model slot. The worker puts the
+    generated text into `output`, followed by DONE.
+    """
+
+    def __init__(self, prompt: str, args: dict, conversation_id: Optional[str] = None):
+        self.prompt = prompt
+        self.args = args
+        self.conversation_id = conversation_id
+        self.output: "queue.Queue" = queue.Queue()
+        self.cancelled = Event()
+        self.enqueued_at = time.monotonic()
+        # Filled in by stream_completion
+        self.result: dict = {}
+        # Set by a ReplicaPool to tell the worker process
+        self.on_cancel: Optional[Callable[[], None]] = None
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+    def texts(self) -> Iterator[str]:
+        while (item := self.output.get()) is not DONE:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+class Dispatcher:
+    """
+    The request counts and timings shared by Scheduler and ReplicaPool.
+    """
+
+    def __init__(self, max_queue: int):
+        self.max_queue = max_queue
+        self.lock = Lock()
+        self.started_at = time.monotonic()
+        self.counts = {
+            "active": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "rejected": 0,
+            "failed": 0,
+            "generated_tokens": 0,
+        }
+        self.total_wait = 0.0
+
+    def _count(self, name: str, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def _started(self, job: Job):
+        with self.lock:
+            self.counts["active"] += 1
+            self.total_wait += time.monotonic() - job.enqueued_at
+
+    def _stats(self, queued: int) -> dict:
+        with self.lock:
+            counts = dict(self.counts)
+            total_wait = self.total_wait
+        elapsed = time.monotonic() - self.started_at
+        started = counts["completed"] + counts["cancelled"] + counts["failed"]
+        return {
+            **counts,
+            "queued": queued,
+            "max_queue": self.max_queue,
+            "mean_wait_seconds": total_wait / started if started else 0.0,
+            "tokens_per_second": counts["generated_tokens"] / elapsed,
+        }
+
+class Scheduler(Dispatcher):
+    """
+    Runs completions from a bounded FIFO queue on `slots` model instances. The
+    instances mmap the same weights, so only the KV caches take extra memory,
+    and llama_cpp releases the GIL while evaluating, so the slots decode in
+    parallel. Jobs that don't fit in the queue are rejected instead of piling up.
+    """
+
+    def __init__(self, model_config, slots: int = 1, max_queue: int = 16, state_cache_mb: int = 0):
+        super().__init__(max_queue)
+        self.model_config = model_config
+        self.slots = slots
+        self.jobs: "queue.Queue[Job]" = queue.Queue(maxsize=max_queue)
+        # The slots load the same model, so any of them can continue a conversation
+        self.states = StateCache(state_cache_mb)
+
+    def start(self):
+        cache_mb = self.model_config.get("prompt_cache_mb", 0) // self.slots
+        # llama_cpp gives every instance half of the CPUs, unless the config says
+        # otherwise, so the slots split them instead of oversubscribing the cores
+        cpus = os.cpu_count() or 1
+        model_config = dict(self.model_config)
+        for key, threads in (("n_threads", cpus // 2), ("n_threads_batch", cpus)):
+            if model_config.get(key) is None:
+                model_config[key] = max(threads // self.slots, 1)
+        for i in range(self.slots):
+            llm = load_llm(model_config, cache_mb)
+            Thread(target=self._work, args=(llm,), name=f"slot-{i}", daemon=True).start()
+
+    def submit(self, job: Job) -> bool:
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            self._count("rejected")
+            return False
+        return True
+
+    def _work(self, llm):
+        while True:
+            job = self.jobs.get()
+            if job.cancelled.is_set():
+                # The client left while the job was queued
+                self._count("cancelled")
+                continue
+            self._started(job)
+            try:
+                self._run(llm, job)
+            except Exception as e:
+                self._count("failed")
+                job.output.put(e)
+            finally:
+                job.output.put(DONE)
+                self._count("active", -1)
+
+    def _run(self, llm, job: Job):
+        texts = stream_completion(llm, self.model_config, job.prompt, job.args, job.result)
+        for text in run_conversation(llm, self.states, job.conversation_id, texts):
+            if job.cancelled.is_set():
+                self._count("cancelled")
+                return
+            self._count("generated_tokens")
+            job.output.put(text)
+        self._count("completed")
+
+    def stats(self) -> dict:
+        return {
+            **self._stats(self.jobs.qsize()),
+            "slots": self.slots,
+            "conversation_states": self.states.stats(),
+        }
+
+def parse_cpu_list(cpus: str) -> List[int]:
+    """
+    Parse a CPU list like "0-3,8,10-11", as in /sys/devices/system/node/*/cpulist.
+    """
+    result = []
+    for part in cpus.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        result.extend(range(int(first), int(last or first) + 1))
+    return result
+
+def numa_cpu_sets() -> List[List[int]]:
+    """
+    The CPUs of each NUMA node, or no sets when the host doesn't report them.
+    """
+    nodes = glob.glob("/sys/devices/system/node/node[0-9]*")
+    sets = []
+    for node in sorted(nodes, key=lambda node: int(node.rsplit("node", 1)[1])):
+        with open(os.path.join(node, "cpulist")) as f:
+            cpus = parse_cpu_list(f.read())
+        if cpus:
+            sets.append(cpus)
+    return sets
+
+def assign_cpu_sets(cpu_sets: List[List[int]], workers: int) -> List[Optional[List[int]]]:
+    """
+    Spread the workers over the CPU sets round-robin. Workers sharing a set split
+    its CPUs, so their threads don't compete for the same cores.
+    """
+    if not cpu_sets:
+        return [None] * workers
+    assigned: List[Optional[List[int]]] = [None] * workers
+    for i, cpus in enumerate(cpu_sets):
+        sharing = list(range(i, workers, len(cpu_sets)))
+        for j, worker in enumerate(sharing):
+            part = cpus[j * len(cpus) // len(sharing) : (j + 1) * len(cpus) // len(sharing)]
+            assigned[worker] = part or cpus
+    return assigned
+
+def replica_main(requests, events, model_config, cpus: Optional[List[int]], state_cache_mb: int):
+    """
+    The worker process of a replica. Jobs arrive as
+    ("job", id, prompt, args, conversation_id) and ("cancel", id) messages on
+    `requests`, and the worker answers with ("ready",), ("start", id),
+    ("text", id, text), ("error", id, message) and ("done", id, result) on
+    `events`.
+    """
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+        # One thread per pinned CPU, unless the config says otherwise
+        model_config = {
+            "n_threads": len(cpus),
+            "n_threads_batch": len(cpus),
+            **model_config,
+        }
+
+    jobs: "queue.Queue" = queue.Queue()
+    cancelled = set()
+
+    def receive():
+        while True:
+            try:
+                message = requests.recv()
+            except (EOFError, OSError):
+                # The front-end exited
+                jobs.put(None)
+                return
+            if message[0] == "cancel":
+                cancelled.add(message[1])
+            else:
+                jobs.put(message[1:])
+
+    # Started before loading, so the front-end never blocks on a full pipe
+    Thread(target=receive, daemon=True).start()
+    llm = load_llm(model_config, model_config.get("prompt_cache_mb", 0))
+    states = StateCache(state_cache_mb)
+    events.send(("ready",))
+
+    while (item := jobs.get()) is not None:
+        job_id, prompt, args, conversation_id = item
+        result = {}
+        if job_id not in cancelled:
+            events.send(("start", job_id))
+            try:
+                texts = stream_completion(llm, model_config, prompt, args, result)
+                for text in run_conversation(llm, states, conversation_id, texts):
+                    if job_id in cancelled:
+                        break
+                    events.send(("text", job_id, text))
+            except Exception as e:
+                events.send(("error", job_id, str(e)))
+        cancelled.discard(job_id)
+        events.send(("done", job_id, result))
+
+class Replica:
+    def __init__(self, index: int, cpus: Optional[List[int]]):
+        self.index = index
+        self.cpus = cpus
+        self.process = None
+        self.requests = None
+        self.ready = Event()
+        self.alive = False
+        self.restarts = 0
+        # The jobs sent to the worker, and the tokens each may still generate
+        self.jobs: Dict[int, Job] = {}
+        self.outstanding: Dict[int, int] = {}
+
+    def outstanding_tokens(self) -> int:
+        return sum(self.outstanding.values())
+
+class ReplicaPool(Dispatcher):
+    """
+    Runs completions on worker processes that each load a replica of the model.
+    The replicas mmap the same GGUF file, so the weights are shared through the
+    page cache, and each worker can be pinned to a CPU set such as a NUMA node.
+    A job goes to the worker with the fewest outstanding tokens, the estimated
+    prompt and maximum completion tokens of the jobs sent to it, less the tokens
+    already generated. Workers that exit are restarted, and their jobs fail.
+    """
+
+    # Seconds to wait before restarting a worker, so a worker that can't load the
+    # model doesn't restart in a busy loop
+    RESTART_DELAY = 1.0
+
+    def __init__(
+        self,
+        model_config,
+        cpu_sets: List[Optional[List[int]]],
+        max_queue: int = 16,
+        state_cache_mb: int = 0,
+    ):
+        super().__init__(max_queue)
+        self.model_config = model_config
+        self.replicas = [Replica(i, cpus) for i, cpus in enumerate(cpu_sets)]
+        # Each worker keeps the states of the conversations it ran
+        self.state_cache_mb = state_cache_mb // max(len(self.replicas), 1)
+        # The worker holding the state of each conversation
+        self.affinity: "OrderedDict[str, Replica]" = OrderedDict()
+        self.ids = itertools.count()
+        self.context = multiprocessing.get_context("spawn")
+
+    def start(self, preload: bool = False):
+        for replica in self.replicas:
+            self._spawn(replica)
+        if preload:
+            for replica in self.replicas:
+                replica.ready.wait()
+
+    def _spawn(self, replica: Replica):
+        requests_recv, requests_send = self.context.Pipe(duplex=False)
+        events_recv, events_send = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=replica_main,
+            args=(
+                requests_recv,
+                events_send,
+                self.model_config,
+                replica.cpus,
+                self.state_cache_mb,
+            ),
+            name=f"replica-{replica.index}",
+            daemon=True,
+        )
+        process.start()
+        # Only the worker holds these now, so the pipes break when it exits
+        requests_recv.close()
+        events_send.close()
+        with self.lock:
+            replica.process = process
+            replica.requests = requests_send
+            replica.ready.clear()
+            replica.alive = True
+        Thread(target=self._listen, args=(replica, events_recv), daemon=True).start()
+
+    def _listen(self, replica: Replica, events):
+        # The jobs of this worker that started, and the ones that failed
+        started = set()
+        failed = set()
+        while True:
+            try:
+                kind, *message = events.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "ready":
+                replica.ready.set()
+                continue
+            job_id = message[0]
+            with self.lock:
+                job = replica.jobs.get(job_id)
+            if job is None:
+                continue
+            if kind == "start":
+                started.add(job_id)
+                self._started(job)
+            elif kind == "text":
+                with self.lock:
+                    self.counts["generated_tokens"] += 1
+                    replica.outstanding[job_id] = max(replica.outstanding[job_id] - 1, 0)
+                job.output.put(message[1])
+            elif kind == "error":
+                failed.add(job_id)
+                job.output.put(RuntimeError(message[1]))
+            elif kind == "done":
+                job.result.update(message[1])
+                with self.lock:
+                    del replica.jobs[job_id]
+                    del replica.outstanding[job_id]
+                    if job_id in started:
+                        started.discard(job_id)
+                        self.counts["active"] -= 1
+                    if job_id in failed:
+                        failed.discard(job_id)
+                        self.counts["failed"] += 1
+                    elif job.cancelled.is_set():
+                        self.counts["cancelled"] += 1
+                    else:
+                        self.counts["completed"] += 1
+                job.output.put(DONE)
+
+        replica.process.join()
+        print(
+            f"Replica {replica.index} exited with code {replica.process.exitcode}, restarting it."
+        )
+        with self.lock:
+            replica.alive = False
+            jobs = replica.jobs
+            replica.jobs = {}
+            replica.outstanding = {}
+            self.counts["active"] -= len(started)
+        for job in jobs.values():
+            self._count("failed")
+            job.output.put(RuntimeError("The model worker crashed."))
+            job.output.put(DONE)
+
+        time.sleep(self.RESTART_DELAY)
+        replica.restarts += 1
+        self._spawn(replica)
+
+    def submit(self, job: Job) -> bool:
+        # About 4 characters per token
+        cost = len(job.prompt) // 4 + self.model_config.get("max_tokens", 1024)
+        with self.lock:
+            sent = sum(len(replica.jobs) for replica in self.replicas)
+            alive = [replica for replica in self.replicas if replica.alive]
+            if not alive or sent >= len(self.replicas) + self.max_queue:
+                self.counts["rejected"] += 1
+                return False
+            # Workers still loading the model only get jobs when none is ready
+            candidates = [replica for replica in alive if replica.ready.is_set()] or alive
+            replica = min(candidates, key=Replica.outstanding_tokens)
+            # The worker that ran the conversation before only evaluates the new
+            # messages, so it is worth waiting for up to the cost of the job
+            previous = self.affinity.get(job.conversation_id)
+            if (
+                previous in candidates
+                and previous.outstanding_tokens() <= replica.outstanding_tokens() + cost
+            ):
+                replica = previous
+            if job.conversation_id is not None:
+                self.affinity[job.conversation_id] = replica
+                self.affinity.move_to_end(job.conversation_id)
+                while len(self.affinity) > conversations.size:
+                    self.affinity.popitem(last=False)
+            job_id = next(self.ids)
+            try:
+                replica.requests.send(
+                    ("job", job_id, job.prompt, job.args, job.conversation_id)
+                )
+            except OSError:
+                # The worker just exited, its listener restarts it
+                self.counts["rejected"] += 1
+                return False
+            replica.jobs[job_id] = job
+            replica.outstanding[job_id] = cost
+        job.on_cancel = lambda: self._cancel(replica, job_id)
+        return True
+
+    def _cancel(self, replica: Replica, job_id: int):
+        with self.lock:
+            if job_id not in replica.jobs:
+                return
+            try:
+                replica.requests.send(("cancel", job_id))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            queued = sum(max(len(replica.jobs) - 1, 0) for replica in self.replicas)
+            replicas = [
+                {
+                    "pid": replica.process.pid if replica.process else None,
+                    "cpus": replica.cpus,
+                    "ready": replica.ready.is_set(),
+                    "jobs": len(replica.jobs),
+                    "outstanding_tokens": replica.outstanding_tokens(),
+                    "restarts": replica.restarts,
+                }
+                for replica in self.replicas
+            ]
+        return {**self._stats(queued), "replicas": replicas}
+
+scheduler: Optional[Dispatcher] = None
+
+conversations = Conversations()
+
+def add_reply(conversation_id: str, checksum: str, text: str):
+    """
+    Add a finished reply to its conversation, unless another request changed the
+    conversation in the meantime.
+    """
+    with conversations.lock:
+        conversation = conversations.get(conversation_id)
+        if conversation is not None and conversation.checksums[-1] == checksum:
+            conversation.append({"role": "assistant", "content": text})
+
 @app.route("/complete", methods=["POST"])
 def complete():
+    """
+    Complete a conversation. With a `conversation_id`, the server keeps the
+    conversation, and the client only sends the messages after the first
+    `prefix_length`, whose checksum is `prefix_checksum`. The server answers 409
+    when it doesn't have that prefix, and the client sends all messages again.
+    """
     data = request.get_json()
     messages = data.get("messages", [])
     stream = data.get("stream", False)
 
-
-    llm = get_llm(model_config)
-    prompt = make_prompt(messages, model_config)
-
     extra_args = {}
     if "temperature" in data:
         extra_args["temperature"] = data["temperature"]
     if "top_p" in data:
         extra_args["top_p"] = data["top_p"]
 
+    conversation_id = data.get("conversation_id")
+    headers = {}
+    if conversation_id is None:
+        prompt = make_prompt(messages, model_config)
+    else:
+        prefix_length = data.get("prefix_length", 0)
+        with conversations.lock:
+            conversation = conversations.get(conversation_id)
+            if prefix_length == 0:
+                conversation = conversations.new(conversation_id)
+            elif conversation is None or not conversation.matches(
+                prefix_length, data.get("prefix_checksum")
+            ):
+                return jsonify({"error": "Unknown conversation prefix, send all messages."}), 409
+            # Also drops a reply the client discarded, as with :rerun
+            conversation.truncate(prefix_length)
+            for message in messages:
+                conversation.append(message)
+            prompt = conversation.prompt()
+            checksum = conversation.checksums[-1]
+        headers["X-Conversation-Id"] = conversation_id
+
+    job = Job(prompt, extra_args, conversation_id)
+    if not scheduler.submit(job):
+        return jsonify({"error": "The server is busy, try again later."}), 429, {"Retry-After": "1"}
+
     if stream:
         def generate():
-            gen = llm.create_completion(
-                prompt,
-                max_tokens=1024,
-                stop=model_config["human_prompt"],
-                stream=True,
-                echo=False,
-                **extra_args,
-            )
-            for x in cast(Iterator[CompletionChunk], gen):
-                yield x["choices"][0]["text"]
-
-        return Response(generate(), mimetype="text/plain")
+            texts = []
+            try:
+                for text in job.texts():
+                    texts.append(text)
+                    yield text
+                if conversation_id is not None:
+                    add_reply(conversation_id, checksum, "".join(texts))
+            finally:
+                # Also runs when the client disconnects and the response is closed
+                job.cancel()
+
+        return Response(generate(), mimetype="text/plain; charset=utf-8", headers=headers)
     else:
-        gen = llm.create_completion(
-            prompt,
-            max_tokens=1024,
-            stop=model_config["human_prompt"],
-            stream=False,
-            echo=False,
-            **extra_args,
+        try:
+            completion = "".join(job.texts())
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        if conversation_id is not None:
+            add_reply(conversation_id, checksum, completion)
+        return jsonify({"completion": completion}), 200, headers
+
+def openai_error(message: str, type: str, status: int, headers: dict = {}):
+    return jsonify({"error": {"message": message, "type": type, "code": None}}), status, headers
+
+def openai_usage(result: dict) -> dict:
+    prompt_tokens = result.get("prompt_tokens", 0)
+    completion_tokens = result.get("completion_tokens", 0)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+def sse(data) -> str:
+    # json.dumps escapes non-ASCII, so an event never ends inside a UTF-8 sequence
+    return f"data: {json.dumps(data)}\n\n"
+
+@app.route("/v1/chat/completions", methods=["POST"])
+def chat_completions():
+    """
+    The OpenAI chat completions API, so OpenAI clients can use the model. The
+    `model` in the request is only echoed back.
+    """
+    data = request.get_json()
+    try:
+        prompt = make_prompt(data["messages"], model_config)
+    except (KeyError, TypeError, ValueError) as e:
+        return openai_error(f"Invalid messages: {e}", "invalid_request_error", 400)
+    stream = data.get("stream", False)
+    include_usage = stream and (data.get("stream_options") or {}).get("include_usage", False)
+
+    extra_args = {}
+    for key in ("temperature", "top_p", "max_tokens"):
+        if data.get(key) is not None:
+            extra_args[key] = data[key]
+    if data.get("stop"):
+        stop = data["stop"]
+        extra_args["stop"] = [stop] if isinstance(stop, str) else stop
+
+    job = Job(prompt, extra_args)
+    if not scheduler.submit(job):
+        return openai_error(
+            "The server is busy, try again later.", "rate_limit_error", 429, {"Retry-After": "1"}
+        )
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    model = data.get("model", "llama")
+
+    def chunk(delta: dict, finish_reason: Optional[str] = None) -> dict:
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    if stream:
+        def generate():
+            try:
+                yield sse(chunk({"role": "assistant", "content": ""}))
+                try:
+                    for text in job.texts():
+                        yield sse(chunk({"content": text}))
+                except Exception as e:
+                    # OpenAI clients raise an APIError for an event with an error
+                    yield sse({"error": {"message": str(e), "type": "server_error"}})
+                    return
+                yield sse(chunk({}, job.result.get("finish_reason", "stop")))
+                if include_usage:
+                    yield sse(
+                        {
+                            "id": completion_id,
+                            "object": "chat.completion.chunk",
+                            "created": created,
+                            "model": model,
+                            "choices": [],
+                            "usage": openai_usage(job.result),
+                        }
+                    )
+                yield "data: [DONE]\n\n"
+            finally:
+                job.cancel()
+
+        return Response(
+            generate(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+    else:
+        try:
+            completion = "".join(job.texts())
+        except Exception as e:
+            return openai_error(str(e), "server_error", 500)
+        return jsonify(
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": completion},
+                        "finish_reason": job.result.get("finish_reason", "stop"),
+                    }
+                ],
+                "usage": openai_usage(job.result),
+            }
         )
-        completion = cast(Completion, gen)["choices"][0]["text"]
-        return jsonify({"completion": completion})
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({**scheduler.stats(), "conversations": len(conversations)})
 
 class suppress_stderr(object):
     def __enter__(self):
@@ -138,7 +916,72 @@ class suppress_stderr(object):
         self.errnull_file.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a llama.cpp model over HTTP.")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=6101)
+    parser.add_argument(
+        "--slots",
+        type=int,
+        default=1,
+        help="The number of model instances serving requests in parallel. Each one uses n_threads threads.",
+    )
+    parser.add_argument(
+        "--max_queue",
+        type=int,
+        default=16,
+        help="The number of requests waiting for a slot before new ones are rejected with 429.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Run the model in this many worker processes instead of slots in this process. \
+Requests go to the worker with the fewest outstanding tokens, and workers that crash are restarted.",
+    )
+    parser.add_argument(
+        "--cpu_sets",
+        type=str,
+        default=None,
+        help="Pin the workers to these CPU sets, separated by semicolons, e.g. '0-15;16-31'.",
+    )
+    parser.add_argument(
+        "--numa",
+        action="store_true",
+        default=False,
+        help="Pin the workers to the CPUs of the NUMA nodes, round-robin.",
+    )
+    parser.add_argument(
+        "--conversation_cache_mb",
+        type=int,
+        default=2048,
+        help="Memory for the llama states of conversations, so a turn only evaluates the new messages.",
+    )
+    parser.add_argument(
+        "--preload",
+        action="store_true",
+        default=False,
+        help="Wait until every worker loaded the model before accepting requests.",
+    )
+    args = parser.parse_args()
+
     print("Loading Model")
-    get_llm(model_config)
-    #app.run(port=6101)
-    app.run(host='0.0.0.0', port=6101)                                                          
+    if args.workers > 0:
+        if args.cpu_sets:
+            cpu_sets = [parse_cpu_list(cpus) for cpus in args.cpu_sets.split(";")]
+        elif args.numa:
+            cpu_sets = numa_cpu_sets()
+        else:
+            cpu_sets = []
+        scheduler = ReplicaPool(
+            model_config,
+            assign_cpu_sets(cpu_sets, args.workers),
+            args.max_queue,
+            args.conversation_cache_mb,
+        )
+        scheduler.start(preload=args.preload)
+    else:
+        scheduler = Scheduler(
+            model_config, args.slots, args.max_queue, args.conversation_cache_mb
+        )
+        scheduler.start()
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,144 @@
+import asyncio
+import io
+import json
+from unittest import mock
+
+import pytest
+
+from gptcli.batch import (
+    BatchInputError,
+    parse_line,
+    read_completed_ids,
+    run_batch_async,
+)
+from gptcli.completion import (
+    BadRequestError,
+    CompletionError,
+    MessageDeltaEvent,
+    UsageEvent,
+)
+
+system_message = {"role": "system", "content": "system message"}
+
+
+def setup_assistant_mock(complete):
+    assistant_mock = mock.MagicMock()
+    assistant_mock.init_messages.side_effect = lambda: [system_message]
+    assistant_mock.supported_overrides.return_value = ["model", "temperature", "top_p"]
+    assistant_mock.acomplete_chat.side_effect = complete
+    return assistant_mock
+
+
+def run(assistant, lines, completed_ids=set(), concurrency=2, retries=0):
+    input_file = io.StringIO("".join(json.dumps(line) + "\n" for line in lines))
+    output_file = io.StringIO()
+    summary = asyncio.run(
+        run_batch_async(
+            assistant, input_file, output_file, concurrency, retries, completed_ids
+        )
+    )
+    results = [json.loads(line) for line in output_file.getvalue().splitlines()]
+    return summary, {result["id"]: result for result in results}
+
+
+def test_batch():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def complete(messages, override_params, stream):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        yield MessageDeltaEvent(f"echo: {messages[-1]['content']}")
+        yield UsageEvent(prompt_tokens=2, completion_tokens=3, total_tokens=5, cost=0.5)
+
+    assistant = setup_assistant_mock(complete)
+    summary, results = run(
+        assistant,
+        [
+            {"prompt": "a"},
+            {"id": "b", "messages": [{"role": "user", "content": "b"}]},
+            {"prompt": "c", "model": "gpt-4"},
+            {"prompt": "d"},
+        ],
+    )
+
+    assert max_in_flight == 2
+    assert summary.completed == 4
+    assert summary.cost == 2.0
+    assert results[0]["response"] == "echo: a"
+    assert results["b"]["response"] == "echo: b"
+    assert results[0]["usage"]["total_tokens"] == 5
+    assistant.acomplete_chat.assert_any_call(
+        [system_message, {"role": "user", "content": "c"}],
+        override_params={"model": "gpt-4"},
+        stream=False,
+    )
+
+
+def test_parse_line_keeps_own_system_message():
+    assistant = setup_assistant_mock(None)
+    own_system = {"role": "system", "content": "own system message"}
+    user = {"role": "user", "content": "a"}
+
+    item = parse_line(assistant, 1, json.dumps({"messages": [own_system, user]}))
+    assert item.messages == [own_system, user]
+
+    item = parse_line(assistant, 2, json.dumps({"messages": [user]}))
+    assert item.messages == [system_message, user]
+
+
+@pytest.mark.parametrize("line", ["42", "[]", '"prompt"', "null"])
+def test_parse_line_rejects_non_objects(line):
+    with pytest.raises(BatchInputError, match="Line 3: expected a JSON object"):
+        parse_line(setup_assistant_mock(None), 3, line)
+
+
+def test_batch_retries():
+    attempts = {}
+
+    async def complete(messages, override_params, stream):
+        prompt = messages[-1]["content"]
+        attempts[prompt] = attempts.get(prompt, 0) + 1
+        if prompt == "bad":
+            raise BadRequestError("bad request")
+        if attempts[prompt] < 2:
+            raise CompletionError("try again")
+        yield MessageDeltaEvent("ok")
+
+    with mock.patch("gptcli.batch.RETRY_BACKOFF_SECONDS", 0):
+        summary, results = run(
+            setup_assistant_mock(complete), [{"prompt": "flaky"}, {"prompt": "bad"}], retries=2
+        )
+
+    assert results[0]["response"] == "ok"
+    assert results[0]["attempts"] == 2
+    assert results[1]["error"] == "bad request"
+    assert attempts["bad"] == 1
+    assert (summary.completed, summary.failed) == (1, 1)
+
+
+def test_batch_resume(tmp_path):
+    out = tmp_path / "out.jsonl"
+    out.write_text(
+        json.dumps({"id": 0, "response": "done", "error": None})
+        + "\n"
+        + json.dumps({"id": 1, "response": None, "error": "failed"})
+        + "\n"
+        + '{"id": 2, "resp'
+    )
+    completed_ids = read_completed_ids(str(out))
+    assert completed_ids == {0}
+
+    async def complete(messages, override_params, stream):
+        yield MessageDeltaEvent("ok")
+
+    summary, results = run(
+        setup_assistant_mock(complete),
+        [{"prompt": "a"}, {"prompt": "b"}, {"prompt": "c"}],
+        completed_ids=completed_ids,
+    )
+    assert summary.skipped == 1
+    assert sorted(results) == [1, 2]
@@ -0,0 +1,131 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from gptcli.cache import CachedProvider, ResponseCache, cache_key
+from gptcli.completion import CompletionProvider, MessageDeltaEvent, UsageEvent
+
+messages = [{"role": "user", "content": "hello"}]
+args = {"model": "gpt-4o", "temperature": 0.0, "top_p": 1.0}
+usage = UsageEvent(prompt_tokens=1, completion_tokens=2, total_tokens=3, cost=0.5)
+# Hits report the tokens of the original response, but cost nothing
+free = UsageEvent(prompt_tokens=1, completion_tokens=2, total_tokens=3, cost=0.0)
+
+
+class FakeProvider(CompletionProvider):
+    def __init__(self, chunks=("Hel", "lo")):
+        self.chunks = chunks
+        self.calls = 0
+
+    def complete(self, messages, args, stream=False):
+        self.calls += 1
+        for chunk in self.chunks:
+            yield MessageDeltaEvent(chunk)
+        yield usage
+
+
+def test_cache_key_is_canonical():
+    assert cache_key(messages, args) == cache_key(
+        [{"content": "hello", "role": "user"}],
+        {"top_p": 1, "temperature": 0, "model": "gpt-4o"},
+    )
+    assert cache_key(messages, args) != cache_key(messages, {**args, "top_p": 0.9})
+    assert cache_key(messages, args) != cache_key(messages, args, tools=[{"x": 1}])
+
+
+def test_hits_replay_the_stream():
+    cache = ResponseCache(":memory:")
+    provider = FakeProvider()
+    cached = CachedProvider(provider, cache)
+
+    expected = [MessageDeltaEvent("Hel"), MessageDeltaEvent("lo"), usage]
+    assert list(cached.complete(messages, args, stream=True)) == expected
+    assert list(cached.complete(messages, args, stream=True)) == [*expected[:2], free]
+    assert list(cached.complete(messages, args, stream=False)) == [
+        MessageDeltaEvent("Hello"),
+        free,
+    ]
+    assert provider.calls == 1
+    assert (cache.stats.hits, cache.stats.misses) == (2, 1)
+    assert cache.total_stats().hit_rate == pytest.approx(2 / 3)
+
+
+def test_only_complete_deterministic_responses_are_cached():
+    cache = ResponseCache(":memory:")
+    provider = FakeProvider()
+    cached = CachedProvider(provider, cache)
+
+    # Sampled responses aren't cached
+    hot = {**args, "temperature": 0.7}
+    list(cached.complete(messages, hot))
+    list(cached.complete(messages, hot))
+    assert provider.calls == 2
+
+    # Neither are interrupted ones
+    events = cached.complete(messages, args, stream=True)
+    next(events)
+    events.close()
+    list(cached.complete(messages, args))
+    list(cached.complete(messages, args))
+    assert provider.calls == 4
+
+
+def test_ttl_and_lru_eviction():
+    cache = ResponseCache(":memory:", ttl=60)
+    provider = FakeProvider()
+    cached = CachedProvider(provider, cache)
+
+    with mock.patch("gptcli.cache.time.time", return_value=1000.0):
+        list(cached.complete(messages, args))
+    with mock.patch("gptcli.cache.time.time", return_value=1100.0):
+        list(cached.complete(messages, args))
+    assert provider.calls == 2
+
+    cache = ResponseCache(":memory:")
+    cache.max_size = 400
+    provider = FakeProvider(chunks=("x" * 50,))
+    cached = CachedProvider(provider, cache)
+    prompts = [[{"role": "user", "content": str(i)}] for i in range(3)]
+    for i, prompt in enumerate(prompts):
+        with mock.patch("gptcli.cache.time.time", return_value=float(i)):
+            list(cached.complete(prompt, args))
+    # Only the two most recently used responses fit
+    assert cache.total_stats().entries == 2
+    with mock.patch("gptcli.cache.time.time", return_value=3.0):
+        assert cache.get(cache_key(prompts[0], args)) is None
+        assert cache.get(cache_key(prompts[2], args)) is not None
+
+
+def test_acomplete_uses_the_cache():
+    cache = ResponseCache(":memory:")
+    provider = FakeProvider()
+    cached = CachedProvider(provider, cache)
+
+    async def collect():
+        return [event async for event in cached.acomplete(messages, args, True)]
+
+    first = asyncio.run(collect())
+    assert asyncio.run(collect()) == [*first[:-1], free]
+    assert provider.calls == 1
+
+
+def test_arguments_the_provider_does_not_take_fail_before_the_lookup():
+    from gptcli.assistant import Assistant
+    from gptcli.similarity import SimilarityCache, SimilarityCachedProvider
+
+    cache = ResponseCache(":memory:")
+    similar = SimilarityCache(":memory:")
+    provider = FakeProvider()
+    cached = CachedProvider(SimilarityCachedProvider(provider, similar, "dev"), cache)
+
+    with pytest.raises(TypeError, match="tools"):
+        cached.complete(messages, args, tools=[{"name": "f"}])
+    assert cache.stats.misses == similar.stats.misses == 0
+
+    # The assistant only passes tools when there are some
+    assistant = Assistant({"model": "gpt-4o", "temperature": 0.0, "top_p": 1.0})
+    with mock.patch.object(assistant, "_completion_provider", return_value=cached):
+        list(assistant.complete_chat(messages, stream=False))
+    assert cache.stats.misses == similar.stats.misses == 1
+    assert cache.total_stats().misses == 1
@@ -0,0 +1,64 @@
+import time
+from unittest import mock
+
+from gptcli.cli import CLIResponseStreamer
+
+
+def setup_streamer(max_fps: float):
+    streamer = CLIResponseStreamer(mock.MagicMock(), markdown=True, max_fps=max_fps)
+    streamer.printer = mock.MagicMock()
+    return streamer
+
+
+def printed(streamer) -> list:
+    return [call.args[0] for call in streamer.printer.print.call_args_list]
+
+
+def test_tokens_are_coalesced():
+    streamer = setup_streamer(max_fps=1)
+    with streamer:
+        for token in ["Hello", ",", " world", "!"]:
+            streamer.on_next_token(token)
+
+    assert printed(streamer) == ["Hello", ", world!"]
+    streamer.printer.__exit__.assert_called_once()
+
+
+def test_newline_flushes():
+    streamer = setup_streamer(max_fps=1)
+    with streamer:
+        for token in ["```", "python", "\nx = 1", "\n```\n", "Done"]:
+            streamer.on_next_token(token)
+
+    assert printed(streamer) == ["```", "python\nx = 1", "\n```\n", "Done"]
+
+
+def test_unlimited_fps():
+    streamer = setup_streamer(max_fps=0)
+    with streamer:
+        for token in [" a", "b", "c"]:
+            streamer.on_next_token(token)
+
+    assert printed(streamer) == ["a", "b", "c"]
+
+
+def test_buffer_flushed_after_interval():
+    streamer = setup_streamer(max_fps=50)
+    with streamer:
+        streamer.on_next_token("a")
+        streamer.on_next_token("b")
+        time.sleep(0.1)
+        assert printed(streamer) == ["a", "b"]
+
+
+def test_flush_on_keyboard_interrupt():
+    streamer = setup_streamer(max_fps=1)
+    try:
+        with streamer:
+            streamer.on_next_token("a")
+            streamer.on_next_token("b")
+            raise KeyboardInterrupt()
+    except KeyboardInterrupt:
+        pass
+
+    assert printed(streamer) == ["a", "b"]
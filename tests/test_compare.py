@@ -0,0 +1,110 @@
+import asyncio
+import time
+from unittest import mock
+
+from gptcli.compare import compare_models, parse_models
+from gptcli.completion import CompletionError, MessageDeltaEvent, UsageEvent
+from gptcli.session import ChatSession
+
+system_message = {"role": "system", "content": "system message"}
+user_message = {"role": "user", "content": "user message"}
+
+DELAYS = {"fast": 0.05, "slow": 0.2}
+
+
+async def complete(messages, override_params, stream, hedge=True):
+    assert not hedge
+    model = override_params["model"]
+    if model == "broken":
+        raise CompletionError("model unavailable")
+    await asyncio.sleep(DELAYS[model])
+    yield MessageDeltaEvent(f"{model} ")
+    yield MessageDeltaEvent("response")
+    yield UsageEvent(prompt_tokens=1, completion_tokens=2, total_tokens=3, cost=0.1)
+
+
+def setup_assistant_mock():
+    assistant_mock = mock.MagicMock()
+    assistant_mock.init_messages.return_value = [system_message]
+    assistant_mock.acomplete_chat.side_effect = complete
+    return assistant_mock
+
+
+def test_parse_models():
+    assert parse_models("gpt-4, claude-3 ,,") == ["gpt-4", "claude-3"]
+    assert parse_models("") == []
+
+
+def test_models_run_concurrently():
+    assistant = setup_assistant_mock()
+    streamer = mock.MagicMock()
+
+    started = time.monotonic()
+    results = compare_models(
+        assistant, [user_message], ["fast", "slow"], {"temperature": 0.5}, streamer
+    )
+    elapsed = time.monotonic() - started
+
+    # Takes as long as the slowest model, not the sum of both
+    assert elapsed < DELAYS["fast"] + DELAYS["slow"]
+    assert [result.model for result in results] == ["fast", "slow"]
+    assert [result.response for result in results] == [
+        "fast response",
+        "slow response",
+    ]
+    assert results[0].time_to_first_token < results[1].time_to_first_token
+    assert all(result.usage.total_tokens == 3 for result in results)
+    assistant.acomplete_chat.assert_any_call(
+        [user_message],
+        override_params={"temperature": 0.5, "model": "slow"},
+        stream=True,
+        hedge=False,
+    )
+
+    streamer.__enter__.assert_called_once()
+    streamer.__exit__.assert_called_once()
+    streamer.on_next_token.assert_any_call("slow", "slow ")
+    assert [call.args[0].model for call in streamer.on_model_done.call_args_list] == [
+        "fast",
+        "slow",
+    ]
+
+
+def test_failing_model_does_not_abort_others():
+    assistant = setup_assistant_mock()
+
+    results = compare_models(
+        assistant, [user_message], ["broken", "fast"], {}, mock.MagicMock()
+    )
+
+    assert results[0].error == "CompletionError: model unavailable"
+    assert results[0].time_to_first_token is None
+    assert results[1].error is None
+    assert results[1].response == "fast response"
+
+
+def test_session_compare_keeps_history():
+    assistant = setup_assistant_mock()
+    assistant.complete_chat.return_value = [MessageDeltaEvent("assistant message")]
+    listener = mock.MagicMock()
+    session = ChatSession(assistant, listener)
+
+    session.process_input("user message", {})
+    messages = list(session.messages)
+
+    assert session.process_input(":compare fast,slow", {})
+    listener.compare_streamer.assert_called_once_with(["fast", "slow"])
+    # The last prompt is re-asked without the response it already got
+    for call in assistant.acomplete_chat.call_args_list:
+        assert call.args[0] == [system_message, user_message]
+    assert session.messages == messages
+
+
+def test_session_compare_without_prompt():
+    assistant = setup_assistant_mock()
+    listener = mock.MagicMock()
+    session = ChatSession(assistant, listener)
+
+    assert session.process_input(":compare fast", {})
+    listener.on_error.assert_called_once()
+    assistant.acomplete_chat.assert_not_called()
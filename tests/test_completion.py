@@ -0,0 +1,71 @@
+import asyncio
+
+from gptcli.completion import (
+    CompletionProvider,
+    MessageDeltaEvent,
+    iterate_async,
+    iterate_sync,
+)
+
+
+class SyncProvider(CompletionProvider):
+    def complete(self, messages, args, stream=False):
+        for token in ["a", "b", "c"]:
+            yield MessageDeltaEvent(token)
+
+
+class AsyncProvider(CompletionProvider):
+    async def acomplete(self, messages, args, stream=False):
+        for token in ["a", "b", "c"]:
+            await asyncio.sleep(0)
+            yield MessageDeltaEvent(token)
+
+
+async def collect(events):
+    return [event.text async for event in events]
+
+
+def test_sync_adapter():
+    events = AsyncProvider().complete([], {"model": "test"}, stream=True)
+    assert [event.text for event in events] == ["a", "b", "c"]
+
+
+def test_async_adapter():
+    events = SyncProvider().acomplete([], {"model": "test"}, stream=True)
+    assert asyncio.run(collect(events)) == ["a", "b", "c"]
+
+
+def test_sync_adapter_closes_stream_early():
+    closed = []
+
+    async def events():
+        try:
+            yield MessageDeltaEvent("a")
+            yield MessageDeltaEvent("b")
+        finally:
+            closed.append(True)
+
+    iterator = iterate_sync(events())
+    assert next(iterator).text == "a"
+    iterator.close()
+    assert closed == [True]
+
+
+def test_async_adapter_closes_stream_early():
+    closed = []
+
+    def events():
+        try:
+            yield MessageDeltaEvent("a")
+            yield MessageDeltaEvent("b")
+        finally:
+            closed.append(True)
+
+    async def first():
+        iterator = iterate_async(events())
+        event = await iterator.__anext__()
+        await iterator.aclose()
+        return event.text
+
+    assert asyncio.run(first()) == "a"
+    assert closed == [True]
@@ -0,0 +1,102 @@
+import threading
+import time
+from unittest import mock
+
+from gptcli.composite import CompositeChatListener, ThreadedChatListener
+from gptcli.session import ChatListener, ChatSession, ResponseStreamer
+
+user_message = {"role": "user", "content": "user message"}
+
+
+class SlowStreamer(ResponseStreamer):
+    def __init__(self, events):
+        self.events = events
+
+    def on_next_token(self, token: str):
+        time.sleep(0.01)
+        self.events.append(("token", token, threading.current_thread()))
+
+    def __exit__(self, *args):
+        self.events.append(("exit", None, threading.current_thread()))
+
+
+class SlowListener(ChatListener):
+    def __init__(self):
+        self.events = []
+
+    def response_streamer(self) -> ResponseStreamer:
+        return SlowStreamer(self.events)
+
+    def on_chat_message(self, message):
+        time.sleep(0.01)
+        self.events.append(("message", message, threading.current_thread()))
+
+    def on_chat_end(self):
+        self.events.append(("end", None, threading.current_thread()))
+
+
+def test_threaded_listener_keeps_order_off_the_caller_thread():
+    slow = SlowListener()
+    listener = ThreadedChatListener(slow)
+
+    started = time.monotonic()
+    listener.on_chat_message(user_message)
+    with listener.response_streamer() as streamer:
+        for token in "abcde":
+            streamer.on_next_token(token)
+    # The caller isn't held up by the slow listener
+    assert time.monotonic() - started < 0.05
+
+    listener.on_chat_end()
+    assert [(kind, value) for kind, value, _ in slow.events] == [
+        ("message", user_message),
+        *[("token", token) for token in "abcde"],
+        ("exit", None),
+        ("end", None),
+    ]
+    assert all(thread is not threading.current_thread() for *_, thread in slow.events)
+
+
+def test_threaded_listener_skips_tokens_nobody_streams():
+    listener = ThreadedChatListener(ChatListener())
+
+    with mock.patch.object(listener.worker, "submit") as submit:
+        with listener.response_streamer() as streamer:
+            for token in "abcde":
+                streamer.on_next_token(token)
+
+    # Only entering and leaving the streamer are queued
+    assert submit.call_count == 2
+    listener.on_chat_end()
+
+
+def test_threaded_listener_survives_listener_errors():
+    inner = mock.MagicMock()
+    inner.on_chat_clear.side_effect = Exception("disk full")
+    listener = ThreadedChatListener(inner)
+
+    listener.on_chat_clear()
+    listener.on_chat_rerun(True)
+    listener.on_chat_end()
+
+    inner.on_chat_rerun.assert_called_once_with(True)
+    # Calls after the end run inline
+    listener.on_chat_rerun(False)
+    inner.on_chat_rerun.assert_called_with(False)
+
+
+def test_session_drains_listeners_on_exit():
+    assistant = mock.MagicMock()
+    assistant.init_messages.return_value = []
+    slow = SlowListener()
+    session = ChatSession(
+        assistant, CompositeChatListener([mock.MagicMock(), ThreadedChatListener(slow)])
+    )
+    input_provider = mock.MagicMock()
+    input_provider.get_user_input.side_effect = [("user message", {}), (":q", {})]
+    assistant.complete_chat.return_value = []
+
+    session.loop(input_provider)
+
+    assert slow.events[0][:2] == ("message", user_message)
+    assert slow.events[-1][0] == "end"
@@ -0,0 +1,158 @@
+from unittest import mock
+
+import pytest
+
+from gptcli import tokens
+from gptcli.assistant import Assistant
+from gptcli.context import ContextTrim, context_window, fit_to_context
+
+
+class FakeEncoding:
+    name = "fake"
+
+    def encode(self, text: str):
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def encoding():
+    tokens._token_cache.clear()
+    with mock.patch("gptcli.context.get_encoding", return_value=FakeEncoding()):
+        yield
+
+
+system = {"role": "system", "content": "system"}
+
+
+def turn(i: int, words: int = 10):
+    return [
+        {"role": "user", "content": " ".join([f"q{i}"] * words)},
+        {"role": "assistant", "content": " ".join([f"a{i}"] * words)},
+    ]
+
+
+def tokens_of(messages):
+    # 4 per message plus the role and the content, 2 for the reply
+    return sum(5 + len(m["content"].split()) for m in messages) + 2
+
+
+def test_context_window():
+    assert context_window("gpt-4") == 8192
+    assert context_window("gpt-4-0613") == 8192
+    assert context_window("gpt-4o-mini") == 128000
+    assert context_window("claude-3-5-sonnet-20240620") == 200000
+    assert context_window("my-local-model") is None
+
+
+def test_fits_unchanged():
+    messages = [system, *turn(0), *turn(1)[:1]]
+    config = {"limit": 1000, "reserve": 100}
+    assert fit_to_context(messages, "model", 1, config) == (messages, None)
+
+
+def test_drops_oldest_turns():
+    messages = [system, *turn(0), *turn(1), *turn(2)[:1]]
+    limit = tokens_of([system, *turn(1), *turn(2)[:1]]) + 10
+
+    trimmed, trim = fit_to_context(
+        messages, "model", 1, {"limit": limit, "reserve": 10}
+    )
+
+    assert trimmed == [system, *turn(1), *turn(2)[:1]]
+    assert trim == ContextTrim(
+        model="model",
+        limit=limit,
+        tokens_before=tokens_of(messages),
+        tokens_after=tokens_of(trimmed),
+        dropped_messages=2,
+        collapsed=False,
+    )
+
+
+def test_keeps_latest_turn_and_system_messages():
+    note = {"role": "system", "content": "note"}
+    messages = [system, *turn(0), note, *turn(1, words=100)[:1]]
+
+    trimmed, trim = fit_to_context(messages, "model", 1, {"limit": 50, "reserve": 0})
+
+    assert trimmed == [system, note, *turn(1, words=100)[:1]]
+    assert trim.tokens_after > 50
+
+
+def test_collapse():
+    messages = [system, *turn(0, words=200), *turn(1)[:1]]
+
+    trimmed, trim = fit_to_context(
+        messages, "model", 1, {"limit": 200, "reserve": 0, "policy": "collapse"}
+    )
+
+    assert trim.collapsed and trim.dropped_messages == 2
+    assert [m["role"] for m in trimmed] == ["system", "user", "assistant", "user"]
+    assert "q0 q0" in trimmed[1]["content"] and "..." in trimmed[1]["content"]
+    assert trimmed[-1] == turn(1)[0]
+    assert trim.tokens_after == tokens_of(trimmed) <= 200
+
+
+def test_policy_off_and_unknown_models():
+    messages = [system, *turn(0, words=100), *turn(1)[:1]]
+    assert fit_to_context(messages, "model", 1, {"limit": 10, "policy": "off"})[1] is None
+    assert fit_to_context(messages, "unknown-model", 1, {})[1] is None
+
+
+def test_assistant_pins_init_messages_and_reports_trim():
+    assistant = Assistant(
+        {
+            "model": "my-model",
+            "messages": [system, *turn(0)],
+            "context": {
+                "limit": tokens_of([system, *turn(0), *turn(2)[:1]]),
+                "reserve": 0,
+            },
+        }
+    )
+    provider = mock.MagicMock()
+    on_trim = mock.MagicMock()
+
+    with mock.patch("gptcli.assistant.get_completion_provider", return_value=provider):
+        assistant.complete_chat(
+            [system, *turn(0), *turn(1), *turn(2)[:1]], on_trim=on_trim
+        )
+
+    assert provider.complete.call_args.args[0] == [system, *turn(0), *turn(2)[:1]]
+    on_trim.assert_called_once()
+    assert on_trim.call_args.args[0].dropped_messages == 2
+
+
+def test_short_prompts_skip_the_tokenizer():
+    messages = [system, *turn(0), *turn(1)[:1]]
+    with mock.patch("gptcli.context.get_encoding") as get_encoding:
+        assert fit_to_context(messages, "gpt-4", 1, {}) == (messages, None)
+    get_encoding.assert_not_called()
+
+
+def test_tokenizer_failure_sends_untrimmed():
+    messages = [system, *turn(0, words=100), *turn(1)[:1]]
+    with mock.patch(
+        "gptcli.context.get_encoding", side_effect=ConnectionError("offline")
+    ):
+        assert fit_to_context(messages, "model", 1, {"limit": 10}) == (
+            messages,
+            None,
+        )
+
+
+def test_reuses_token_counter():
+    messages = [system, *turn(0), *turn(1), *turn(2)[:1]]
+    limit = tokens_of([system, *turn(1), *turn(2)[:1]]) + 10
+    counter = tokens.TokenCounter("model", messages)
+    with mock.patch("gptcli.tokens.get_encoding", return_value=FakeEncoding()):
+        counter.total
+
+    with mock.patch("gptcli.context.count_message_tokens") as count_message_tokens:
+        trimmed, trim = fit_to_context(
+            messages, "model", 1, {"limit": limit, "reserve": 10}, counter
+        )
+
+    count_message_tokens.assert_not_called()
+    assert trimmed == [system, *turn(1), *turn(2)[:1]]
+    assert trim.tokens_before == tokens_of(messages)
@@ -0,0 +1,134 @@
+import io
+import os
+import sys
+import tempfile
+import threading
+from unittest import mock
+
+import pytest
+
+from gptcli.completion import MessageDeltaEvent, UsageEvent
+from gptcli.config import GptCliConfig
+from gptcli.daemon import DaemonServer, run_daemon, run_via_daemon
+from gptcli.gpt import args_error, parse_args
+
+
+@pytest.fixture
+def daemon():
+    assistant_mock = mock.MagicMock()
+    assistant_mock.init_messages.return_value = []
+    init_assistant = mock.MagicMock(return_value=assistant_mock)
+
+    path = os.path.join(tempfile.mkdtemp(), "daemon.sock")
+    server = DaemonServer(
+        path,
+        lambda argv: parse_args(GptCliConfig(), argv),
+        init_assistant,
+        args_error,
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield path, init_assistant, assistant_mock
+    server.shutdown()
+    server.server_close()
+    os.unlink(path)
+
+
+def test_prompt_is_forwarded(daemon, capsys):
+    path, init_assistant, assistant_mock = daemon
+    assistant_mock.complete_chat.side_effect = lambda *args, **kwargs: iter(
+        [
+            MessageDeltaEvent("Hello"),
+            MessageDeltaEvent(", world"),
+            UsageEvent(prompt_tokens=1, completion_tokens=2, total_tokens=3, cost=0.0),
+        ]
+    )
+
+    assert run_via_daemon(["dev", "-p", "hi", "--no_stream"], path)
+    assert capsys.readouterr().out == "Hello, world"
+    assistant_mock.complete_chat.assert_called_once_with(
+        [{"role": "user", "content": "hi"}], stream=False
+    )
+
+    # The assistant is reused for the same arguments
+    assert run_via_daemon(["dev", "-p", "hi again"], path)
+    init_assistant.assert_called_once()
+
+
+def test_stdin_prompt(daemon, capsys, monkeypatch):
+    path, _, assistant_mock = daemon
+    assistant_mock.complete_chat.return_value = iter([MessageDeltaEvent("ok")])
+    monkeypatch.setattr("sys.stdin", io.StringIO("from stdin\n"))
+
+    assert run_via_daemon(["-p", "first", "-p", "-"], path)
+    assistant_mock.complete_chat.assert_called_once_with(
+        [{"role": "user", "content": "first\nfrom stdin\n"}], stream=True
+    )
+
+
+@pytest.mark.parametrize("option", [["--prompt=-"], ["--prompt", "-"], ["-p-"]])
+def test_stdin_prompt_option_forms(daemon, monkeypatch, option):
+    path, _, assistant_mock = daemon
+    assistant_mock.complete_chat.return_value = iter([MessageDeltaEvent("ok")])
+    monkeypatch.setattr("sys.stdin", io.StringIO("from stdin"))
+
+    assert run_via_daemon(option, path)
+    assistant_mock.complete_chat.assert_called_once_with(
+        [{"role": "user", "content": "from stdin"}], stream=True
+    )
+
+
+def test_unread_stdin_prompt_falls_back(daemon, monkeypatch):
+    path, _, assistant_mock = daemon
+    monkeypatch.setattr("sys.stdin", io.StringIO("from stdin"))
+
+    # argparse accepts the abbreviation, the client doesn't recognize it
+    assert not run_via_daemon(["-p", "hi", "--prom", "-"], path)
+    assistant_mock.complete_chat.assert_not_called()
+    assert sys.stdin.read() == "from stdin"
+
+
+def test_fallback(daemon):
+    path, _, assistant_mock = daemon
+
+    # Interactive sessions and invalid arguments run in-process
+    assert not run_via_daemon(["dev"], path)
+    assert not run_via_daemon(["-p", "hi", "--temperature", "hot"], path)
+    assert not run_via_daemon(["-p", "hi", "--no_daemon"], path)
+    assistant_mock.complete_chat.assert_not_called()
+
+
+def test_invalid_argument_combinations_fail(daemon, capsys):
+    path, _, assistant_mock = daemon
+
+    with pytest.raises(SystemExit) as e:
+        run_via_daemon(["-p", "hi", "--batch", "prompts.jsonl"], path)
+
+    assert e.value.code == 1
+    assert "mutually exclusive" in capsys.readouterr().out
+    assistant_mock.complete_chat.assert_not_called()
+
+
+def test_no_daemon_running():
+    path = os.path.join(tempfile.mkdtemp(), "daemon.sock")
+    assert not run_via_daemon(["-p", "hi"], path)
+
+
+def test_socket_is_private(monkeypatch):
+    path = os.path.join(tempfile.mkdtemp(), "daemon.sock")
+    modes = []
+
+    def serve_forever(server):
+        modes.append(os.stat(path).st_mode & 0o777)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(DaemonServer, "serve_forever", serve_forever)
+    umask = os.umask(0o022)
+    try:
+        run_daemon(mock.MagicMock(), mock.MagicMock(), path)
+        assert os.umask(umask) == 0o022
+    finally:
+        os.umask(umask)
+
+    assert modes == [0o600]
+    assert not os.path.exists(path)
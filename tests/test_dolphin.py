@@ -0,0 +1,88 @@
+from unittest import mock
+
+from gptcli.providers import dolphin
+from gptcli.providers.dolphin import Conversations, DolphinCompletionProvider
+
+args = {"model": "dolphin"}
+
+
+class FakeHost:
+    """
+    Answers /complete like llamahost, remembering the message count of each
+    conversation.
+    """
+
+    def __init__(self, conversations=True):
+        self.conversations = conversations
+        self.lengths = {}
+        self.payloads = []
+
+    def post(self, url, json, stream):
+        self.payloads.append(json)
+        response = mock.MagicMock()
+        response.__enter__.return_value = response
+        conversation_id = json["conversation_id"]
+        if not self.conversations:
+            response.headers = {}
+        elif json["prefix_length"] > self.lengths.get(conversation_id, 0):
+            response.status_code = 409
+            return response
+        else:
+            response.headers = {"X-Conversation-Id": conversation_id}
+            self.lengths[conversation_id] = json["prefix_length"] + len(
+                json["messages"]
+            ) + 1
+        response.status_code = 200
+        response.json.return_value = {"completion": f"reply {len(self.payloads)}"}
+        return response
+
+
+def chat(host, turns, conversations=None):
+    provider = DolphinCompletionProvider()
+    messages = [{"role": "system", "content": "You are helpful."}]
+    with mock.patch.object(dolphin, "get_session", return_value=host), mock.patch.object(
+        dolphin, "CONVERSATIONS", conversations or Conversations()
+    ):
+        for turn in range(turns):
+            messages.append({"role": "user", "content": f"question {turn}"})
+            reply = "".join(e.text for e in provider.complete(messages, args))
+            messages.append({"role": "assistant", "content": reply})
+    return messages
+
+
+def test_only_new_messages_are_sent():
+    host = FakeHost()
+    chat(host, 3)
+
+    sent = [(p["prefix_length"], len(p["messages"])) for p in host.payloads]
+    assert sent == [(0, 2), (3, 1), (5, 1)]
+    assert len({p["conversation_id"] for p in host.payloads}) == 1
+
+
+def test_evicted_conversations_are_sent_again():
+    host = FakeHost()
+    conversations = Conversations()
+    chat(host, 1, conversations)
+    # The host forgot the conversation
+    host.lengths.clear()
+    with mock.patch.object(dolphin, "get_session", return_value=host), mock.patch.object(
+        dolphin, "CONVERSATIONS", conversations
+    ):
+        messages = [
+            {"role": "system", "content": "You are helpful."},
+            {"role": "user", "content": "question 0"},
+            {"role": "assistant", "content": "reply 1"},
+            {"role": "user", "content": "question 1"},
+        ]
+        list(DolphinCompletionProvider().complete(messages, args))
+
+    sent = [(p["prefix_length"], len(p["messages"])) for p in host.payloads]
+    assert sent == [(0, 2), (3, 1), (0, 4)]
+
+
+def test_hosts_without_conversations_get_all_messages():
+    host = FakeHost(conversations=False)
+    chat(host, 3)
+
+    sent = [(p["prefix_length"], len(p["messages"])) for p in host.payloads]
+    assert sent == [(0, 2), (0, 4), (0, 6)]
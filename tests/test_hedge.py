@@ -0,0 +1,117 @@
+import asyncio
+import time
+from unittest import mock
+
+import pytest
+
+from gptcli.assistant import Assistant
+from gptcli.completion import CompletionError, MessageDeltaEvent, UsageEvent
+from gptcli.hedge import HedgeStats, hedged_complete
+
+usage = UsageEvent(prompt_tokens=1, completion_tokens=1, total_tokens=2, cost=0.0)
+
+
+def stream(name, first_token_delay, closed=None, error=None):
+    async def events(*args, **kwargs):
+        try:
+            await asyncio.sleep(first_token_delay)
+            if error is not None:
+                raise error
+            yield MessageDeltaEvent(f"{name} ")
+            yield MessageDeltaEvent("response")
+            yield usage
+        finally:
+            if closed is not None:
+                closed.append(name)
+
+    return events
+
+
+def collect(primary, secondary, delay=0.05):
+    stats = HedgeStats()
+
+    async def run():
+        return [
+            event
+            async for event in hedged_complete(primary, secondary, delay, stats)
+        ]
+
+    return asyncio.run(run()), stats
+
+
+def text(events):
+    return "".join(event.text for event in events if event.type == "message_delta")
+
+
+def test_fast_primary_does_not_fire():
+    secondary = mock.MagicMock()
+    events, stats = collect(stream("primary", 0), secondary)
+
+    assert text(events) == "primary response"
+    assert events[-1] == usage
+    secondary.assert_not_called()
+    assert stats == HedgeStats(requests=1, fired=0, primary_wins=1, secondary_wins=0)
+
+
+def test_secondary_wins_and_primary_is_closed():
+    closed = []
+    started = time.monotonic()
+    events, stats = collect(stream("primary", 10, closed), stream("secondary", 0))
+
+    assert text(events) == "secondary response"
+    assert closed == ["primary"]
+    assert time.monotonic() - started < 1
+    assert stats == HedgeStats(requests=1, fired=1, primary_wins=0, secondary_wins=1)
+
+
+def test_primary_wins_after_firing():
+    closed = []
+    events, stats = collect(
+        stream("primary", 0.1), stream("secondary", 10, closed), delay=0.01
+    )
+
+    assert text(events) == "primary response"
+    assert closed == ["secondary"]
+    assert stats == HedgeStats(requests=1, fired=1, primary_wins=1, secondary_wins=0)
+
+
+def test_primary_error_starts_secondary():
+    events, stats = collect(
+        stream("primary", 0, error=CompletionError("overloaded")),
+        stream("secondary", 0),
+        delay=10,
+    )
+
+    assert text(events) == "secondary response"
+    assert stats.fired == 1 and stats.secondary_wins == 1
+
+
+def test_both_fail():
+    error = CompletionError("primary error")
+    with pytest.raises(CompletionError) as e:
+        collect(
+            stream("primary", 0, error=error),
+            stream("secondary", 0, error=CompletionError("secondary error")),
+        )
+    assert e.value is error
+
+
+def test_assistant_hedge_config():
+    assistant = Assistant(
+        {"model": "primary", "hedge": {"model": "secondary", "delay": 0.01}}
+    )
+
+    def get_provider(model):
+        provider = mock.MagicMock()
+        provider.acomplete.side_effect = stream(model, 10 if model == "primary" else 0)
+        return provider
+
+    with mock.patch("gptcli.assistant.get_completion_provider", get_provider):
+        events = list(assistant.complete_chat([{"role": "user", "content": "hi"}]))
+        # Not hedged against itself
+        with mock.patch("gptcli.assistant.hedged_complete") as hedged:
+            assistant.acomplete_chat([], {"model": "secondary"})
+            hedged.assert_not_called()
+
+    assert text(events) == "secondary response"
+    assert assistant.hedge_stats.secondary_wins == 1
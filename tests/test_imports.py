@@ -0,0 +1,78 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from gptcli.assistant import get_completion_provider
+from gptcli.providers import find_provider_spec
+
+# Modules that must not be imported just to start the CLI or parse arguments
+HEAVY_MODULES = [
+    "openai",
+    "anthropic",
+    "cohere",
+    "google.generativeai",
+    "tiktoken",
+    "llama_cpp",
+    "requests",
+    "rich",
+    "prompt_toolkit",
+]
+
+# Cumulative import time of gptcli.gpt, in microseconds
+IMPORT_TIME_BUDGET_US = 200_000
+
+
+def run_python(code: str, *flags: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_cold_import_does_not_load_sdks():
+    result = run_python(
+        "import sys, json, gptcli.gpt; "
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    assert json.loads(result.stdout) == []
+
+
+def test_cold_import_time_budget():
+    result = run_python("import gptcli.gpt", "-X", "importtime")
+    cumulative = None
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == "gptcli.gpt":
+            cumulative = int(parts[1])
+    assert cumulative is not None
+    assert cumulative < IMPORT_TIME_BUDGET_US
+
+
+@pytest.mark.parametrize(
+    "model,module",
+    [
+        ("gpt-4o", "gptcli.providers.openai"),
+        ("ft:gpt-3.5-turbo:org", "gptcli.providers.openai"),
+        ("oai-compat:meta-llama/Llama-3-70b-chat-hf", "gptcli.providers.openai"),
+        ("o1-preview", "gptcli.providers.openai"),
+        ("claude-3-5-sonnet-20240620", "gptcli.providers.anthropic"),
+        ("llama-7b", "gptcli.providers.llama"),
+        ("command-r-plus", "gptcli.providers.cohere"),
+        ("dolphin", "gptcli.providers.dolphin"),
+        ("gemini-1.5-pro", "gptcli.providers.google"),
+    ],
+)
+def test_provider_registry(model, module):
+    spec = find_provider_spec(model)
+    assert spec is not None
+    assert spec.module == module
+
+
+def test_unknown_model():
+    with pytest.raises(ValueError):
+        get_completion_provider("unknown-model")
@@ -0,0 +1,65 @@
+from unittest import mock
+
+from gptcli.providers.llama import LLaMAModelManager, model_size
+
+
+def model_config(tmp_path, name, size):
+    path = tmp_path / f"{name}.gguf"
+    path.write_bytes(b"\0" * size)
+    return {
+        "path": str(path),
+        "human_prompt": "Human:",
+        "assistant_prompt": "AI:",
+        "prompt_cache_mb": 0,
+    }
+
+
+def test_models_stay_loaded(tmp_path):
+    loader = mock.MagicMock(side_effect=lambda config: mock.MagicMock())
+    manager = LLaMAModelManager(loader=loader)
+    config = model_config(tmp_path, "llama-a", 10)
+
+    first = manager.get("llama-a", config)
+    assert manager.get("llama-a", config) is first
+    assert loader.call_count == 1
+
+    assert manager.unload("llama-a")
+    first.llm.close.assert_called_once()
+    assert not manager.unload("llama-a")
+    manager.get("llama-a", config)
+    assert loader.call_count == 2
+
+
+def test_ram_budget_unloads_least_recently_used(tmp_path):
+    manager = LLaMAModelManager(
+        ram_budget=25, loader=lambda config: mock.MagicMock()
+    )
+    configs = {name: model_config(tmp_path, name, 10) for name in "abc"}
+
+    manager.get("a", configs["a"])
+    manager.get("b", configs["b"])
+    manager.get("a", configs["a"])
+    manager.get("c", configs["c"])
+    assert manager.loaded() == ["a", "c"]
+
+    # A model larger than the budget is still loaded, on its own
+    big = model_config(tmp_path, "big", 30)
+    manager.get("big", big)
+    assert manager.loaded() == ["big"]
+
+
+def test_preload(tmp_path):
+    loader = mock.MagicMock(side_effect=lambda config: mock.MagicMock())
+    manager = LLaMAModelManager(loader=loader)
+    config = model_config(tmp_path, "llama-a", 10)
+
+    manager.preload("llama-a", config).join()
+    assert manager.loaded() == ["llama-a"]
+    manager.get("llama-a", config)
+    assert loader.call_count == 1
+
+
+def test_model_size_includes_prompt_cache(tmp_path):
+    config = model_config(tmp_path, "llama-a", 10)
+    assert model_size(config) == 10
+    assert model_size({**config, "prompt_cache_mb": 2}) == 10 + 2 * 2**20
@@ -0,0 +1,68 @@
+from unittest import mock
+
+from gptcli.llama_tune import (
+    TuneResult,
+    save_tuned_settings,
+    thread_candidates,
+    tune,
+    tuned_settings,
+)
+from gptcli.providers.llama import llama_params
+
+model_config = {
+    "path": "model.gguf",
+    "human_prompt": "Human:",
+    "assistant_prompt": "AI:",
+}
+
+
+def test_thread_candidates():
+    assert thread_candidates(32) == [4, 8, 16, 32]
+    assert thread_candidates(2) == [1, 2]
+
+
+def test_tune_sweeps_threads_then_batch_sizes():
+    # Generation peaks at 8 threads, prompt evaluation at 16 threads and batch 256
+    def measure(llm, prompt, tokens):
+        generation = {4: 10.0, 8: 12.0, 16: 11.0}[llm.n_threads]
+        prompt_eval = llm.n_threads_batch * 10.0
+        if llm.n_batch == 256:
+            prompt_eval += 5.0
+        return {"prompt_eval": prompt_eval, "generation": generation}
+
+    loaded = []
+
+    def loader(config):
+        loaded.append(config)
+        keys = ("n_threads", "n_threads_batch", "n_batch")
+        return mock.MagicMock(**{key: config[key] for key in keys})
+
+    best = tune(model_config, [4, 8, 16], [256, 512], loader=loader, measure=measure)
+    assert (best.n_threads, best.n_threads_batch, best.n_batch) == (8, 16, 256)
+    assert best.generation == 12.0
+    assert best.prompt_eval == 165.0
+    assert all(config["prompt_cache_mb"] == 0 for config in loaded)
+    assert len(loaded) == 5
+
+
+def test_tuned_settings_are_saved_per_model(tmp_path):
+    path = str(tmp_path / "tune.json")
+    assert tuned_settings("llama-a", path) == {}
+
+    save_tuned_settings("llama-a", TuneResult(8, 16, 256, 100.0, 10.0), path)
+    assert tuned_settings("llama-a", path) == {
+        "n_threads": 8,
+        "n_threads_batch": 16,
+        "n_batch": 256,
+    }
+    assert tuned_settings("llama-b", path) == {}
+
+
+def test_llama_params():
+    params = llama_params({**model_config, "n_threads": 8, "rope_freq_base": 1e6})
+    assert params["n_threads"] == 8
+    assert params["rope_freq_base"] == 1e6
+    assert params["n_ctx"] == 2048
+    # Left to llama_cpp
+    assert "n_threads_batch" not in params
+    assert "path" not in params
@@ -0,0 +1,532 @@
+import json
+import threading
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("flask")
+
+import llamahost  # noqa: E402
+from llamahost import (  # noqa: E402
+    Job,
+    ReplicaPool,
+    Scheduler,
+    StateCache,
+    assign_cpu_sets,
+    parse_cpu_list,
+    run_conversation,
+    stream_completion,
+)
+
+config = {
+    "path": "model.gguf",
+    "human_prompt": "Human:",
+    "assistant_prompt": "AI:",
+    "max_tokens": 100,
+}
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpu_list("5") == [5]
+    assert parse_cpu_list("") == []
+
+
+def test_assign_cpu_sets():
+    nodes = [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert assign_cpu_sets([], 2) == [None, None]
+    # Round-robin over the nodes, workers on the same node split its CPUs
+    assert assign_cpu_sets(nodes, 2) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert assign_cpu_sets(nodes, 4) == [[0, 1], [4, 5], [2, 3], [6, 7]]
+    assert assign_cpu_sets(nodes, 3) == [[0, 1], [4, 5, 6, 7], [2, 3]]
+    # More workers than CPUs share them
+    assert assign_cpu_sets([[0]], 2) == [[0], [0]]
+
+
+class FakePipe:
+    def __init__(self, events=()):
+        self.sent = []
+        self.events = list(events)
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def recv(self):
+        if not self.events:
+            raise EOFError
+        return self.events.pop(0)
+
+
+def make_pool(replicas=2, max_queue=16):
+    pool = ReplicaPool(config, [None] * replicas, max_queue=max_queue)
+    for replica in pool.replicas:
+        replica.alive = True
+        replica.ready.set()
+        replica.requests = FakePipe()
+        replica.process = mock.MagicMock(pid=1000 + replica.index, exitcode=-9)
+    return pool
+
+
+def sent_to(pool):
+    return [len(replica.requests.sent) for replica in pool.replicas]
+
+
+def test_dispatches_to_least_outstanding_tokens():
+    pool = make_pool()
+
+    assert pool.submit(Job("x" * 400, {}))
+    assert sent_to(pool) == [1, 0]
+    # 100 prompt tokens estimated from the length, and up to 100 generated
+    assert pool.replicas[0].outstanding_tokens() == 200
+
+    assert pool.submit(Job("x" * 40, {}))
+    assert sent_to(pool) == [1, 1]
+    assert pool.submit(Job("x" * 40, {}))
+    assert sent_to(pool) == [1, 2]
+
+    # Replicas still loading the model only get jobs when none is ready
+    pool.replicas[1].ready.clear()
+    assert pool.submit(Job("", {}))
+    assert sent_to(pool) == [2, 2]
+
+
+def test_conversations_stay_on_their_replica():
+    pool = make_pool()
+    assert pool.submit(Job("", {}, "conversation"))
+    assert sent_to(pool) == [1, 0]
+    assert pool.affinity["conversation"] is pool.replicas[0]
+
+    # Worth waiting for up to the cost of the job
+    assert pool.submit(Job("", {}, "conversation"))
+    assert sent_to(pool) == [2, 0]
+
+    # But not longer
+    assert pool.submit(Job("", {}, "conversation"))
+    assert sent_to(pool) == [2, 1]
+    assert pool.affinity["conversation"] is pool.replicas[1]
+
+
+def test_rejects_beyond_the_queue():
+    pool = make_pool(replicas=1, max_queue=1)
+    assert pool.submit(Job("", {}))
+    assert pool.submit(Job("", {}))
+    assert not pool.submit(Job("", {}))
+    assert pool.stats()["rejected"] == 1
+    assert pool.stats()["queued"] == 1
+
+    pool.replicas[0].alive = False
+    pool.replicas[0].jobs.clear()
+    assert not pool.submit(Job("", {}))
+
+
+def test_cancel_tells_the_worker():
+    pool = make_pool(replicas=1)
+    job = Job("", {})
+    pool.submit(job)
+
+    job.cancel()
+
+    assert job.cancelled.is_set()
+    assert pool.replicas[0].requests.sent[-1] == ("cancel", 0)
+
+
+def test_worker_crash_fails_its_jobs_and_restarts_it():
+    pool = make_pool(replicas=1)
+    replica = pool.replicas[0]
+    finished, crashed, failed = Job("", {}), Job("", {}), Job("", {})
+    for job in (finished, crashed, failed):
+        assert pool.submit(job)
+
+    events = FakePipe(
+        [
+            ("ready",),
+            ("start", 0),
+            ("text", 0, "Hello"),
+            ("done", 0, {"finish_reason": "stop"}),
+            ("start", 2),
+            ("error", 2, "out of memory"),
+            ("done", 2, {}),
+            ("start", 1),
+            ("text", 1, "Hi"),
+        ]
+    )
+    pool.RESTART_DELAY = 0
+    with mock.patch.object(pool, "_spawn") as spawn:
+        pool._listen(replica, events)
+
+    assert list(finished.texts()) == ["Hello"]
+    assert finished.result == {"finish_reason": "stop"}
+    with pytest.raises(RuntimeError, match="out of memory"):
+        list(failed.texts())
+    with pytest.raises(RuntimeError, match="crashed"):
+        list(crashed.texts())
+
+    stats = pool.stats()
+    assert (stats["completed"], stats["failed"], stats["active"]) == (1, 2, 0)
+    assert stats["generated_tokens"] == 2
+    assert replica.jobs == {} and replica.outstanding_tokens() == 0
+    assert not replica.alive and replica.restarts == 1
+    spawn.assert_called_once_with(replica)
+
+
+class FakeLlama:
+    """
+    Generates `tokens`, waiting for `proceed` before each one after the first.
+    """
+
+    def __init__(self, tokens=("Hel", "lo")):
+        self.tokens = tokens
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.generated = 0
+
+    def create_completion(self, prompt, stop, stream, echo, **kwargs):
+        for i, token in enumerate(self.tokens):
+            if i > 0:
+                self.proceed.wait(5)
+            self.generated += 1
+            finish_reason = "stop" if i == len(self.tokens) - 1 else None
+            yield {"choices": [{"text": token, "finish_reason": finish_reason}]}
+
+    def tokenize(self, text, add_bos=True):
+        return text.split()
+
+
+class FakeState:
+    llama_state_size = 10
+
+
+def start_scheduler(llm, **kwargs):
+    scheduler = Scheduler(config, **kwargs)
+    with mock.patch("llamahost.load_llm", return_value=llm):
+        scheduler.start()
+    return scheduler
+
+
+def wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("timed out")
+
+
+def test_scheduler_runs_jobs():
+    scheduler = start_scheduler(FakeLlama())
+    job = Job("Human: hi", {})
+    assert scheduler.submit(job)
+
+    assert list(job.texts()) == ["Hel", "lo"]
+    assert job.result["finish_reason"] == "stop"
+    wait_for(lambda: scheduler.stats()["completed"] == 1)
+    assert scheduler.stats()["generated_tokens"] == 2
+
+
+def test_scheduler_slots_split_the_cpus():
+    with mock.patch("llamahost.os.cpu_count", return_value=32), mock.patch(
+        "llamahost.load_llm", return_value=FakeLlama()
+    ) as load_llm:
+        Scheduler(config, slots=4).start()
+        Scheduler({**config, "n_threads": 6}, slots=4).start()
+
+    configs = [call.args[0] for call in load_llm.call_args_list]
+    assert {(c["n_threads"], c["n_threads_batch"]) for c in configs[:4]} == {(4, 8)}
+    assert {(c["n_threads"], c["n_threads_batch"]) for c in configs[4:]} == {(6, 8)}
+
+
+def test_scheduler_rejects_with_429_when_the_queue_is_full(monkeypatch):
+    # No slots take jobs off the queue
+    scheduler = Scheduler(config, max_queue=1)
+    monkeypatch.setattr(llamahost, "scheduler", scheduler)
+    monkeypatch.setattr(llamahost, "model_config", config)
+    assert scheduler.submit(Job("", {}))
+
+    response = llamahost.app.test_client().post(
+        "/complete", json={"messages": [{"role": "user", "content": "hi"}]}
+    )
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    stats = llamahost.app.test_client().get("/stats").get_json()
+    assert (stats["rejected"], stats["queued"], stats["max_queue"]) == (1, 1, 1)
+
+
+def test_scheduler_skips_jobs_cancelled_while_queued():
+    llm = FakeLlama()
+    scheduler = Scheduler(config, max_queue=2)
+    cancelled, job = Job("", {}), Job("", {})
+    scheduler.submit(cancelled)
+    scheduler.submit(job)
+    cancelled.cancel()
+
+    with mock.patch("llamahost.load_llm", return_value=llm):
+        scheduler.start()
+
+    assert list(job.texts()) == ["Hel", "lo"]
+    wait_for(lambda: scheduler.stats()["completed"] == 1)
+    assert scheduler.stats()["cancelled"] == 1
+    assert llm.generated == 2
+    assert cancelled.output.empty()
+
+
+def test_scheduler_stops_jobs_cancelled_while_streaming():
+    llm = FakeLlama(tokens=("a", "b", "c"))
+    llm.proceed.clear()
+    scheduler = start_scheduler(llm)
+    job = Job("", {})
+    scheduler.submit(job)
+
+    texts = job.texts()
+    assert next(texts) == "a"
+    job.cancel()
+    llm.proceed.set()
+
+    # The slot stops at the next token
+    assert list(texts) == []
+    wait_for(lambda: scheduler.stats()["active"] == 0)
+    stats = scheduler.stats()
+    assert (stats["cancelled"], stats["completed"]) == (1, 0)
+    assert llm.generated == 2
+
+
+def test_conversations_bypass_the_prompt_cache():
+    llm = FakeLlama()
+    llm.cache = prompt_cache = mock.MagicMock()
+    caches = []
+    llm.save_state = mock.MagicMock(
+        side_effect=lambda: caches.append(llm.cache) or FakeState()
+    )
+    llm.load_state = mock.MagicMock()
+    states = StateCache(budget_mb=1)
+
+    def turn(conversation_id):
+        texts = stream_completion(llm, config, "Human: hi", {}, {})
+        return list(run_conversation(llm, states, conversation_id, texts))
+
+    assert turn("conversation") == ["Hel", "lo"]
+    assert turn("conversation") == ["Hel", "lo"]
+
+    # One saved state per turn, with the prompt cache detached meanwhile
+    assert caches == [None, None]
+    llm.load_state.assert_called_once()
+    assert llm.cache is prompt_cache
+    assert states.stats()["states"] == 1
+
+
+def test_state_cache_counts_the_arrays_of_the_states():
+    mb = 2**20
+
+    def state(llama_state_mb, arrays_mb):
+        array = mock.MagicMock(nbytes=arrays_mb * mb // 2)
+        return mock.MagicMock(
+            llama_state_size=llama_state_mb * mb, input_ids=array, scores=array
+        )
+
+    states = StateCache(budget_mb=10)
+    states.put("a", state(2, 2))
+    states.put("b", state(2, 2))
+    assert states.stats() == {"states": 2, "size_mb": 8.0}
+
+    # The arrays take it over the budget
+    states.put("c", state(1, 2))
+    assert states.get("a") is None
+    assert states.stats() == {"states": 2, "size_mb": 7.0}
+
+    states.put("big", state(1, 10))
+    assert states.get("big") is None
+
+
+class FakeScheduler:
+    """
+    Answers every job with `reply` right away, and keeps the prompts.
+    """
+
+    def __init__(self, reply=("Hel", "lo")):
+        self.reply = reply
+        self.prompts = []
+
+    def submit(self, job):
+        self.prompts.append(job.prompt)
+        job.result.update(finish_reason="length", prompt_tokens=3, completion_tokens=2)
+        for text in self.reply:
+            job.output.put(text)
+        job.output.put(llamahost.DONE)
+        return True
+
+
+@pytest.fixture
+def server(monkeypatch):
+    scheduler = FakeScheduler()
+    monkeypatch.setattr(llamahost, "scheduler", scheduler)
+    monkeypatch.setattr(llamahost, "model_config", config)
+    monkeypatch.setattr(llamahost, "conversations", llamahost.Conversations())
+    return llamahost.app.test_client(), scheduler
+
+
+def checksum(messages):
+    value = ""
+    for message in messages:
+        value = llamahost.message_checksum(value, message)
+    return value
+
+
+hi = {"role": "user", "content": "hi"}
+hello = {"role": "assistant", "content": "Hello"}
+again = {"role": "user", "content": "again"}
+
+
+def turn(client, messages, prefix=(), conversation_id="c1", stream=False):
+    return client.post(
+        "/complete",
+        json={
+            "messages": messages,
+            "conversation_id": conversation_id,
+            "prefix_length": len(prefix),
+            "prefix_checksum": checksum(prefix),
+            "stream": stream,
+        },
+    )
+
+
+def test_conversation_turns_only_send_new_messages(server):
+    client, scheduler = server
+
+    response = turn(client, [hi])
+    assert response.get_json() == {"completion": "Hello"}
+    assert response.headers["X-Conversation-Id"] == "c1"
+
+    response = turn(client, [again], prefix=[hi, hello], stream=True)
+    assert response.get_data(as_text=True) == "Hello"
+    assert scheduler.prompts == [
+        "Human: hi\nAI:",
+        "Human: hi\nAI: Hello\nHuman: again\nAI:",
+    ]
+    assert llamahost.conversations.get("c1").checksums[-1] == checksum(
+        [hi, hello, again, hello]
+    )
+
+
+def test_conversation_rerun_truncates(server):
+    client, scheduler = server
+    turn(client, [hi])
+
+    # Re-running the reply sends the prefix without it
+    assert turn(client, [], prefix=[hi]).status_code == 200
+    assert scheduler.prompts[-1] == "Human: hi\nAI:"
+    assert llamahost.conversations.get("c1").checksums[-1] == checksum([hi, hello])
+
+
+def test_conversation_prefix_length_0_resets(server):
+    client, scheduler = server
+    turn(client, [hi])
+
+    assert turn(client, [again]).status_code == 200
+    assert scheduler.prompts[-1] == "Human: again\nAI:"
+    assert len(llamahost.conversations.get("c1").lines) == 2
+
+
+def test_unknown_conversation_prefix_is_409(server):
+    client, scheduler = server
+    turn(client, [hi])
+
+    # A different history than the server's, and a conversation it doesn't have
+    assert turn(client, [again], prefix=[again, hello]).status_code == 409
+    response = turn(client, [again], prefix=[hi, hello], conversation_id="c2")
+    assert response.status_code == 409
+    assert len(scheduler.prompts) == 1
+
+
+def test_stale_replies_are_not_added(server):
+    client, _ = server
+    turn(client, [hi])
+    conversation = llamahost.conversations.get("c1")
+
+    # Another request changed the conversation while the reply was generated
+    llamahost.add_reply("c1", checksum([hi]), "late")
+
+    assert conversation.checksums[-1] == checksum([hi, hello])
+    assert len(conversation.lines) == 2
+
+
+def events(response):
+    data = response.get_data(as_text=True)
+    assert data.endswith("\n\n")
+    return [
+        line[len("data: ") :] if line == "data: [DONE]" else json.loads(line[6:])
+        for line in data.split("\n\n")
+        if line
+    ]
+
+
+def test_chat_completions_stream(server):
+    client, scheduler = server
+
+    response = client.post(
+        "/v1/chat/completions",
+        json={
+            "model": "llama",
+            "messages": [hi],
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        },
+    )
+
+    assert response.mimetype == "text/event-stream"
+    role, *contents, finish, usage, done = events(response)
+    assert role["choices"][0]["delta"] == {"role": "assistant", "content": ""}
+    assert [c["choices"][0]["delta"] for c in contents] == [
+        {"content": "Hel"},
+        {"content": "lo"},
+    ]
+    assert finish["choices"] == [
+        {"index": 0, "delta": {}, "finish_reason": "length"}
+    ]
+    assert usage["choices"] == []
+    assert usage["usage"] == {
+        "prompt_tokens": 3,
+        "completion_tokens": 2,
+        "total_tokens": 5,
+    }
+    assert done == "[DONE]"
+    assert {e["id"] for e in (role, *contents, finish, usage)} == {role["id"]}
+    assert role["object"] == "chat.completion.chunk" and role["model"] == "llama"
+    assert scheduler.prompts == ["Human: hi\nAI:"]
+
+
+def test_chat_completions(server):
+    client, _ = server
+
+    response = client.post(
+        "/v1/chat/completions", json={"model": "llama", "messages": [hi]}
+    )
+
+    body = response.get_json()
+    assert body["object"] == "chat.completion"
+    assert body["choices"] == [
+        {
+            "index": 0,
+            "message": {"role": "assistant", "content": "Hello"},
+            "finish_reason": "length",
+        }
+    ]
+    assert body["usage"] == {
+        "prompt_tokens": 3,
+        "completion_tokens": 2,
+        "total_tokens": 5,
+    }
+
+
+def test_chat_completions_busy(server, monkeypatch):
+    client, _ = server
+    # No slots take jobs off the queue
+    scheduler = Scheduler(config, max_queue=1)
+    scheduler.submit(Job("", {}))
+    monkeypatch.setattr(llamahost, "scheduler", scheduler)
+
+    response = client.post(
+        "/v1/chat/completions", json={"model": "llama", "messages": [hi]}
+    )
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert response.get_json()["error"]["type"] == "rate_limit_error"
@@ -0,0 +1,54 @@
+import pytest
+
+from gptcli.markdown import MarkdownBlockSplitter
+
+
+def feed_tokens(text: str, token_size: int = 3):
+    splitter = MarkdownBlockSplitter()
+    blocks = []
+    for i in range(0, len(text), token_size):
+        blocks.extend(splitter.feed(text[i : i + token_size]))
+    return blocks, splitter.flush()
+
+
+def test_paragraphs():
+    blocks, pending = feed_tokens("First paragraph.\n\nSecond paragraph.\n\nThird")
+    assert blocks == ["First paragraph.\n\n", "Second paragraph.\n\n"]
+    assert pending == "Third"
+
+
+def test_block_not_frozen_before_next_line_starts():
+    splitter = MarkdownBlockSplitter()
+    assert splitter.feed("First paragraph.\n\n") == []
+    assert splitter.feed(" ") == []
+    assert splitter.feed(" indented\n") == []
+    assert splitter.feed("\nSec") == ["First paragraph.\n\n  indented\n\n"]
+    assert splitter.pending == "Sec"
+
+
+def test_fenced_code_with_blank_lines():
+    text = "Code:\n\n```python\ndef f():\n\n    return 1\n```\nAfter"
+    blocks, pending = feed_tokens(text)
+    assert blocks == ["Code:\n\n", "```python\ndef f():\n\n    return 1\n```\n"]
+    assert pending == "After"
+
+
+def test_longer_closing_fence_required():
+    blocks, pending = feed_tokens("````\n```\nstill code\n\n````\nDone")
+    assert blocks == ["````\n```\nstill code\n\n````\n"]
+    assert pending == "Done"
+
+
+def test_lists_with_indented_continuation():
+    text = "- item one\n\n  continued\n- item two\n\nParagraph"
+    blocks, pending = feed_tokens(text)
+    assert blocks == ["- item one\n\n  continued\n- item two\n\n"]
+    assert pending == "Paragraph"
+
+
+@pytest.mark.parametrize("token_size", [1, 2, 5, 100])
+def test_blocks_reassemble_to_input(token_size):
+    text = "# Title\n\nSome text\nmore text\n\n1. a\n2. b\n\n~~~\ncode\n\n~~~\n\nEnd.\n"
+    blocks, pending = feed_tokens(text, token_size)
+    assert "".join(blocks) + pending == text
+    assert len(blocks) == 4
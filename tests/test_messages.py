@@ -0,0 +1,79 @@
+import pytest
+
+from gptcli.messages import MessageLog
+
+
+def message(i: int):
+    return {"role": "user", "content": str(i)}
+
+
+def test_snapshot_is_not_affected_by_appends():
+    log = MessageLog([message(0)])
+    snapshot = log.snapshot()
+    log.append(message(1))
+
+    assert snapshot == [message(0)]
+    assert log.snapshot() == [message(0), message(1)]
+
+
+def test_truncate_below_snapshot_keeps_snapshot():
+    log = MessageLog([message(0), message(1), message(2)])
+    snapshot = log.snapshot()
+
+    log.truncate(1)
+    log.append(message(3))
+
+    assert snapshot == [message(0), message(1), message(2)]
+    assert log.snapshot() == [message(0), message(3)]
+
+
+def test_truncate_above_snapshot_reuses_storage():
+    log = MessageLog([message(0)])
+    snapshot = log.snapshot()
+    log.append(message(1))
+    storage = log._messages
+
+    log.truncate(1)
+    log.append(message(2))
+
+    assert log._messages is storage
+    assert snapshot == [message(0)]
+    assert log.snapshot() == [message(0), message(2)]
+
+
+def test_snapshot_sequence():
+    log = MessageLog([message(i) for i in range(4)])
+    snapshot = log.snapshot()
+    log.append(message(4))
+
+    assert len(snapshot) == 4
+    assert snapshot[-1] == message(3)
+    assert list(snapshot) == [message(i) for i in range(4)]
+    assert snapshot[:-1] == [message(i) for i in range(3)]
+    assert snapshot[1:] == [message(i) for i in range(1, 4)]
+    assert snapshot[::2] == [message(0), message(2)]
+    with pytest.raises(IndexError):
+        snapshot[4]
+
+
+def test_truncate_after_snapshots_are_released_reuses_storage():
+    log = MessageLog([message(0), message(1)])
+    log.snapshot()
+    storage = log._messages
+
+    # e.g. re-running a response that has been shown: the snapshot of the whole
+    # conversation isn't referenced any more
+    log.truncate(1)
+
+    assert log._messages is storage
+    assert log.snapshot() == [message(0)]
+
+
+def test_truncate_below_snapshot_prefix_keeps_prefix():
+    log = MessageLog([message(0), message(1), message(2)])
+    prefix = log.snapshot()[:2]
+
+    log.truncate(1)
+    log.append(message(3))
+
+    assert prefix == [message(0), message(1)]
@@ -0,0 +1,203 @@
+import json
+from unittest import mock
+
+import pytest
+
+from gptcli import providers
+from gptcli.config import GptCliConfig
+from gptcli.providers import clear_clients, configure_providers, get_client, http_pool_options
+
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    yield
+    clear_clients()
+    configure_providers(None)
+
+
+def test_get_client_is_cached_per_key():
+    factory = mock.MagicMock(side_effect=lambda: object())
+
+    client = get_client("openai", "key", None, factory)
+    assert get_client("openai", "key", None, factory) is client
+    factory.assert_called_once()
+
+    assert get_client("openai", "other-key", None, factory) is not client
+    assert get_client("openai", "key", "http://localhost/v1", factory) is not client
+    assert get_client("anthropic", "key", None, factory) is not client
+    assert factory.call_count == 4
+
+
+def test_clear_clients_closes_clients():
+    client = mock.MagicMock()
+    get_client("openai", "key", None, lambda: client)
+
+    clear_clients()
+
+    client.close.assert_called_once()
+    assert get_client("openai", "key", None, object) is not client
+
+
+def test_async_clients_are_shared_by_sync_calls():
+    import asyncio
+
+    from gptcli.completion import CompletionProvider, MessageDeltaEvent
+
+    factory = mock.MagicMock(side_effect=lambda: object())
+
+    class AsyncProvider(CompletionProvider):
+        async def acomplete(self, messages, args, stream=False):
+            get_client("async", "key", None, factory, scope=asyncio.get_running_loop())
+            yield MessageDeltaEvent("a")
+
+    for _ in range(3):
+        assert list(AsyncProvider().complete([], {}))
+    factory.assert_called_once()
+    assert len(providers._clients) == 1
+
+
+def test_clients_of_closed_loops_are_dropped():
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    client = get_client("async", "key", None, object, scope=loop)
+    loop.close()
+
+    get_client("async", "key", None, object, scope=object())
+
+    assert client not in providers._clients.values()
+    assert len(providers._clients) == 1
+
+
+def test_http_pool_options():
+    assert http_pool_options() == (
+        providers.DEFAULT_HTTP_POOL_SIZE,
+        providers.DEFAULT_HTTP_KEEPALIVE_EXPIRY,
+        False,
+    )
+
+    configure_providers(
+        GptCliConfig(http_pool_size=32, http_keepalive_expiry=5.0, http2=True)
+    )
+    assert http_pool_options() == (32, 5.0, True)
+
+
+def test_openai_streaming_reports_usage():
+    import httpx
+    from openai import OpenAI
+
+    from gptcli.completion import MessageDeltaEvent, UsageEvent
+    from gptcli.providers.openai import OpenAICompletionProvider
+
+    def chunk(choices, usage=None):
+        data = {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "oai-compat:llama",
+            "choices": choices,
+            "usage": usage,
+        }
+        return f"data: {json.dumps(data)}\n\n"
+
+    body = "".join(
+        [
+            chunk([{"index": 0, "delta": {"content": "Hé"}, "finish_reason": None}]),
+            chunk([{"index": 0, "delta": {"content": "llo"}, "finish_reason": None}]),
+            chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}]),
+            chunk(
+                [], {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}
+            ),
+            "data: [DONE]\n\n",
+        ]
+    )
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(
+            200, content=body, headers={"content-type": "text/event-stream"}
+        )
+
+    base_url = "http://llamahost/v1"
+    client = OpenAI(
+        api_key="key",
+        base_url=base_url,
+        http_client=httpx.Client(transport=httpx.MockTransport(handler)),
+    )
+    get_client("openai", "key", base_url, lambda: client)
+    with mock.patch("openai.api_key", "key"), mock.patch("openai.base_url", base_url):
+        provider = OpenAICompletionProvider()
+    events = list(
+        provider.complete(
+            [{"role": "user", "content": "hi"}],
+            {"model": "oai-compat:llama", "temperature": 0.0},
+            stream=True,
+        )
+    )
+
+    assert requests[0]["stream_options"] == {"include_usage": True}
+    assert events == [
+        MessageDeltaEvent("Hé"),
+        MessageDeltaEvent("llo"),
+        UsageEvent(prompt_tokens=5, completion_tokens=2, total_tokens=7, cost=0.0),
+    ]
+
+
+def test_openai_compatible_servers_without_stream_options():
+    import httpx
+    from openai import OpenAI
+
+    from gptcli.completion import MessageDeltaEvent
+    from gptcli.providers import openai as openai_provider
+
+    chunk = {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "llama",
+        "choices": [{"index": 0, "delta": {"content": "Hi"}, "finish_reason": "stop"}],
+    }
+    requests = []
+
+    def handler(request):
+        data = json.loads(request.content)
+        requests.append(data)
+        if "stream_options" in data:
+            return httpx.Response(
+                400, json={"error": {"message": "Unknown field: stream_options"}}
+            )
+        return httpx.Response(
+            200,
+            content=f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n",
+            headers={"content-type": "text/event-stream"},
+        )
+
+    base_url = "http://vllm/v1"
+    client = OpenAI(
+        api_key="key",
+        base_url=base_url,
+        max_retries=0,
+        http_client=httpx.Client(transport=httpx.MockTransport(handler)),
+    )
+    get_client("openai", "key", base_url, lambda: client)
+    with mock.patch("openai.api_key", "key"), mock.patch("openai.base_url", base_url):
+        provider = openai_provider.OpenAICompletionProvider()
+
+    def complete():
+        return list(
+            provider.complete(
+                [{"role": "user", "content": "hi"}],
+                {"model": "oai-compat:llama"},
+                stream=True,
+            )
+        )
+
+    try:
+        assert complete() == [MessageDeltaEvent("Hi")]
+        assert ["stream_options" in request for request in requests] == [True, False]
+        # The server is remembered
+        assert complete() == [MessageDeltaEvent("Hi")]
+        assert len(requests) == 3
+    finally:
+        openai_provider._no_stream_options.clear()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+from gptcli.completion import (
+    CompletionError,
+    MessageDeltaEvent,
+    iterate_sync,
+    on_cancel,
+)
+from gptcli.reader import StreamReader
+
+
+def test_reads_ahead_of_slow_consumer():
+    read = []
+
+    def events():
+        for token in "abc":
+            read.append(token)
+            yield MessageDeltaEvent(token)
+
+    with StreamReader(events()) as reader:
+        # The whole stream is read before the consumer asks for anything
+        reader.thread.join(1)
+        assert read == ["a", "b", "c"]
+        # Including the end of stream marker
+        assert reader.depth == 4
+        time.sleep(0.01)
+        assert [event.text for event in reader] == ["a", "b", "c"]
+
+    assert reader.stats.events == 3
+    assert reader.stats.max_depth == 4
+    assert reader.stats.max_wait >= 0.01
+    assert reader.stats.mean_wait <= reader.stats.max_wait
+
+
+def test_errors_are_raised_to_the_consumer():
+    def events():
+        yield MessageDeltaEvent("a")
+        raise CompletionError("connection reset")
+
+    with StreamReader(events()) as reader:
+        iterator = iter(reader)
+        assert next(iterator).text == "a"
+        with pytest.raises(CompletionError):
+            next(iterator)
+
+
+def test_cancel_closes_stream():
+    closed = threading.Event()
+
+    def events():
+        try:
+            while True:
+                yield MessageDeltaEvent("token")
+        finally:
+            closed.set()
+
+    with StreamReader(events(), max_queue_size=2) as reader:
+        next(iter(reader))
+
+    # The reader blocked on the full queue notices the cancellation
+    assert closed.wait(1)
+    reader.thread.join(1)
+    assert not reader.thread.is_alive()
+
+
+def test_cancel_closes_stalled_response():
+    response_closed = threading.Event()
+
+    def events():
+        # A read that blocks until the response is closed
+        on_cancel(response_closed.set)
+        yield MessageDeltaEvent("token")
+        response_closed.wait(5)
+        raise CompletionError("response closed")
+
+    with StreamReader(events()) as reader:
+        next(iter(reader))
+        started = time.monotonic()
+
+    # Without waiting for the stalled read to return
+    assert response_closed.is_set()
+    assert time.monotonic() - started < 1
+    reader.thread.join(1)
+    assert not reader.thread.is_alive()
+
+
+def test_cancel_interrupts_async_stream():
+    import asyncio
+
+    cancelled = threading.Event()
+
+    async def events():
+        yield MessageDeltaEvent("token")
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with StreamReader(iterate_sync(events())) as reader:
+        next(iter(reader))
+
+    assert cancelled.wait(1)
+    reader.thread.join(1)
+    assert not reader.thread.is_alive()
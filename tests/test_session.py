@@ -1,6 +1,7 @@
+import asyncio
 from unittest import mock
 from gptcli.completion import CompletionError, BadRequestError, MessageDeltaEvent
-from gptcli.session import ChatSession
+from gptcli.session import AsyncChatSession, ChatSession
 
 system_message = {"role": "system", "content": "system message"}
 
@@ -238,3 +239,59 @@ def test_stream():
     response_streamer_mock.assert_has_calls(
         [mock.call.on_next_token(token) for token in assistant_message]
     )
+
+
+async def async_events(events):
+    for event in events:
+        yield event
+
+
+def setup_async_session():
+    assistant_mock = setup_assistant_mock()
+    listener_mock, _ = setup_listener_mock()
+    session = AsyncChatSession(assistant_mock, listener_mock)
+    return assistant_mock, listener_mock, session
+
+
+def test_async_respond():
+    assistant_mock, listener_mock, session = setup_async_session()
+    assistant_mock.acomplete_chat.side_effect = lambda *args, **kwargs: async_events(
+        [MessageDeltaEvent("assistant "), MessageDeltaEvent("message")]
+    )
+
+    should_continue = asyncio.run(session.process_input("user message", {}))
+    assert should_continue
+
+    user_message = {"role": "user", "content": "user message"}
+    assistant_message = {"role": "assistant", "content": "assistant message"}
+    assistant_mock.acomplete_chat.assert_called_once_with(
+        [system_message, user_message],
+        override_params={},
+        on_trim=listener_mock.on_context_trimmed,
+        token_counter=session._token_counter,
+    )
+    listener_mock.on_chat_message.assert_has_calls(
+        [mock.call(user_message), mock.call(assistant_message)]
+    )
+    assert session.messages == [system_message, user_message, assistant_message]
+
+    # Re-run replaces the last response
+    assert asyncio.run(session.process_input(":r", {}))
+    assert session.messages == [system_message, user_message, assistant_message]
+    assert assistant_mock.acomplete_chat.call_count == 2
+
+
+def test_async_bad_request_error():
+    assistant_mock, listener_mock, session = setup_async_session()
+
+    error = BadRequestError("error message")
+
+    async def failing_events():
+        raise error
+        yield
+
+    assistant_mock.acomplete_chat.return_value = failing_events()
+
+    assert asyncio.run(session.process_input("user message", {}))
+    listener_mock.on_error.assert_called_once_with(error)
+    assert session.messages == [system_message]
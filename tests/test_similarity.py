@@ -0,0 +1,142 @@
+from unittest import mock
+
+from gptcli.cache import CachedProvider, ResponseCache
+from gptcli.completion import CompletionProvider, MessageDeltaEvent, UsageEvent
+from gptcli.similarity import (
+    SimilarityCache,
+    SimilarityCachedProvider,
+    minhash,
+    normalize,
+    numbers,
+    shingle_hashes,
+    similarity,
+)
+
+system = {"role": "system", "content": "You summarize CI logs."}
+args = {"model": "gpt-4o", "temperature": 0.0, "top_p": 1.0}
+usage = UsageEvent(prompt_tokens=1, completion_tokens=2, total_tokens=3, cost=0.5)
+# Hits cost nothing
+free = UsageEvent(prompt_tokens=1, completion_tokens=2, total_tokens=3, cost=0.0)
+
+PROMPT = "Summarize the build log and list the failing tests. Build 4521 failed at \
+2024-05-01 10:22:01 with 3 errors in the storage module."
+
+
+def user(content):
+    return {"role": "user", "content": content}
+
+
+class FakeProvider(CompletionProvider):
+    def __init__(self):
+        self.calls = 0
+
+    def complete(self, messages, args, stream=False):
+        self.calls += 1
+        yield MessageDeltaEvent(f"response {self.calls}")
+        yield usage
+
+
+def signature(text):
+    return minhash(shingle_hashes(text))
+
+
+def test_normalize():
+    assert normalize("  Build 4521\n\tat 10:22:01 ") == "build 4521 at 0"
+    assert (
+        normalize("Run 123e4567-e89b-12d3-a456-426614174000 on 2024-05-01T10:22:01Z")
+        == "run 0 on 0"
+    )
+
+
+def test_numbers():
+    assert numbers(PROMPT) == ["4521", "3"]
+    assert numbers("What is 4 * 9?") == ["4", "9"]
+
+
+def test_similarity_estimates_jaccard():
+    reworded = PROMPT.replace("Summarize", "Please summarize").replace("4521", "4530")
+    assert similarity(signature(PROMPT), signature(PROMPT)) == 1.0
+    assert similarity(signature(PROMPT), signature(reworded)) > 0.8
+    assert similarity(signature(PROMPT), signature("Write a haiku about autumn")) < 0.3
+
+
+def test_near_duplicates_are_served_from_the_cache():
+    cache = SimilarityCache(":memory:", threshold=0.8)
+    provider = FakeProvider()
+    cached = SimilarityCachedProvider(provider, cache, "general")
+
+    first = list(cached.complete([system, user(PROMPT)], args, stream=True))
+    # Only whitespace, the timestamp and a word differ
+    reworded = "Please summarize" + PROMPT[len("Summarize") :].replace(
+        "2024-05-01 10:22:01", "2024-06-11 08:00:59"
+    )
+    hit = list(cached.complete([system, user(reworded + "  ")], args))
+    assert hit == [*first[:-1], free]
+    assert provider.calls == 1
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+
+    # Different prompts, numbers, assistants, models and conversations don't match
+    list(cached.complete([system, user("Write a haiku about autumn")], args))
+    list(cached.complete([system, user(PROMPT.replace("4521", "4522"))], args))
+    list(cached.complete([system, user(PROMPT)], {**args, "model": "gpt-4o-mini"}))
+    list(
+        SimilarityCachedProvider(provider, cache, "dev").complete(
+            [system, user(PROMPT)], args
+        )
+    )
+    list(
+        cached.complete(
+            [system, user("hi"), {"role": "assistant", "content": "hello"}, user(PROMPT)],
+            args,
+        )
+    )
+    assert provider.calls == 6
+
+
+def test_different_numbers_miss():
+    cache = SimilarityCache(":memory:", threshold=0.5)
+    provider = FakeProvider()
+    cached = SimilarityCachedProvider(provider, cache, "general")
+
+    list(cached.complete([user("What is 17 * 23?")], args))
+    list(cached.complete([user("What is 4 * 9?")], args))
+    list(cached.complete([user("What is 17 * 23 ?")], args))
+    assert provider.calls == 2
+
+
+def test_eviction():
+    cache = SimilarityCache(":memory:", max_size_mb=2000 / 2**20, ttl=100)
+    provider = FakeProvider()
+    cached = SimilarityCachedProvider(provider, cache, "general")
+    prompts = [f"Summarize the {topic} logs" for topic in ("build", "deploy", "test")]
+
+    with mock.patch("time.time", return_value=1000):
+        for prompt in prompts:
+            list(cached.complete([user(prompt)], args))
+    (entries,) = cache.connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+    (buckets,) = cache.connection.execute(
+        "SELECT COUNT(DISTINCT entry_id) FROM buckets"
+    ).fetchone()
+    # Each entry takes over 600 bytes, the least recently used one was evicted
+    assert (entries, buckets) == (2, 2)
+
+    # Expired responses are neither served nor kept
+    with mock.patch("time.time", return_value=1200):
+        list(cached.complete([user(prompts[-1])], args))
+    assert provider.calls == 4
+    (entries,) = cache.connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+    assert entries == 1
+
+
+def test_exact_cache_is_checked_first():
+    exact = ResponseCache(":memory:")
+    similar = SimilarityCache(":memory:")
+    provider = FakeProvider()
+    cached = CachedProvider(SimilarityCachedProvider(provider, similar, ""), exact)
+
+    list(cached.complete([user(PROMPT)], args))
+    list(cached.complete([user(PROMPT)], args))
+    list(cached.complete([user(PROMPT + " ")], args))
+    assert provider.calls == 1
+    assert (exact.stats.hits, exact.stats.misses) == (1, 2)
+    assert (similar.stats.hits, similar.stats.misses) == (1, 1)
@@ -0,0 +1,206 @@
+import time
+from unittest import mock
+
+from gptcli.completion import MessageDeltaEvent, UsageEvent
+from gptcli.session import ChatSession
+from gptcli.store import SessionStore, SessionStoreListener
+
+system_message = {"role": "system", "content": "system message"}
+
+
+def user(content):
+    return {"role": "user", "content": content}
+
+
+def assistant(content):
+    return {"role": "assistant", "content": content}
+
+
+def setup_session(store):
+    assistant_mock = mock.MagicMock()
+    assistant_mock.init_messages.return_value = [system_message]
+    assistant_mock.supported_overrides.return_value = ["model", "temperature", "top_p"]
+    listener = SessionStoreListener(store)
+    return assistant_mock, ChatSession(assistant_mock, listener, store)
+
+
+def respond(assistant_mock, text):
+    assistant_mock.complete_chat.return_value = [MessageDeltaEvent(text)]
+
+
+def test_session_is_stored_and_resumed(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.db"))
+    assistant_mock, session = setup_session(store)
+
+    respond(assistant_mock, "first answer")
+    session.process_input("first question", {"temperature": 0.5})
+    respond(assistant_mock, "second answer")
+    session.process_input("second question", {})
+    # Re-running replaces the stored response
+    respond(assistant_mock, "second answer, again")
+    session.process_input(":r", {})
+
+    expected = [
+        system_message,
+        user("first question"),
+        assistant("first answer"),
+        user("second question"),
+        assistant("second answer, again"),
+    ]
+    assert session.messages == expected
+
+    sessions = store.list_sessions()
+    assert len(sessions) == 1
+    assert sessions[0].title == "first question"
+
+    _, resumed = setup_session(store)
+    assert resumed.resume()
+    assert resumed.messages == expected
+    assert resumed.user_prompts == [
+        (user("first question"), {"temperature": 0.5}),
+        (user("second question"), {}),
+    ]
+
+    # The resumed conversation continues the same session
+    respond(assistant_mock, "third answer")
+    resumed.assistant = assistant_mock
+    resumed.process_input("third question", {})
+    assert store.load(sessions[0].id).messages == expected + [
+        user("third question"),
+        assistant("third answer"),
+    ]
+
+
+def test_rolled_back_prompt_is_not_stored():
+    store = SessionStore(":memory:")
+    listener = SessionStoreListener(store)
+    listener.on_chat_response(
+        [system_message, user("q")],
+        assistant("a"),
+        {},
+        UsageEvent(prompt_tokens=1, completion_tokens=2, total_tokens=3, cost=0.5),
+    )
+    # The session sends a prompt that fails, then a new one in the same position
+    listener.on_chat_response(
+        [system_message, user("q"), assistant("a"), user("q2")], assistant("a2"), {}
+    )
+    listener.on_chat_clear()
+    listener.on_chat_response([user("new")], assistant("conversation"), {})
+
+    first, second = sorted(store.list_sessions(), key=lambda session: session.id)
+    assert store.load(first.id).messages == [
+        system_message,
+        user("q"),
+        assistant("a"),
+        user("q2"),
+        assistant("a2"),
+    ]
+    assert store.load(second.id).messages == [user("new"), assistant("conversation")]
+
+
+def test_resume_unknown_session():
+    store = SessionStore(":memory:")
+    _, session = setup_session(store)
+    session.listener = mock.MagicMock()
+
+    assert not session.resume(42)
+    session.listener.on_error.assert_called_once()
+    assert session.messages == [system_message]
+
+
+def test_long_history_loads_quickly():
+    store = SessionStore(":memory:")
+    listener = SessionStoreListener(store)
+    messages = [system_message]
+    for i in range(1000):
+        listener.on_chat_response(
+            messages + [user(f"question {i}")], assistant(f"answer {i}"), {}
+        )
+        messages = messages + [user(f"question {i}"), assistant(f"answer {i}")]
+
+    started = time.monotonic()
+    stored = store.load(listener.session_id)
+    assert time.monotonic() - started < 0.5
+    assert stored.messages == messages
+    assert len(stored.user_prompts) == 1000
+
+
+def test_search_ranks_messages_across_sessions():
+    store = SessionStore(":memory:")
+    listener = SessionStoreListener(store)
+    listener.on_chat_response(
+        [user("how do I reverse a list in python?")],
+        assistant("Use reversed(items) or items[::-1]."),
+        {},
+    )
+    first = listener.session_id
+    listener.on_chat_clear()
+    listener.on_chat_response(
+        [user("what is a linked list?")], assistant("A list of linked nodes."), {}
+    )
+    second = listener.session_id
+
+    results = store.search("reverse list")
+    assert [(r.session_id, r.role) for r in results] == [(first, "user")]
+    assert "**reverse**" in results[0].snippet
+
+    # New messages are searchable as soon as they are written
+    listener.on_chat_response(
+        [
+            user("what is a linked list?"),
+            assistant("A list of linked nodes."),
+            user("reverse it"),
+        ],
+        assistant("Walk the nodes and flip each pointer."),
+        {},
+    )
+    assert {r.session_id for r in store.search("reverse")} == {first, second}
+    assert store.search("flip pointer")[0].role == "assistant"
+    assert store.search("") == []
+    # Punctuation is not read as query syntax
+    assert store.search('items[::-1] "')[0].role == "assistant"
+
+
+def test_search_skips_replaced_messages():
+    store = SessionStore(":memory:")
+    listener = SessionStoreListener(store)
+    prompt = user("name a fruit")
+    listener.on_chat_response([prompt], assistant("a banana"), {})
+    # A re-run response
+    listener.on_chat_response([prompt], assistant("an apple"), {})
+
+    assert store.search("banana") == []
+    assert [r.role for r in store.search("apple")] == ["assistant"]
+    assert [r.role for r in store.search("fruit")] == ["user"]
+
+
+def test_search_indexes_existing_database(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SessionStore(path)
+    listener = SessionStoreListener(store)
+    listener.on_chat_response([user("an old question")], assistant("an old answer"), {})
+    # A database written before the search index existed
+    store.connection.executescript(
+        "DROP TRIGGER messages_fts_insert; DROP TABLE messages_fts;"
+    )
+    store.close()
+
+    store = SessionStore(path)
+    assert sorted(r.role for r in store.search("old")) == ["assistant", "user"]
+
+
+def test_search_command():
+    store = SessionStore(":memory:")
+    assistant_mock, session = setup_session(store)
+    respond(assistant_mock, "Paris")
+    session.process_input("capital of France?", {})
+
+    session.listener = mock.MagicMock()
+    stream = session.listener.response_streamer.return_value.__enter__.return_value
+    session.process_input(":search france", {})
+    output = stream.on_next_token.call_args[0][0]
+    assert "**France**" in output
+    assert f"| {store.latest_session_id()} |" in output
+
+    session.process_input(":search", {})
+    session.listener.on_error.assert_called_once()
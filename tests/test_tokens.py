@@ -0,0 +1,79 @@
+from unittest import mock
+
+import pytest
+
+from gptcli import tokens
+from gptcli.session import ChatSession
+from gptcli.tokens import TokenCounter, count_messages_tokens
+
+
+class FakeEncoding:
+    name = "fake"
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text: str):
+        self.encoded.append(text)
+        return text.split()
+
+
+@pytest.fixture
+def encoding():
+    encoding = FakeEncoding()
+    tokens._token_cache.clear()
+    with mock.patch("gptcli.tokens.get_encoding", return_value=encoding):
+        yield encoding
+
+
+def message(content: str):
+    return {"role": "user", "content": content}
+
+
+def test_count_messages_tokens(encoding):
+    messages = [message("one two"), {"role": "user", "name": "bob", "content": "x"}]
+    # 4 + 1 + 2, 4 + 1 + 1 - 1 + 1, and 2 for the reply
+    assert count_messages_tokens(messages, "model") == 7 + 6 + 2
+
+
+def test_texts_are_encoded_once(encoding):
+    messages = [message("a b c")]
+    count_messages_tokens(messages, "model")
+    count_messages_tokens(messages + [message("d")], "model")
+
+    assert encoding.encoded == ["user", "a b c", "d"]
+
+
+def test_counter_is_incremental(encoding):
+    counter = TokenCounter("model", [message("a b")])
+    assert counter.total == 4 + 1 + 2 + 2
+
+    counter.append(message("c d e"))
+    counter.append(message("f"))
+    assert counter.total == 7 + 8 + 6 + 2
+
+    counter.truncate(1)
+    assert counter.total == 7 + 2
+    counter.append(message("g"))
+    assert counter.total == 7 + 6 + 2
+    assert counter.total == count_messages_tokens(
+        [message("a b"), message("g")], "model"
+    )
+
+
+def test_session_prompt_tokens(encoding):
+    assistant = mock.MagicMock()
+    assistant.init_messages.return_value = [message("system prompt")]
+    assistant._param.side_effect = lambda param, overrides: overrides.get(
+        "model", "model"
+    )
+    assistant.complete_chat.return_value = []
+    session = ChatSession(assistant, mock.MagicMock())
+    assert session.prompt_tokens() == 7 + 2
+
+    session.process_input("hello there", {})
+    # An empty assistant response: 4 + 1 ("assistant") + 0
+    assert session.prompt_tokens() == 7 + 7 + 5 + 2
+    session.process_input(":c", {})
+    assert session.prompt_tokens() == 7 + 2
+    assert session.prompt_tokens({"model": "other"}) == 7 + 2